@@ -2,10 +2,16 @@
 
 import sys
 import re
+import contextlib
+import copyreg
+import functools
 import textwrap
+import threading
+import weakref
 from . import util
 from .util import error_result
 from . import debugging
+from . import forest
 
 __doc__ = """
 This module provides a full-featured pure-python framework for building tokenizing LR language parsers and interpreters for context-free grammars.  (The :mod:`modgrammar` parsing engine is implemented as a recursive-descent parser with backtracking, using an object-oriented grammar model.)
@@ -23,9 +29,9 @@ Once a grammar is defined, the :meth:`~Grammar.parser` method can be called on t
 __all__ = [
     "ReferenceError", "UnknownReferenceError", "BadReferenceError", "ParseError", "Grammar",
     "Terminal",
-    "Literal", "Word", "Repetition", "ListRepetition", "Reference",
-    "GRAMMAR", "G", "ANY", "EMPTY", "REF", "LITERAL", "L", "OR", "EXCEPT", "WORD", "REPEAT", "LIST_OF", "OPTIONAL", "NOT_FOLLOWED_BY",
-    "ZERO_OR_MORE", "ONE_OR_MORE", "ANY_EXCEPT", "BOL", "EOL", "EOF",
+    "Literal", "Word", "Keywords", "Repetition", "ListRepetition", "Operators", "Reference",
+    "GRAMMAR", "G", "ANY", "EMPTY", "CUT", "REF", "LITERAL", "L", "OR", "EXCEPT", "WORD", "REPEAT", "LIST_OF", "OPTIONAL", "NOT_FOLLOWED_BY",
+    "ZERO_OR_MORE", "ONE_OR_MORE", "ANY_EXCEPT", "KEYWORDS", "OPERATORS", "BOL", "EOL", "EOF",
     "REST_OF_LINE", "WHITESPACE", "SPACE",
     "generate_ebnf",
     "WS_DEFAULT", "WS_NOEOL",
@@ -46,6 +52,31 @@ class _Singleton:
 
 DEFAULT = _Singleton("DEFAULT")  # singleton used for detecting default args
 
+_interned_grammars = weakref.WeakValueDictionary()
+
+# Held while linking grammars (see Grammar.grammar_link).
+_link_lock = threading.RLock()
+
+def _anongrammar(name, base, cdict):
+  # Structurally identical anonymous grammars are created all the time (every
+  # LITERAL(",") in a grammar, for example), so with intern=True they are
+  # interned: the same arguments return the same (read-only) class, and
+  # comparing such grammars is just an identity check.  Other anonymous
+  # grammars are separate classes which can be modified as usual.
+  if not cdict.pop('intern', False):
+    return GrammarClass(name, (base,), cdict)
+  try:
+    key = (name, util.IdentityKey(base), util.intern_key(cdict))
+  except TypeError:
+    # Some attribute is not hashable, so the class can't be shared.
+    return GrammarClass(name, (base,), cdict)
+  cls = _interned_grammars.get(key)
+  if cls is None:
+    cls = GrammarClass(name, (base,), cdict)
+    type.__setattr__(cls, '_interned', True)
+    _interned_grammars[key] = cls
+  return cls
+
 def _gclass_reconstructor(name, bases, cdict):
   return GrammarClass(name, bases, cdict)
 
@@ -124,24 +155,79 @@ class ParseError (Exception):
 
        The text message which would be printed if this exception were printed.  (This is of the form "Expected ...: Found ...")
   """
-  def __init__(self, grammar, buf, pos, char, line=None, col=None, expected=None, message=None):
-    if message is None:
+  def __init__(self, grammar, buf, pos, char, line=None, col=None, expected=None, message=None, origin=None, tabs=1):
+    # The message, line and column are only computed when someone actually
+    # asks for them, since parse errors are often caught and discarded
+    # (e.g. when trying alternatives or computing completions).  If *origin*
+    # (the (line, col) position of the start of *buf*) is given, line and col
+    # are calculated from it on first access.  Likewise *expected* can be a
+    # function, which is called to obtain the set of expected grammars when
+    # it is first needed.
+    self.grammar = grammar
+    self.buffer = buf
+    self.buffer_pos = pos
+    self.char = char
+    self._expected = expected
+    self._line = line
+    self._col = col
+    self._origin = origin if line is None and col is None else None
+    self._tabs = tabs
+    self._message = message
+
+  def _calc_line_col(self):
+    if self._origin is not None:
+      line, col = self._origin
+      self._origin = None
+      self._line, self._col = util.calc_line_col(self.buffer, self.buffer_pos, line, col, self._tabs)
+
+  @property
+  def line(self):
+    self._calc_line_col()
+    return self._line
+
+  @line.setter
+  def line(self, value):
+    self._calc_line_col()
+    self._line = value
+
+  @property
+  def col(self):
+    self._calc_line_col()
+    return self._col
+
+  @col.setter
+  def col(self, value):
+    self._calc_line_col()
+    self._col = value
+
+  @property
+  def expected(self):
+    if callable(self._expected):
+      self._expected = self._expected()
+    return self._expected
+
+  @expected.setter
+  def expected(self, value):
+    self._expected = value
+
+  @property
+  def message(self):
+    if self._message is None:
+      expected = self.expected
       if not expected:
-        message = ""
+        self._message = ""
       else:
         noteworthy = [e for e in expected if e.grammar_noteworthy]
         if not noteworthy:
           noteworthy = expected
         expected_txt = " or ".join(sorted(e.grammar_desc for e in noteworthy))
-        found_txt = util.get_found_txt(buf, pos)
-        message = "Expected {}: Found {}".format(expected_txt, found_txt)
-    self.buffer = buf
-    self.buffer_pos = pos
-    self.char = char
-    self.line = line
-    self.col = col
-    self.expected = expected
-    self.message = message
+        found_txt = util.get_found_txt(self.buffer, self.buffer_pos)
+        self._message = "Expected {}: Found {}".format(expected_txt, found_txt)
+    return self._message
+
+  @message.setter
+  def message(self, value):
+    self._message = value
 
   def __str__(self):
     lc = []
@@ -162,6 +248,9 @@ class GrammarClass (type):
   "The metaclass for all Grammar classes"
 
   def __init__(cls, name, bases, classdict):
+    if "grammar_parse" in classdict and "grammar_match" not in classdict:
+      # An inherited grammar_match would not agree with the new grammar_parse.
+      cls.grammar_match = None
     if getattr(cls, 'grammar', None) is None:
       # This is an abstract class definition.  Don't do any of our usual setup.
       return
@@ -203,6 +292,8 @@ class GrammarClass (type):
     for key in cls.__dict__.keys():
       if key.startswith('__'):
         del cdict[key]
+    # The recreated class is a separate one, so it isn't interned.
+    cdict.pop('_interned', None)
     return (_gclass_reconstructor, (cls.__name__, cls.__bases__, cdict))
 
   def __repr__(cls):
@@ -235,6 +326,10 @@ class GrammarClass (type):
       # should never change, so we just consider these attributes read-only if
       # our hash value has ever been calculated before.
       raise AttributeError("Changing the value of the {!r} attribute would change the hash value of the object.".format(attr))
+    if cls.__dict__.get('_interned') and not attr.startswith('_'):
+      # Interned anonymous grammars are shared by everything which created an
+      # identical grammar, so changing one would change all of them.
+      raise AttributeError("Anonymous grammar {!r} is interned and cannot be modified (create it without intern=True, or pass {!r} as a keyword argument).".format(cls, attr))
     return type.__setattr__(cls, attr, value)
 
   def __hash__(cls):
@@ -245,14 +340,21 @@ class GrammarClass (type):
     return hash_id
 
   def __eq__(cls, other):
+    if cls is other:
+      return True
     if not isinstance(other, GrammarClass):
       return NotImplemented
+    hash_id = getattr(cls, '_hash_id', None)
+    other_hash_id = getattr(other, '_hash_id', None)
+    if hash_id is not None and other_hash_id is not None and hash_id != other_hash_id:
+      return False
     return cls.grammar_hashdata() == other.grammar_hashdata()
 
   def __ne__(cls, other):
-    if not isinstance(other, GrammarClass):
-      return NotImplemented
-    return cls.grammar_hashdata() != other.grammar_hashdata()
+    result = cls.__eq__(other)
+    if result is NotImplemented:
+      return result
+    return not result
 
 class Text:
   """Text objects are used to hold the current working text being matched against the grammar.  They keep track of both the text contents and certain other useful state information such as whether we're at the beginning of a line or the end of a file, etc.
@@ -260,6 +362,8 @@ class Text:
   """
   def __init__(self, string, bol=False, eof=False):
     self.string = ""
+    # See whitespace_ends()
+    self.whitespace_cache = {}
     self.append(string, bol=bol, eof=eof)
 
   def append(self, string, bol=None, eof=None):
@@ -272,6 +376,8 @@ class Text:
     if string:
       self.string += string
       eof = bool(eof)
+      for ends in self.whitespace_cache.values():
+        ends.extend_to(self.string)
     if eof is not None:
       self.eof = eof
     return self
@@ -280,8 +386,18 @@ class Text:
     if count:
       self.bol = (self.string[count-1] == "\n")
       self.string = self.string[count:]
+      # Nothing is parsing the old positions anymore, but what is known about
+      # the rest of the text is kept (parsing usually went a bit past count).
+      self.whitespace_cache = {regex: ends.skip(count, self.string) for regex, ends in self.whitespace_cache.items()}
     return self
 
+  def whitespace_ends(self, regex):
+    """Return a sequence which, indexed by position, gives the end of the whitespace matching *regex* which starts there (or the position itself, if there is none).  It stays valid (and is extended) as more text is appended."""
+    ends = self.whitespace_cache.get(regex)
+    if ends is None:
+      ends = self.whitespace_cache[regex] = util.WhitespaceEnds(self.string, regex)
+    return ends
+
   def __str__(self):
     return self.string
 
@@ -290,10 +406,11 @@ class Text:
     return "{0.__module__}.{0.__name__}({1.string!r}, bol={1.bol}, eof={1.eof})".format(cls, self)
 
 class ParserSession:
-  def __init__(self, data={}):
+  def __init__(self, data=None):
     self.data = data
     self.parser = None
     self.debugger = None
+    self.update_best_error = util.update_best_error
 
 class GrammarParser:
   """
@@ -316,9 +433,18 @@ class GrammarParser:
      The position within the current :attr:`line` we're at.
   """
 
-  def __init__(self, grammar, sessiondata, tabs, debug, debug_flags):
+  def __init__(self, grammar, sessiondata, tabs, debug, debug_flags, error_tracking='full', reduce=False, algorithm='backtracking'):
+    if error_tracking not in ('full', 'deferred'):
+      raise ValueError("Invalid value for 'error_tracking' parameter: {!r}".format(error_tracking))
+    if algorithm not in ('backtracking', 'chart'):
+      raise ValueError("Invalid value for 'algorithm' parameter: {!r}".format(algorithm))
+    if hasattr(grammar, 'grammar_link'):
+      grammar.grammar_link()
     self.grammar = grammar
     self.tabs = tabs
+    self.error_tracking = error_tracking
+    self.reduce = reduce
+    self.algorithm = algorithm
     self.session = ParserSession(sessiondata)
     if not debug:
       self.debugger = None
@@ -357,6 +483,8 @@ class GrammarParser:
     self.text.append(string, bol=bol, eof=eof)
 
   def _parse(self, pos, session, matchtype):
+    if matchtype == 'forest' or self.algorithm == 'chart':
+      return self._parse_chart(pos, session, matchtype)
     debugger = session.debugger
     parsestate, matches = self.state
     best_error = None
@@ -391,8 +519,12 @@ class GrammarParser:
           if m and m.end() == len(self.text.string):
             return (None, None)
         char = self.char + errpos
-        line, col = util.calc_line_col(self.text.string, errpos, self.line, self.col, self.tabs)
-        raise ParseError(self.grammar, self.text.string, errpos, char, line=line, col=col, expected=expected)
+        if session.update_best_error is not util.update_best_error:
+          # Only the position of the furthest error was tracked.  Find out
+          # what was expected there by parsing again (if anyone asks).
+          text = self.text
+          expected = functools.partial(self._expected_at, Text(text.string, bol=text.bol, eof=text.eof), pos, session.data, matchtype)
+        raise ParseError(self.grammar, self.text.string, errpos, char, expected=expected, origin=(self.line, self.col), tabs=self.tabs)
       if count is None:
         # We need more input
         if self.text.eof:
@@ -426,20 +558,73 @@ class GrammarParser:
     elif matchtype == 'all':
       objs = [x[1] for x in matches]
       count = max(x[0] for x in matches)
-      pp_objs = []
-      for obj in objs:
-        result = obj.grammar_postprocess(None, session)
-        if len(result) == 1:
-          result = result[0]
-        pp_objs.append(result)
-      return (count, pp_objs)
+      return (count, [self._result(obj, session) for obj in objs])
     else:
       raise ValueError("Invalid value for 'matchtype' parameter: {!r}".format(matchtype))
 
-    result = obj.grammar_postprocess(None, session)
+    return (count, self._result(obj, session))
+
+  def _parse_chart(self, pos, session, matchtype):
+    if not self.text.eof:
+      # All the matches can only be known once we have all of the text.
+      return (None, None)
+    string = self.text.string
+    result, best_error = forest.parse_forest(self, pos, session)
+    lengths = result.lengths if result else []
+    if matchtype == 'complete':
+      for length in lengths:
+        if pos + length != len(string):
+          # Pretend there was an EOI grammar at the end that didn't match
+          best_error = util.merge_best_error(best_error, (pos + length, {EOI}))
+      lengths = [length for length in lengths if pos + length == len(string)]
+    if not lengths:
+      if pos == len(string):
+        # See _parse()
+        return (None, None)
+      errpos, expected = best_error
+      if errpos == len(string) and self.grammar.grammar_whitespace_mode != 'explicit':
+        m = self.grammar.grammar_whitespace.match(string, pos)
+        if m and m.end() == len(string):
+          return (None, None)
+      raise ParseError(self.grammar, string, errpos, self.char + errpos, expected=set(expected), origin=(self.line, self.col), tabs=self.tabs)
+    if matchtype == 'forest':
+      return (lengths[0], result)
+    if matchtype == 'all':
+      return (lengths[0], list(result))
+    if matchtype in ('complete', 'longest'):
+      count = lengths[0]
+    elif matchtype == 'shortest':
+      count = lengths[-1]
+    elif matchtype == 'first':
+      count = result._backtracking_lengths()[0]
+    elif matchtype == 'last':
+      count = result._backtracking_lengths()[-1]
+    else:
+      raise ValueError("Invalid value for 'matchtype' parameter: {!r}".format(matchtype))
+    return (count, result._backtracking_tree(count))
+
+  def _result(self, obj, session):
+    if self.reduce:
+      result = obj.grammar_reduced(session.data)
+    else:
+      result = obj.grammar_postprocess(None, session)
     if len(result) == 1:
       result = result[0]
-    return (count, result)
+    return result
+
+  def _expected_at(self, text, pos, data, matchtype):
+    # Second pass for error_tracking='deferred': repeat a failed parse with
+    # full error tracking and return the expected set of the resulting error.
+    parser = GrammarParser(self.grammar, data, self.tabs, None, None)
+    parser.text = text
+    session = ParserSession(data)
+    session.parser = parser
+    session.debugger = parser.debugger
+    try:
+      parser._parse(pos, session, matchtype)
+    except ParseError as e:
+      return e.expected
+    raise InternalError("Parse succeeded when repeated with full error tracking")
 
   def _parse_text(self, string, bol, eof, data, matchtype):
     if data is None:
@@ -450,13 +635,17 @@ class GrammarParser:
     pos = 0
     session.parser = self #FIXME
     session.debugger = self.debugger
+    if self.error_tracking == 'deferred' and self.algorithm == 'backtracking':
+      session.update_best_error = util.update_furthest_error
+    else:
+      session.update_best_error = util.update_best_error
 
     while True:
       count, obj = self._parse(pos, session, matchtype)
       if count is None:
         # Partial match
         break
-      elif matchtype != 'all':
+      elif matchtype not in ('all', 'forest'):
         self.skip(count)
       yield obj
       if not count:
@@ -497,6 +686,8 @@ class GrammarParser:
             The first match which exactly matches the input text (i.e. there is no remainder).
           'all'
             Return all possible matches, in a list.  Note that in this case the buffer position will not be automatically advanced.  You must call :func:`~GrammarParser.skip` manually.
+          'forest'
+            Return all possible matches as a :class:`~modgrammar.forest.ParseForest`, which stores the parts the matches have in common only once, and builds the individual results only when they are iterated over.  This also lets ambiguous texts be detected cheaply.  The result is only returned once *eof* is given, and as with ``'all'``, the buffer position is not advanced.
       *bol*
         Treat the input text as starting at the beginning of a line (for the purposes of matching the :const:`BOL` grammar element).  It is not usually necessary to specify this explicitly.
     """
@@ -543,24 +734,28 @@ class GrammarParser:
       for result in self._parse_text("", None, True, data, matchtype):
         yield result
 
-  def parse_file(self, file, encoding=None, bol=False, eof=True, reset=False, data=None, matchtype='first'):
+  def parse_file(self, file, encoding=None, bol=False, eof=True, reset=False, data=None, matchtype='first', blocksize=8192):
     """
     *(generator method)*
 
-    Open and process the contents of a file using the associated grammar.  This is basically the same as opening the specified file, and passing the resulting file object to :meth:`parse_lines`.
+    Open and process the contents of a file using the associated grammar.  This is basically the same as opening the specified file, and passing its contents to :meth:`parse_lines` a block of *blocksize* characters at a time.  Matches are returned as soon as enough of the file has been read to find them, so only the text of the match being worked on needs to be held in memory, however long the lines of the file are.  If *blocksize* is :const:`None`, the file is read a line at a time instead.
 
-    *file* and *encoding* are passed directly to :meth:`open`.  Return values, exceptions, and other optional parameters are all exactly the same as for :meth:`parse_text`.
+    *file* and *encoding* are passed directly to :meth:`open` (or *file* can be an already open file object).  Return values, exceptions, and other optional parameters are all exactly the same as for :meth:`parse_text`.
 
     .. note::
        Be careful using ``matchtype="all"`` with parse_lines/parse_file.  You must manually call :func:`~GrammarParser.skip` after each yielded match, or you will end up with an infinite loop!
     """
     if isinstance(file, str):
       with open(file, "r", encoding=encoding) as f:
-        for result in self.parse_lines(f, bol=bol, eof=eof, reset=reset, data=data, matchtype=matchtype):
+        for result in self.parse_file(f, bol=bol, eof=eof, reset=reset, data=data, matchtype=matchtype, blocksize=blocksize):
           yield result
+      return
+    if blocksize is None:
+      blocks = file
     else:
-      for result in self.parse_lines(file, bol=bol, eof=eof, reset=reset, data=data, matchtype=matchtype):
-        yield result
+      blocks = iter(functools.partial(file.read, blocksize), "")
+    for result in self.parse_lines(blocks, bol=bol, eof=eof, reset=reset, data=data, matchtype=matchtype):
+      yield result
 
   def skip(self, count):
     """
@@ -583,6 +778,63 @@ class GrammarParser:
     """
     return self.text.string
 
+class ParserPool:
+  """
+  A pool of :class:`GrammarParser` objects for the same grammar, which can be used by several threads at once.  Each parse is done by a parser which no other thread is using at the time; parsers are reused once they are released, so creating a parser is not paid for every time.
+
+  :class:`ParserPool` objects are not generally instantiated directly.  Instead, to obtain one, call the :meth:`~Grammar.parser_pool` method on the appropriate grammar class.
+  """
+
+  def __init__(self, grammar, size, parser_args):
+    self.grammar = grammar
+    self.size = size
+    self.parser_args = parser_args
+    self.idle = []
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    """
+    Return a parser for the calling thread to use until it is given back with :meth:`release`.  A new parser is created if there are no idle ones.
+    """
+    with self.lock:
+      if self.idle:
+        return self.idle.pop()
+    return self.grammar.parser(**self.parser_args)
+
+  def release(self, parser):
+    """
+    Give back a parser obtained from :meth:`acquire`.  The parser is :meth:`~GrammarParser.reset`, and kept for reuse unless the pool already holds *size* idle parsers.
+    """
+    parser.reset()
+    with self.lock:
+      if self.size is None or len(self.idle) < self.size:
+        self.idle.append(parser)
+
+  @contextlib.contextmanager
+  def parser(self):
+    """
+    Context manager which acquires a parser for the ``with`` block and releases it afterwards.
+    """
+    parser = self.acquire()
+    try:
+      yield parser
+    finally:
+      self.release(parser)
+
+  def parse_text(self, string, data=None, matchtype='first'):
+    """
+    Parse the complete text *string* with a parser from the pool.  This is equivalent to ``.parse_text(string, reset=True, eof=True, data=data, matchtype=matchtype)`` on a parser of one's own.
+    """
+    with self.parser() as parser:
+      return parser.parse_text(string, reset=True, eof=True, data=data, matchtype=matchtype)
+
+  def parse_string(self, string, data=None):
+    """
+    Parse *string* with a parser from the pool, the same as :meth:`GrammarParser.parse_string`.
+    """
+    with self.parser() as parser:
+      return parser.parse_string(string, data=data)
+
 ###############################################################################
 #                            Base (public) Classes                            #
 ###############################################################################
@@ -596,22 +848,57 @@ class Grammar (metaclass=GrammarClass):
   To define a new grammar, you should create a new class definition, descended from :class:`Grammar`.  In this class definition, you can override several class attributes and class methods to customize the behavior of the grammar.
   """
 
+  # Result objects are created for every (partial) match tried during parsing,
+  # so what each of them needs is kept in slots.  Subclasses still get a
+  # __dict__ for the attributes set by grammar_elem_init, but it is only
+  # allocated when one is actually set.
+  __slots__ = ('_str_info', 'elements', 'parent', '_postprocessed', '_grammar_value')
+
   grammar_terminal = False
   grammar_collapse = False
+  grammar_collapse_skip = False
   grammar_greedy = True
   grammar_null_subtoken_ok = True
   grammar_whitespace = None
   grammar_whitespace_mode = None
   grammar_error_override = False
   grammar_noteworthy = True
+  grammar_compact = False
   grammar_hashattrs = ('grammar_name', 'grammar', 'grammar_min', 'grammar_max', 'grammar_collapse', 'grammar_greedy', 'grammar_whitespace', 'grammar_whitespace_mode')
 
+  # Optional direct-call alternative to grammar_parse for grammars which can
+  # compute all of their results at once when the text is at EOF.  If set, it
+  # is a classmethod grammar_match(text, index) returning a sequence of the
+  # successful results grammar_parse would have yielded, or None to fall back
+  # to grammar_parse.  Once the sequence is exhausted, the failure result is
+  # obtained from grammar_match_error(index) (so it is only created when it is
+  # actually needed).
+  grammar_match = None
+
+  # Optional semantic action.  If set, it is called through the class as
+  # grammar_reduce(string, values, sessiondata), where string is the matched
+  # text and values is the list of the values of the elements (None for
+  # missing optional elements), and returns the value of the match.  Without
+  # it, the value of a terminal is its string and the value of anything else
+  # is the tuple of the values of its elements.  Collapsed grammars have no
+  # value of their own: the values of their elements are spliced into the
+  # values of the parent.
+  grammar_reduce = None
+
+  # Optional name of an attribute in which to store grammar_value() on each
+  # (postprocessed) result object, before grammar_elem_init is called.
+  grammar_value_attr = None
+
+  @classmethod
+  def grammar_match_error(cls, index):
+    return error_result(index, cls)
+
   @classmethod
   def __class_init__(cls, attrs):
     pass
 
   @classmethod
-  def parser(cls, sessiondata=None, tabs=1, debug=False, debug_flags=None):
+  def parser(cls, sessiondata=None, tabs=1, debug=False, debug_flags=None, error_tracking='full', reduce=False, algorithm='backtracking'):
     """
     Return a :class:`GrammarParser` associated with this grammar.
 
@@ -620,8 +907,30 @@ class Grammar (metaclass=GrammarClass):
     The *tabs* parameter indicates the width of "tab stops" in the input (i.e. how far a "tab" character will advance the column position when encountered).  This is only used to correctly report column numbers in :exc:`ParseError`\ s.  If you don't care about that, or your input does not contain tabs, you can ignore this parameter.
 
     The *debug* and *debug_flags* options control whether and how debugging information will be output while using this parser.  For more information on grammar debugging, see the :mod:`modgrammar.debugging` module documentation.
+
+    The *error_tracking* option controls how much work is done to produce the :attr:`~ParseError.expected` grammars of a :exc:`ParseError`.  With the default of ``'full'``, the expected grammars are collected from every failed alternative as parsing goes.  With ``'deferred'``, only the position of the furthest failure is tracked, which makes successful parses cheaper.  If the parse fails, the text is parsed again with full tracking when the :attr:`~ParseError.expected` grammars (or the error message) are first needed.
+
+    If *reduce* is :const:`True`, the parser returns the value of the match computed by the :attr:`grammar_reduce` semantic actions (see :meth:`grammar_reduced`) instead of a tree of result objects.  No :meth:`grammar_elem_init` methods are called in this mode.
+
+    The *algorithm* option selects how the text is matched.  The default, ``'backtracking'``, tries the alternatives one at a time and backs up when they fail.  This is fast for most grammars and can return matches before all of the input is available, but some grammars take exponential time on some texts.  With ``'chart'``, each grammar is matched at most once at each position of the text, and the matches are shared (as in the forest returned with ``matchtype='forest'``), which takes at most cubic time for any grammar without left recursion, and close to linear time for most texts which can only be parsed one way.  The results and the :exc:`ParseError`\ s are the same as with backtracking, except that:
+
+    * Results are only returned once *eof* is given.
+    * With ``matchtype='all'``, the results may come in a different order, and ``matchtype='last'`` gives the match whose length the backtracking parser would have found last, which may not be its last result.
+    * Grammars with custom :meth:`grammar_parse` methods (terminals, :func:`OPERATORS`, etc.) are still matched by those methods, :const:`CUT` has no effect, and the *debug* and *error_tracking* options are ignored.
+    * In repetitions without a maximum, empty matches of the elements after the first *min* ones (or the first one) are not used, where the backtracking parser may keep repeating them forever.
+
+    Before the first parser is created, the :func:`REF` declarations in the grammar are resolved (see :meth:`grammar_link`).
+    """
+    return GrammarParser(cls, sessiondata, tabs, debug, debug_flags, error_tracking, reduce, algorithm)
+
+  @classmethod
+  def parser_pool(cls, size=None, **kwargs):
+    """
+    Return a :class:`ParserPool` of parsers for this grammar, which several threads can parse with at the same time without any locking of their own.  At most *size* idle parsers are kept for reuse (any number if *size* is :const:`None`).  The other arguments are passed to :meth:`parser` when a parser is created.
+
+    A :class:`GrammarParser` keeps the state of the parse in progress, so each one must only be used by one thread at a time.  The grammar classes themselves hold no parsing state (apart from resolving their :func:`REF` declarations when the first parser is created, which is done only once), so any number of parsers can use the same grammar at once, in different threads or from within the :meth:`grammar_elem_init` and :attr:`grammar_reduce` actions of another parse.  The same goes for the *sessiondata* given here, as long as those actions don't modify it; otherwise, pass each parse its own *data*.
     """
-    return GrammarParser(cls, sessiondata, tabs, debug, debug_flags)
+    return ParserPool(cls, size, kwargs)
 
   # Yields:
   #   Success:     (count, obj)
@@ -651,13 +960,28 @@ class Grammar (metaclass=GrammarClass):
     else:
       whitespace_skip = False
       whitespace_reqd = False
+    if whitespace_skip:
+      # Sibling grammars (and this one, after backtracking) keep looking for
+      # whitespace at the same positions, so the results are cached.
+      whitespace_ends = text.whitespace_ends(whitespace_re)
+    # A collapsed grammar is replaced by its elements when the results are
+    # postprocessed (or reduced), so when it matches a single element, that
+    # element is returned as it is instead of building a result object around
+    # it.  (Result objects copy the list of elements they are given, so objs
+    # can be modified after they are created.)
+    passthrough = (cls.grammar_collapse
+                   and cls.grammar_collapsed_elems is Grammar.grammar_collapsed_elems
+                   and cls.grammar_postprocess is Grammar.grammar_postprocess
+                   and cls.grammar_reduced is Grammar.grammar_reduced)
     debugger = session.debugger
+    update_best_error = session.update_best_error
     objs = []
     states = []
     positions = []
     best_error = None
     pos = index
     first_pos = None
+    committed = False
 
     while True:
       # Forward ho!
@@ -665,22 +989,23 @@ class Grammar (metaclass=GrammarClass):
         if not greedy and len(objs) >= grammar_min:
           # If we're not "greedy", then try returning every match as soon as we
           # get it (which will naturally return the shortest matches first)
-          yield (pos - index, cls(text.string, index, pos, objs))
-          # We need to copy objs for any further stuff, since it's now part of
-          # the object we yielded above, which our caller may be keeping for
-          # later, so if we modify it in-place we'll be screwing up the
-          # 'entities' list of that object in the process.
-          objs = list(objs)
+          if passthrough and len(objs) == 1 and (objs[0]._cut or not committed):
+            obj = objs[0]
+          else:
+            obj = cls(text.string, index, pos, objs)
+            if committed:
+              obj._cut = True
+          yield (pos - index, obj)
         if len(objs) >= grammar_max:
           break
         prews_pos = pos
         if whitespace_skip:
           while True:
-            m = whitespace_re.match(text.string, pos)
-            if m:
+            ws_end = whitespace_ends[pos]
+            if ws_end != pos:
               if debugger:
-                debugger.ws_skipped(cls, pos, text, m.end() - pos)
-              pos = m.end()
+                debugger.ws_skipped(cls, pos, text, ws_end - pos)
+              pos = ws_end
             if pos < len(text.string) or text.eof:
               break
             text = yield (None, None)
@@ -692,27 +1017,38 @@ class Grammar (metaclass=GrammarClass):
             if debugger:
               debugger.ws_not_found(cls, pos, text)
             obj = util.error_result(pos, WHITESPACE)[1]
-            best_error = util.update_best_error(best_error, obj)
+            best_error = update_best_error(best_error, obj)
             break
         if first_pos is None:
           first_pos = pos
         g = grammar[len(objs)]
-        s = g.grammar_parse(text, pos, session)
-        if debugger:
-          s = debugger.debug_wrapper(s, g, pos, text)
+        s = None
+        if text.eof and g.grammar_match and not debugger:
+          s = g.grammar_match(text, pos)
+        if s is None:
+          s = g.grammar_parse(text, pos, session)
+          if debugger:
+            s = debugger.debug_wrapper(s, g, pos, text)
+        else:
+          s = iter(s)
         while True:
-          offset, obj = next(s)
+          offset, obj = next(s, None) or g.grammar_match_error(pos)
           while offset is None:
             text = yield (None, None)
             offset, obj = s.send(text)
           if cls.grammar_null_subtoken_ok or offset is not 0:
             break
         if offset is False:
-          best_error = util.update_best_error(best_error, obj)
+          best_error = update_best_error(best_error, obj)
           pos = prews_pos
           break
         objs.append(obj)
         states.append((pos, s))
+        if obj._cut:
+          # We've passed a CUT, so we're committed to everything before this
+          # element and can forget how to backtrack into it.
+          del states[:-1]
+          committed = True
         pos += offset
       # Went as far as we can forward and it didn't work.  Backtrack until we
       # find something else to follow...
@@ -721,25 +1057,29 @@ class Grammar (metaclass=GrammarClass):
           # If we are greedy, then return matches only after we've gone as far
           # forward as possible, while we're backtracking (returns the longest
           # matches first)
-          yield (pos - index, cls(text.string, index, pos, objs))
-          # We need to copy objs for any further stuff, since it's now part of
-          # the object we yielded above, which our caller may be keeping for
-          # later, so if we modify it in-place we'll be screwing up the
-          # 'entities' list of that object in the process.
-          objs = list(objs)
+          if passthrough and len(objs) == 1 and (objs[0]._cut or not committed):
+            obj = objs[0]
+          else:
+            obj = cls(text.string, index, pos, objs)
+            if committed:
+              obj._cut = True
+          yield (pos - index, obj)
         if not states:
           break
         pos, s = states[-1]
-        offset, obj = next(s)
+        offset, obj = next(s, None) or grammar[len(objs) - 1].grammar_match_error(pos)
         while offset is None:
           text = yield (None, None)
           offset, obj = s.send(text)
         if offset is False:
-          best_error = util.update_best_error(best_error, obj)
+          best_error = update_best_error(best_error, obj)
           states.pop()
           objs.pop()
         else:
           objs[-1] = obj
+          if obj._cut:
+            del states[:-1]
+            committed = True
           pos += offset
           break
       # Have we gone all the way back to the beginning?
@@ -857,6 +1197,8 @@ class Grammar (metaclass=GrammarClass):
         If :const:`True`, it is not considered an error if a :func:`REF` construct cannot be resolved at this time (it will simply be left as a :func:`REF` in the resulting grammar).  If :const:`False`, then all references must be resolvable or an :exc:`UnresolvedReference` exception will be raised.
       *skip*
         An optional list of grammars which should not be searched for :func:`REF` constructs (useful in conjunction with *recurse* to exclude certain parts of the grammar).
+
+    References created with ``REF(..., dynamic=True)`` are always left in place, to be resolved while parsing.
     """
 
     if not skip:
@@ -872,12 +1214,14 @@ class Grammar (metaclass=GrammarClass):
     grammar = []
     for g in cls.grammar:
       rec = recurse
-      while issubclass(g, Reference):
+      while issubclass(g, Reference) and not g.ref_dynamic:
         try:
           g = g.resolve(refmap)
         except UnknownReferenceError:
           if not missing_ok:
             raise
+          rec = False
+          break
         if not follow:
           rec = False
           break
@@ -888,16 +1232,71 @@ class Grammar (metaclass=GrammarClass):
       grammar.append(g)
       if rec and hasattr(g, "grammar_resolve_refs"):
         g.grammar_resolve_refs(refmap, recurse, follow, missing_ok, skip)
+    if isinstance(cls.grammar, util.RepeatingTuple):
+      grammar = util.RepeatingTuple(*grammar, len=cls.grammar.len)
+    else:
+      grammar = tuple(grammar)
     # We have to bypass the normal __setattr__ here because we're technically
     # changing a hash-related attr after our hash may already have been
     # calculated.  In this case, it's ok, because the two grammars are
-    # effectively the same anyway.
-    type.__setattr__(cls, 'grammar', tuple(grammar))
+    # effectively the same anyway.  (Other threads may be parsing with this
+    # grammar meanwhile, so it's replaced in one go.)
+    type.__setattr__(cls, 'grammar', grammar)
+
+  @classmethod
+  def grammar_link(cls):
+    """
+    Replace all the (non-dynamic) :func:`REF` declarations which can currently be resolved within the grammar tree with the grammars they refer to, so they don't need to be looked up again during every parse.  References which can't be resolved yet are left alone and are still resolved (also using the parser's *sessiondata*) while parsing.
+
+    This is done automatically when a parser is created for the grammar, and only the first time.
+    """
+    if cls.__dict__.get('_linked'):
+      return
+    with _link_lock:
+      if cls.__dict__.get('_linked'):
+        return
+      cls.grammar_resolve_refs(recurse=True, follow=True, missing_ok=True)
+      type.__setattr__(cls, '_linked', True)
+
+  # Set on results which contain a CUT, so the grammars they are part of stop
+  # backtracking into what came before them.
+  _cut = False
 
   def __init__(self, string, start=0, end=None, parsed=()):
     self._str_info = (string, start, end)
-    self.elements = parsed
-    self.string = ""
+    self.elements = tuple(parsed)
+    # Set once grammar_postprocess has processed the elements of this object
+    # (result objects may be shared between several candidate parse trees).
+    self._postprocessed = False
+
+  @property
+  def string(self):
+    # The matched string is only sliced out of the input buffer the first time
+    # it is actually needed (most intermediate results are never asked).
+    info = self._str_info
+    if info.__class__ is tuple:
+      s, start, end = info
+      info = self._str_info = s[start:end]
+    return info
+
+  @string.setter
+  def string(self, value):
+    self._str_info = value
+
+  def __getstate__(self):
+    state = dict(getattr(self, '__dict__', ()))
+    for name in Grammar.__slots__:
+      try:
+        state[name] = getattr(self, name)
+      except AttributeError:
+        pass
+    # Don't carry the whole input buffer along.
+    state['_str_info'] = self.string
+    return state
+
+  def __setstate__(self, state):
+    for name, value in state.items():
+      setattr(self, name, value)
 
   def grammar_collapsed_elems(self, sessiondata):
     """
@@ -916,10 +1315,7 @@ class Grammar (metaclass=GrammarClass):
 
   def grammar_postprocess(self, parent, session):
     self.parent = parent
-    if hasattr(self, '_str_info'):
-      s, start, end = self._str_info
-      self.string = s[start:end]
-      #del self._str_info
+    if not self._postprocessed:
       if self.grammar_collapse:
         elems = self.grammar_collapsed_elems(session.data)
         pp_elems = []
@@ -935,8 +1331,8 @@ class Grammar (metaclass=GrammarClass):
         for e in elems:
           pp_elems.extend(e.grammar_postprocess(self, session))
         self.elements = tuple(pp_elems)
-        del self._str_info
-    if hasattr(self, 'elem_init'):
+        self._postprocessed = True
+    if hasattr(self.__class__, 'elem_init'):
       for c in type.mro(self.__class__):
         if 'elem_init' in c.__dict__:
           break
@@ -944,9 +1340,53 @@ class Grammar (metaclass=GrammarClass):
         c = self.__class__
       util.depwarning("In class {}.{}: 'elem_init' method is deprecated.  Use 'grammar_elem_init' instead.".format(c.__module__, c.__name__), util.get_calling_stacklevel())
       self.elem_init(session.data)
+    if self.grammar_value_attr is not None:
+      setattr(self, self.grammar_value_attr, self.grammar_value(session.data))
     self.grammar_elem_init(session.data)
+    if self.grammar_compact:
+      # Everything needed from the sub-elements has been extracted by
+      # grammar_elem_init, so let go of the parse tree below this object.
+      self.elements = ()
     return (self,)
 
+  def grammar_reduced(self, sessiondata):
+    """
+    Return the tuple of values this result contributes to the values of its parent (this is used by parsers created with ``reduce=True`` instead of :meth:`grammar_postprocess`).  The values are computed bottom-up from the raw parse results, without postprocessing them or calling :meth:`grammar_elem_init`.
+    """
+    if self.grammar_collapse:
+      values = []
+      for e in self.grammar_collapsed_elems(sessiondata):
+        if e is None:
+          values.append(None)
+        else:
+          values.extend(e.grammar_reduced(sessiondata))
+      return tuple(values)
+    values = []
+    for e in self.elements:
+      values.extend(e.grammar_reduced(sessiondata))
+    return (self._grammar_reduce_values(values, sessiondata),)
+
+  def grammar_value(self, sessiondata=None):
+    """
+    Return the value of this (postprocessed) result, the same as a parser created with ``reduce=True`` would have returned for it.  The value is computed on first call and remembered.
+    """
+    try:
+      return self._grammar_value
+    except AttributeError:
+      pass
+    values = [None if e is None else e.grammar_value(sessiondata) for e in self.elements]
+    value = self._grammar_reduce_values(values, sessiondata)
+    self._grammar_value = value
+    return value
+
+  def _grammar_reduce_values(self, values, sessiondata):
+    reduce = self.__class__.grammar_reduce
+    if reduce is not None:
+      return reduce(self.string, values, sessiondata)
+    if self.grammar_terminal:
+      return self.string
+    return tuple(values)
+
   def grammar_elem_init(self, sessiondata):
     """
     This method is called on each result object after it is fully initialized, before the resulting parse tree is returned to the caller.  It can be overridden to perform any custom initialization desired (the default implementation does nothing).
@@ -1042,7 +1482,7 @@ class Grammar (metaclass=GrammarClass):
     return len(self.string)
 
   def __bool__(self):
-    return bool(self.elements) or self.grammar_terminal
+    return bool(self.elements) or self.grammar_terminal or self.grammar_compact
 
   def __str__(self):
     return self.string
@@ -1063,11 +1503,13 @@ class Grammar (metaclass=GrammarClass):
     except KeyError:
       lookup = None
     if lookup == cls:
-      return object.__reduce__(cls, self)
+      return (copyreg.__newobj__, (cls,), self.__getstate__())
     cdict = dict(cls.__dict__)
     for key in cls.__dict__.keys():
       if key.startswith('__'):
         del cdict[key]
+    # The recreated class is a separate one, so it isn't interned.
+    cdict.pop('_interned', None)
     if hasattr(self, '__getstate__'):
       state = self.__getstate__()
     else:
@@ -1134,6 +1576,12 @@ class Literal (Terminal):
       yield (len(cls.string), cls(cls.string))
     yield error_result(index, cls)
 
+  @classmethod
+  def grammar_match(cls, text, index):
+    if text.string.startswith(cls.string, index):
+      return ((len(cls.string), cls(cls.string)),)
+    return ()
+
   @classmethod
   def grammar_ebnf_rhs(cls, opts):
     return None
@@ -1150,20 +1598,22 @@ def GRAMMAR(*subgrammars, **kwargs):
   Allows the construction of "anonymous grammars", that is, creating a grammar without explicitly defining a named class derived from the :class:`Grammar` superclass.  This can be useful for some simple grammars where a full class definition is not necessary.
 
    *subgrammars* is a list of other grammars which the new grammar should be made up of, the same as would be given as the :attr:`~Grammar.grammar` attribute in a grammar class definition.
+
+   This and the other functions creating anonymous grammars (:func:`LITERAL`, :func:`OR`, :func:`REPEAT`, etc.) accept an *intern* keyword argument.  With ``intern=True``, calls with the same arguments return the same grammar class, so comparing such grammars is an identity check, but the class is shared and its attributes cannot be changed afterwards.  Literals created implicitly from plain strings in a grammar are always interned.
   """
   grammar = util.regularize(subgrammars)
   if len(grammar) == 1 and not kwargs:
     return grammar[0]
   else:
     cdict = util.make_classdict(AnonGrammar, grammar, kwargs)
-    return GrammarClass("<GRAMMAR>", (AnonGrammar,), cdict)
+    return _anongrammar("<GRAMMAR>", AnonGrammar, cdict)
 
 def LITERAL(string, **kwargs):
   """
   Create a simple grammar that only matches the specified literal string.  Literal matches are case-sensitive.
   """
   cdict = util.make_classdict(Literal, (), kwargs, string=string)
-  return GrammarClass("<LITERAL>", (Literal,), cdict)
+  return _anongrammar("<LITERAL>", Literal, cdict)
 
 class ANY (Terminal):
   grammar_whitespace_mode = 'explicit'
@@ -1182,6 +1632,12 @@ class ANY (Terminal):
     yield (1, cls(text.string, index, index+1))
     yield error_result(index, cls)
 
+  @classmethod
+  def grammar_match(cls, text, index):
+    if index == len(text.string):
+      return ()
+    return ((1, cls(text.string, index, index+1)),)
+
 class EMPTY (Terminal):
   grammar_whitespace_mode = 'explicit'
   grammar_whitespace = None
@@ -1196,6 +1652,39 @@ class EMPTY (Terminal):
     yield (0, cls(""))
     yield error_result(index, cls)
 
+  @classmethod
+  def grammar_match(cls, text, index):
+    return ((0, cls("")),)
+
+  @classmethod
+  def grammar_ebnf_lhs(cls, opts):
+    return ("(*empty*)", ())
+
+  @classmethod
+  def grammar_ebnf_rhs(cls, opts):
+    return None
+
+class CUT (Terminal):
+  """
+  Matches the empty string (like :const:`EMPTY`), but commits to what was matched before it: once a sequence (or repetition) has matched its elements up to a :const:`CUT`, it will not backtrack to try other matches for them, and neither will any grammars which the sequence is part of, once it has matched.  This lets the parser forget the state needed for backtracking, so grammars like a long list of statements can be parsed in constant space, and errors are reported where the committed match fails instead of after trying every alternative before it.
+  """
+  grammar_whitespace_mode = 'explicit'
+  grammar_whitespace = None
+  grammar = ()
+  grammar_collapse = True
+  grammar_collapse_skip = True
+  grammar_desc = "(nothing)"
+  _cut = True
+
+  @classmethod
+  def grammar_parse(cls, text, index, session):
+    yield (0, cls(""))
+    yield error_result(index, cls)
+
+  @classmethod
+  def grammar_match(cls, text, index):
+    return ((0, cls("")),)
+
   @classmethod
   def grammar_ebnf_lhs(cls, opts):
     return ("(*empty*)", ())
@@ -1218,7 +1707,7 @@ def OR(*grammars, **kwargs):
     else:
       collapsed.append(GRAMMAR(g))
   cdict = util.make_classdict(OR_Operator, collapsed, kwargs)
-  return GrammarClass("<OR>", (OR_Operator,), cdict)
+  return _anongrammar("<OR>", OR_Operator, cdict)
 
 class OR_Operator (Grammar):
   grammar_whitespace_mode = 'explicit'
@@ -1236,8 +1725,17 @@ class OR_Operator (Grammar):
   @classmethod
   def grammar_parse(cls, text, index, session):
     debugger = session.debugger
+    update_best_error = session.update_best_error
     best_error = None
     for g in cls.grammar:
+      results = None
+      if text.eof and g.grammar_match and not debugger:
+        results = g.grammar_match(text, index)
+      if results is not None:
+        for result in results:
+          yield result
+        best_error = update_best_error(best_error, g.grammar_match_error(index)[1])
+        continue
       results = g.grammar_parse(text, index, session)
       if debugger:
         results = debugger.debug_wrapper(results, g, index, text)
@@ -1246,7 +1744,7 @@ class OR_Operator (Grammar):
           text = yield (None, None)
           count, obj = results.send(text)
         if count is False:
-          best_error = util.update_best_error(best_error, obj)
+          best_error = update_best_error(best_error, obj)
           break
         yield (count, obj)
     yield error_result(*best_error)
@@ -1277,7 +1775,7 @@ def NOT_FOLLOWED_BY(*grammar, **kwargs):
   When successful (that is, the next text in the input does not match the specified grammar), this element of the parse tree will contain :const:`None`, and no input text will be consumed.  When unsuccessful (that is, the next text does match), a :exc:`ParseError` will be raised.
   """
   cdict = util.make_classdict(NotFollowedBy, grammar, kwargs)
-  return GrammarClass("<NOT_FOLLOWED_BY>", (NotFollowedBy,), cdict)
+  return _anongrammar("<NOT_FOLLOWED_BY>", NotFollowedBy, cdict)
 
 class NotFollowedBy (Grammar):
   grammar_whitespace_mode = 'explicit'
@@ -1344,15 +1842,40 @@ def EXCEPT(grammar, exc_grammar, **kwargs):
      In many cases there are more efficient ways to design a particular grammar than using this construct.  It is provided mostly for full EBNF compatibility.
   """
   cdict = util.make_classdict(ExceptionGrammar, (grammar, exc_grammar), kwargs)
-  return GrammarClass("<EXCEPT>", (ExceptionGrammar,), cdict)
+  return _anongrammar("<EXCEPT>", ExceptionGrammar, cdict)
 
 class ExceptionGrammar (Grammar):
   grammar_whitespace_mode = 'explicit'
+  grammar_exc_literals = None
 
   @classmethod
   def __class_init__(cls, attrs):
     if not "grammar_desc" in attrs and cls.grammar:
       cls.grammar_desc = "{} except {}".format(cls.grammar[0].grammar_desc, cls.grammar[1].grammar_desc)
+    if cls.grammar:
+      cls.grammar_exc_literals = cls._literal_exclusions(cls.grammar[1])
+
+  @staticmethod
+  def _literal_exclusions(grammar):
+    # If the exception grammar is just a literal (or an OR of literals), we can
+    # check a candidate match by looking up the matched span in a set of
+    # strings instead of re-parsing a copy of the text.  Returns a dict
+    # mapping string length to the set of strings of that length, or None if
+    # the exception grammar is something more complicated.
+    literals = []
+    pending = [grammar]
+    while pending:
+      g = pending.pop()
+      if issubclass(g, Literal) and g.grammar_parse.__func__ is Literal.grammar_parse.__func__:
+        literals.append(g.string)
+      elif issubclass(g, OR_Operator) and g.grammar_parse.__func__ is OR_Operator.grammar_parse.__func__:
+        pending.extend(g.grammar)
+      else:
+        return None
+    by_length = {}
+    for string in literals:
+      by_length.setdefault(len(string), set()).add(string)
+    return dict((length, frozenset(strings)) for length, strings in by_length.items())
 
   @classmethod
   def grammar_parse(cls, text, index, session):
@@ -1360,6 +1883,7 @@ class ExceptionGrammar (Grammar):
     best_error = None
     g = cls.grammar[0]
     exc = cls.grammar[1]
+    exc_literals = cls.grammar_exc_literals
     results = g.grammar_parse(text, index, session)
     if debugger:
       results = debugger.debug_wrapper(results, g, index, text)
@@ -1368,8 +1892,13 @@ class ExceptionGrammar (Grammar):
         text = yield (None, None)
         count, obj = results.send(text)
       if count is False:
-        best_error = util.update_best_error(best_error, obj)
+        best_error = session.update_best_error(best_error, obj)
         break
+      if exc_literals is not None:
+        strings = exc_literals.get(count)
+        if not strings or text.string[index:index+count] not in strings:
+          yield (count, obj)
+        continue
       # We found one, but now we need to check to make sure that the
       # exception-grammar does NOT match the same part of the text string.
       e_text = Text(text.string[:index+count], bol=text.bol, eof=True)
@@ -1423,7 +1952,7 @@ def REPEAT(*grammar, **kwargs):
   Match (by default) one-or-more repetitions of *grammar*, one right after another.  If the *min* or *max* keyword parameters are provided, the number of matches can be restricted to a particular range.
   """
   cdict = util.make_classdict(Repetition, grammar, kwargs)
-  return GrammarClass("<REPEAT>", (Repetition,), cdict)
+  return _anongrammar("<REPEAT>", Repetition, cdict)
 
 class Repetition (Grammar):
   grammar_count = None
@@ -1462,15 +1991,6 @@ class Repetition (Grammar):
       params += ", collapse=True"
     return "REPEAT({}{})".format(cls.grammar[0].grammar_details(depth, visited), params)
 
-  @classmethod
-  def grammar_resolve_refs(cls, refmap={}, recurse=True, follow=False, missing_ok=False, skip=None):
-    # The default grammar_resolve_refs process will inadvertently replace our
-    # RepeatingTuple with a simple tuple, so we need to convert it back to
-    # RepeatingTuple after it's done.
-    old_grammar = cls.grammar
-    Grammar.grammar_resolve_refs.__func__(cls, refmap, recurse, follow, missing_ok, skip)
-    type.__setattr__(cls, 'grammar', util.RepeatingTuple(*cls.grammar, len=old_grammar.len))
-
   #TODO: implement strict vs non-strict EBNF
   @classmethod
   def grammar_ebnf_lhs(cls, opts):
@@ -1516,7 +2036,7 @@ def WORD(startchars, restchars=None, fullmatch=False, escapes=False, **kwargs):
     fullmatch = kwargs['longest']
     del kwargs['longest']
   cdict = util.make_classdict(Word, (), kwargs, startchars=startchars, restchars=restchars, fullmatch_only=fullmatch, escapes=escapes)
-  return GrammarClass("<WORD>", (Word,), cdict)
+  return _anongrammar("<WORD>", Word, cdict)
 
 class Word (Terminal):
   grammar_whitespace_mode = 'explicit'
@@ -1599,6 +2119,10 @@ class Word (Terminal):
       string = text.string
       m = cls.regexp.match(string, index)
       if not m:
+        if index == len(string) and not text.eof:
+          # Nothing to look at yet, wait for more text.
+          text = yield (None, None)
+          continue
         yield error_result(index, cls)
       end = m.end()
       matchlen = end - index
@@ -1618,6 +2142,29 @@ class Word (Terminal):
         matchlen -= 1
     yield error_result(index, cls)
 
+  # Above this many candidate matches, grammar_match defers to the generator,
+  # which only creates the shorter matches if backtracking asks for them.
+  grammar_match_limit = 8
+
+  @classmethod
+  def grammar_match(cls, text, index):
+    string = text.string
+    m = cls.regexp.match(string, index)
+    if not m:
+      return ()
+    end = m.end()
+    matchlen = end - index
+    if matchlen < cls.grammar_min:
+      return ()
+    if cls.fullmatch_only:
+      return ((matchlen, cls(string, index, end)),)
+    if matchlen - cls.grammar_min >= cls.grammar_match_limit:
+      return None
+    lengths = range(cls.grammar_min, matchlen + 1)
+    if cls.grammar_greedy:
+      lengths = reversed(lengths)
+    return [(length, cls(string, index, index+length)) for length in lengths]
+
   @classmethod
   def grammar_ebnf_lhs(cls, opts):
     return (util.ebnf_specialseq(cls, opts), ())
@@ -1629,7 +2176,7 @@ class Word (Terminal):
   def __bool__(self):
     return bool(self.string)
 
-def REF(ref_name, module=DEFAULT, default=None):
+def REF(ref_name, module=DEFAULT, default=None, dynamic=False):
   """
   Create a reference to a grammar named *ref_name*, to be resolved later.
 
@@ -1638,17 +2185,20 @@ def REF(ref_name, module=DEFAULT, default=None):
   By default, resolving a reference involves searching for a grammar class with the same name in the same python module.  The python module is determined based on the location where the :func:`REF` call occurred.  If you wish to use a different module to look for the grammar this :func:`REF` refers to, it can be provided in the *module* parameter.  If *module* is given as :const:`None`, then no module will be searched.
 
   If provided, *default* should contain a grammar which will be used if the given reference cannot be resolved.
+
+  References are normally resolved once, when the first parser for the grammar is created (see :meth:`~Grammar.grammar_link`).  If *dynamic* is :const:`True`, the reference is instead resolved every time it is used in parsing, looking first in the parser's *sessiondata* (using its ``grammar_resolve_ref()`` method if it has one, or else looking up *ref_name* as a key), so different parsers can use different grammars for it.
   """
   if module is DEFAULT:
     # Try to figure out what module we were called from, as that should be what
     # we"ll later look things up relative to...
     module = util.get_calling_module()
-  return GrammarClass("<REF>", (Reference,), dict(ref_name=ref_name, ref_base=module, ref_default=default))
+  return GrammarClass("<REF>", (Reference,), dict(ref_name=ref_name, ref_base=module, ref_default=default, ref_dynamic=dynamic))
 
 class Reference (Grammar):
   ref_name = None
   ref_base = None
   ref_default = None
+  ref_dynamic = False
   grammar_whitespace_mode = 'explicit'
   grammar = ()
 
@@ -1724,7 +2274,7 @@ def LIST_OF(*grammar, **kwargs):
      Although this is most commonly used with a literal separator (such as the default ``","``), actually any (arbitrarily-complex) subgrammar can be specified for *sep* if desired.
   """
   cdict = util.make_classdict(ListRepetition, grammar, kwargs)
-  return GrammarClass("<LIST>", (ListRepetition,), cdict)
+  return _anongrammar("<LIST>", ListRepetition, cdict)
 
 class ListRepetition (Repetition):
   sep = LITERAL(",")
@@ -1754,7 +2304,7 @@ class ListRepetition (Repetition):
       params += ", collapse=True"
     return "LIST_OF({}, sep={}{})".format(cls.grammar[0].grammar_details(depth, visited), cls.sep.grammar_details(depth, visited), params)
 
-  def grammar_postprocess(self, parent, session):
+  def _flatten_elements(self):
     # Collapse down the succ_grammar instances for successive matches
     elems = []
     for e in self.elements:
@@ -1762,9 +2312,196 @@ class ListRepetition (Repetition):
         elems = [e]
       else:
         elems.extend(e.elements)
-    self.elements = elems
+    self.elements = tuple(elems)
+
+  def grammar_postprocess(self, parent, session):
+    self._flatten_elements()
     return Grammar.grammar_postprocess(self, parent, session)
 
+  def grammar_reduced(self, sessiondata):
+    self._flatten_elements()
+    return Grammar.grammar_reduced(self, sessiondata)
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+def OPERATORS(operand, *levels, **kwargs):
+  """
+  Match an expression consisting of one or more *operand*\ s separated by infix operators.  Each of *levels* is a tuple *(operators, associativity)*, where *operators* is an operator grammar (or a list of alternative operator grammars) and *associativity* is either ``'left'`` or ``'right'``.  The levels are listed from the highest precedence (most tightly binding) to the lowest.  For example::
+
+    OPERATORS(Number, ("^", 'right'), (["*", "/"], 'left'), (["+", "-"], 'left'))
+
+  Unlike the equivalent grammar built from nested :func:`REPEAT` and :func:`OR` constructs, the expression is parsed in a single pass using precedence climbing, without backtracking.  The first match of *operand* at each position and the first operator (in the order given) which matches are used, and only the longest possible expression is matched (so this construct never returns more than one match).
+
+  The result is an object of this grammar for each sequence of operators of the same precedence: for left-associative operators, its elements are the operands and operators of the whole sequence (``1 - 2 + 3`` gives one object with five elements, the same as a ``(operand, ONE_OR_MORE(operator, operand))`` grammar would), and for right-associative operators each operator gives an object with the three elements left operand, operator and right operand (so ``2 ^ 3 ^ 4`` gives ``(2, ^, (3, ^, 4))``).  The operands in these are either *operand* results or other objects of this grammar.  If the text contains only a single operand, the result is an object of this grammar with that operand as its only element.
+  """
+  grammar = (GRAMMAR(operand),)
+  operator_levels = []
+  for operators, associativity in levels:
+    if associativity not in ('left', 'right'):
+      raise GrammarDefError("Invalid associativity for OPERATORS(): {!r}".format(associativity))
+    operators = util.regularize(operators)
+    grammar += operators
+    operator_levels.append((len(operators), associativity))
+  cdict = util.make_classdict(Operators, grammar, kwargs, operator_levels=tuple(operator_levels))
+  return _anongrammar("<OPERATORS>", Operators, cdict)
+
+class Operators (Grammar):
+  operator_levels = ()
+  grammar_hashattrs = Grammar.grammar_hashattrs + ('operator_levels',)
+
+  @classmethod
+  def grammar_parse(cls, text, index, session):
+    # (grammar, precedence, is right-associative) for each operator.
+    operators = []
+    precedence = len(cls.operator_levels)
+    i = 1
+    for count, associativity in cls.operator_levels:
+      for g in cls.grammar[i:i+count]:
+        operators.append((g, precedence, associativity == 'right'))
+      i += count
+      precedence -= 1
+    operand = cls.grammar[0]
+    update_best_error = session.update_best_error
+    best_error = None
+
+    offset, obj, text = yield from cls._first_match(operand, text, index, session)
+    if offset is False:
+      if cls.grammar_error_override:
+        yield error_result(index, cls)
+      else:
+        yield (False, obj)
+      return
+    pos = index + offset
+    # The operands which haven't been combined yet, as (start, end, result,
+    # chain), where chain is [precedence, elements...] for a chain of
+    # left-associative operators which can still be extended (and result is
+    # None), and the operators between them as (precedence, is
+    # right-associative, result).  The operators on the stack always have
+    # increasing precedence.
+    operand_stack = [(index, pos, obj, None)]
+    operator_stack = []
+
+    def result(operand):
+      start, end, obj, chain = operand
+      if chain is not None:
+        obj = cls(text.string, start, end, tuple(chain[1:]))
+      return obj
+
+    def combine():
+      right = operand_stack.pop()
+      left = operand_stack.pop()
+      precedence, right_assoc, operator = operator_stack.pop()
+      start = left[0]
+      end = right[1]
+      chain = left[3]
+      if right_assoc:
+        obj = cls(text.string, start, end, (result(left), operator, result(right)))
+        operand_stack.append((start, end, obj, None))
+      elif chain is not None and chain[0] == precedence:
+        chain.extend((operator, result(right)))
+        operand_stack.append((start, end, None, chain))
+      else:
+        chain = [precedence, result(left), operator, result(right)]
+        operand_stack.append((start, end, None, chain))
+
+    while True:
+      op_pos, text = yield from cls._skip_whitespace(text, pos, session)
+      if op_pos is None:
+        break
+      for g, precedence, right_assoc in operators:
+        offset, obj, text = yield from cls._first_match(g, text, op_pos, session)
+        if offset is not False:
+          break
+        best_error = update_best_error(best_error, obj)
+      else:
+        break
+      operator = obj
+      operand_pos, text = yield from cls._skip_whitespace(text, op_pos + offset, session)
+      if operand_pos is None:
+        break
+      offset, obj, text = yield from cls._first_match(operand, text, operand_pos, session)
+      if offset is False:
+        best_error = update_best_error(best_error, obj)
+        break
+      while operator_stack and (operator_stack[-1][0] > precedence or (operator_stack[-1][0] == precedence and not right_assoc)):
+        combine()
+      operator_stack.append((precedence, right_assoc, operator))
+      pos = operand_pos + offset
+      operand_stack.append((operand_pos, pos, obj, None))
+    if len(operand_stack) == 1:
+      # No operators at all.
+      obj = cls(text.string, index, pos, (operand_stack[0][2],))
+    else:
+      while operator_stack:
+        combine()
+      obj = result(operand_stack[0])
+    yield (pos - index, obj)
+    if best_error is None:
+      yield error_result(pos, cls)
+    else:
+      yield (False, best_error)
+
+  @classmethod
+  def _first_match(cls, g, text, pos, session):
+    # Returns (offset, obj, text) for the first match of g at pos (offset is
+    # False and obj the error if there is none).
+    debugger = session.debugger
+    s = None
+    if text.eof and g.grammar_match and not debugger:
+      s = g.grammar_match(text, pos)
+    if s is None:
+      s = g.grammar_parse(text, pos, session)
+      if debugger:
+        s = debugger.debug_wrapper(s, g, pos, text)
+    else:
+      s = iter(s)
+    offset, obj = next(s, None) or g.grammar_match_error(pos)
+    while offset is None:
+      text = yield (None, None)
+      offset, obj = s.send(text)
+    return (offset, obj, text)
+
+  @classmethod
+  def _skip_whitespace(cls, text, pos, session):
+    # Returns (pos, text) after skipping the whitespace between an operand and
+    # an operator, with pos None if required whitespace is missing.
+    whitespace_mode = cls.grammar_whitespace_mode
+    if whitespace_mode not in ('optional', 'required'):
+      return (pos, text)
+    debugger = session.debugger
+    start = pos
+    while True:
+      end = text.whitespace_ends(cls.grammar_whitespace)[pos]
+      if end != pos:
+        if debugger:
+          debugger.ws_skipped(cls, pos, text, end - pos)
+        pos = end
+      if pos < len(text.string) or text.eof:
+        break
+      text = yield (None, None)
+    if whitespace_mode == 'required' and pos == start:
+      if debugger:
+        debugger.ws_not_found(cls, pos, text)
+      return (None, text)
+    return (pos, text)
+
+  @classmethod
+  def grammar_details(cls, depth=-1, visited=None):
+    if not visited:
+      visited = (cls,)
+    elif cls in visited:
+      # Circular reference.  Stop here.
+      return cls.grammar_name
+    else:
+      visited = visited + (cls,)
+    args = [cls.grammar[0].grammar_details(depth - 1, visited)]
+    i = 1
+    for count, associativity in cls.operator_levels:
+      operators = ", ".join(g.grammar_details(depth - 1, visited) for g in cls.grammar[i:i+count])
+      args.append("(({}), {!r})".format(operators, associativity))
+      i += count
+    return "OPERATORS({})".format(", ".join(args))
+
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 def OPTIONAL(*grammar, **kwargs):
@@ -1804,6 +2541,91 @@ def ANY_EXCEPT(charlist, **kwargs):
   kwargs.setdefault("grammar_name", "ANY_EXCEPT({!r})".format(charlist))
   return WORD("^{}".format(charlist), **kwargs)
 
+def KEYWORDS(*keywords, sep="", **kwargs):
+  """
+  Match any one of the literal strings *keywords*.  This is functionally equivalent to ``OR(*keywords)`` (or ``OR(*[(k, sep) for k in keywords])`` if *sep* is given), but instead of trying each literal in turn, the matching keyword is found with a single dictionary lookup, so it is well suited for large sets of keywords.
+
+  If *sep* is given, each keyword must be followed by *sep* (which is included in the match), and the keyword is the text up to the first occurrence of *sep* (so keywords should not contain *sep*).  Otherwise all keywords which match at the current position are returned, longest first.
+
+  The individual keywords are also available as :attr:`keyword_grammars` (a tuple of literal grammars, each matching one keyword followed by *sep*).  When the match fails, these are reported as the expected grammars instead of the :func:`KEYWORDS` grammar itself, so attributes set on them can be used for error reporting or completion.  The matched keyword (without *sep*) is available as the :attr:`keyword` attribute of the result object.
+  """
+  cdict = util.make_classdict(Keywords, (), kwargs, keywords=tuple(keywords), sep=sep)
+  return GrammarClass("<KEYWORDS>", (Keywords,), cdict)
+
+class Keywords (Terminal):
+  grammar_whitespace_mode = 'explicit'
+  grammar_whitespace = None
+  grammar = ()
+  keywords = ()
+  sep = ""
+  grammar_hashattrs = ('keywords', 'sep')
+
+  @classmethod
+  def __class_init__(cls, attrs):
+    if "grammar_name" not in attrs:
+      argspec = ", ".join(repr(k) for k in cls.keywords)
+      if cls.sep:
+        argspec += ", sep={!r}".format(cls.sep)
+      cls.grammar_name = "KEYWORDS({})".format(argspec)
+    if "grammar_desc" not in attrs:
+      cls.grammar_desc = " or ".join(repr(k) for k in cls.keywords)
+    # Not interned, so that attributes can be set on them.
+    cls.keyword_grammars = tuple(LITERAL(k + cls.sep) for k in cls.keywords)
+    cls.keyword_set = frozenset(cls.keywords)
+    # All prefixes of (keyword + sep), used to decide whether an incomplete
+    # input could still match once more text arrives.
+    cls.keyword_prefixes = frozenset((k + cls.sep)[:i] for k in cls.keywords for i in range(len(k) + len(cls.sep)))
+    cls.keyword_lengths = tuple(sorted(set(len(k) for k in cls.keywords), reverse=True))
+
+  @classmethod
+  def grammar_parse(cls, text, index, session):
+    sep = cls.sep
+    seplen = len(sep)
+    while True:
+      string = text.string
+      partial = not text.eof and string[index:] in cls.keyword_prefixes
+      if sep:
+        end = string.find(sep, index)
+        if end >= 0:
+          if string[index:end] in cls.keyword_set:
+            yield (end + seplen - index, cls(string, index, end + seplen))
+          break
+        if not partial:
+          break
+      elif not partial:
+        remaining = len(string) - index
+        for length in cls.keyword_lengths:
+          if length <= remaining and string[index:index+length] in cls.keyword_set:
+            yield (length, cls(string, index, index+length))
+        break
+      # Partial match.  Try again when we have more text.
+      text = yield (None, None)
+    yield cls.grammar_match_error(index)
+
+  @classmethod
+  def grammar_match(cls, text, index):
+    string = text.string
+    results = []
+    if cls.sep:
+      end = string.find(cls.sep, index)
+      if end >= 0 and string[index:end] in cls.keyword_set:
+        end += len(cls.sep)
+        results.append((end - index, cls(string, index, end)))
+    else:
+      remaining = len(string) - index
+      for length in cls.keyword_lengths:
+        if length <= remaining and string[index:index+length] in cls.keyword_set:
+          results.append((length, cls(string, index, index+length)))
+    return results
+
+  @classmethod
+  def grammar_match_error(cls, index):
+    return error_result(index, set(cls.keyword_grammars))
+
+  @property
+  def keyword(self):
+    return self.string[:len(self.string)-len(self.sep)]
+
 # FIXME: whitespace at beginning of line
 class BOL (Terminal):
   grammar_whitespace_mode = 'explicit'
@@ -1820,6 +2642,12 @@ class BOL (Terminal):
       yield (0, cls(""))
     yield error_result(index, cls)
 
+  @classmethod
+  def grammar_match(cls, text, index):
+    if (text.string[index-1] in ("\n", "\r")) if index else text.bol:
+      return ((0, cls("")),)
+    return ()
+
 class EOF (Terminal):
   grammar_whitespace_mode = 'explicit'
   grammar_whitespace = None
@@ -1829,10 +2657,19 @@ class EOF (Terminal):
 
   @classmethod
   def grammar_parse(cls, text, index, session):
+    while not text.eof and index == len(text.string):
+      # Can't tell yet whether more text is coming.
+      text = yield (None, None)
     if text.eof and index == len(text.string):
       yield (0, cls(""))
     yield error_result(index, cls)
 
+  @classmethod
+  def grammar_match(cls, text, index):
+    if index == len(text.string):
+      return ((0, cls("")),)
+    return ()
+
 class EOI (EOF):
   """
   This "end-of-input" grammar is a special case of EOF only used internally by
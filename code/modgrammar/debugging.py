@@ -2,6 +2,7 @@
 
 import logging
 import io
+import time
 import modgrammar
 
 __doc__ = """
@@ -307,3 +308,142 @@ class GrammarDebugger:
     if pos is not None:
       msg = "{} at {}".format(msg, pos)
     self.logger.debug("{}  ## {}".format(self.stack_summary(self.stack), msg))
+
+class GrammarStats:
+  """
+  Parse statistics collected by :class:`GrammarProfiler` for a single grammar class.
+
+  .. attribute:: grammar
+
+     The grammar class these statistics are for.
+
+  .. attribute:: calls
+
+     Number of times :meth:`~modgrammar.Grammar.grammar_parse` was invoked for the grammar.
+
+  .. attribute:: retries
+
+     Number of times the parser re-entered the grammar to look for an alternative match.
+
+  .. attribute:: successes
+  .. attribute:: failures
+  .. attribute:: partials
+
+     Number of successful, failed and partial (need more input) results returned by the grammar.
+
+  .. attribute:: backtracks
+
+     Number of failures returned after the grammar had already matched at the same position (i.e. all of its matches were rejected by the enclosing grammar).
+
+  .. attribute:: time
+
+     Cumulative time (in seconds) spent in the grammar, including its sub-grammars.
+
+  .. attribute:: self_time
+
+     Time (in seconds) spent in the grammar, excluding time spent in its sub-grammars.
+  """
+
+  def __init__(self, grammar):
+    self.grammar = grammar
+    self.calls = 0
+    self.retries = 0
+    self.successes = 0
+    self.failures = 0
+    self.partials = 0
+    self.backtracks = 0
+    self.time = 0.0
+    self.self_time = 0.0
+
+  @property
+  def name(self):
+    name = self.grammar.grammar_name
+    if name.startswith('<'):
+      # Anonymous grammar, describe its contents instead
+      return self.grammar.grammar_details(1)
+    return name
+
+  def __repr__(self):
+    return "<GrammarStats {}: calls={} retries={} backtracks={} time={:.6f} self_time={:.6f}>".format(self.name, self.calls, self.retries, self.backtracks, self.time, self.self_time)
+
+class GrammarProfiler(GrammarDebugger):
+  """
+  A :class:`GrammarDebugger` which, instead of logging parse events, collects per-grammar statistics (see :class:`GrammarStats`) about the number of :meth:`~modgrammar.Grammar.grammar_parse` invocations, retries, backtracks and time spent.
+
+  To use it, pass an instance as the *debug* parameter of :meth:`~modgrammar.Grammar.parser`::
+
+    profiler = GrammarProfiler()
+    MyGrammar.parser(debug=profiler).parse_text(text, eof=True)
+    print(profiler.summary())
+
+  Statistics accumulate over all parses done with the profiler until :meth:`reset` is called.  Parsers created without it do not pay any profiling overhead.
+
+  Note that cumulative :attr:`~GrammarStats.time` of a recursive grammar counts nested invocations more than once.
+  """
+
+  def __init__(self, timer=time.perf_counter):
+    GrammarDebugger.__init__(self, None, DEBUG_NONE)
+    self.timer = timer
+    self.reset()
+
+  def reset(self):
+    """
+    Discard all statistics collected so far.
+    """
+    self.stats = {}
+    self.child_times = []
+
+  def debug_wrapper(self, parser_generator, grammar, pos, text):
+    stats = self.stats.get(id(grammar))
+    if stats is None:
+      stats = self.stats[id(grammar)] = GrammarStats(grammar)
+    stats.calls += 1
+    timer = self.timer
+    child_times = self.child_times
+    matched = False
+    t = None
+    while True:
+      child_times.append(0.0)
+      start = timer()
+      try:
+        result = parser_generator.send(t)
+      except StopIteration:
+        raise modgrammar.InternalError("{!r} completed parse loop without returning a failure result".format(grammar))
+      finally:
+        elapsed = timer() - start
+        child_time = child_times.pop()
+        stats.time += elapsed
+        stats.self_time += elapsed - child_time
+        if child_times:
+          child_times[-1] += elapsed
+      offset = result[0]
+      if offset is False:
+        stats.failures += 1
+        if matched:
+          stats.backtracks += 1
+      elif offset is None:
+        stats.partials += 1
+      else:
+        stats.successes += 1
+        matched = True
+      t = yield result
+      if offset is not None:
+        stats.retries += 1
+
+  def results(self, sort='self_time'):
+    """
+    Return a list of :class:`GrammarStats` for all grammars seen so far, ordered descending by the attribute named by *sort*.
+    """
+    return sorted(self.stats.values(), key=lambda s: getattr(s, sort), reverse=True)
+
+  def summary(self, limit=None, sort='self_time', width=60):
+    """
+    Return a table (as a string) summarizing the collected statistics, with the most expensive grammars (according to *sort*, see :meth:`results`) first.  If *limit* is given, only that many grammars are listed.  Grammar descriptions longer than *width* characters are truncated.
+    """
+    lines = ["{:>10} {:>10} {:>10} {:>10} {:>10} {:>10}  {}".format("calls", "retries", "backtracks", "failures", "time", "self time", "grammar")]
+    for s in self.results(sort)[:limit]:
+      name = s.name
+      if width is not None and len(name) > width:
+        name = name[:width - 3] + '...'
+      lines.append("{0.calls:>10} {0.retries:>10} {0.backtracks:>10} {0.failures:>10} {0.time:>10.6f} {0.self_time:>10.6f}  {1}".format(s, name))
+    return "\n".join(lines)
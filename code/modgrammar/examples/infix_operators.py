@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+
+# The same expressions as infix_precedence.py, using OPERATORS() to handle the
+# operator precedence instead of nested grammars.
+
+import sys
+from modgrammar import *
+
+grammar_whitespace_mode = 'optional'
+
+class Number (Grammar):
+    grammar = (OPTIONAL('-'), WORD('0-9'), OPTIONAL('.', WORD('0-9')))
+
+    def value(self):
+        return float(self.string)
+
+class ParenExpr (Grammar):
+    grammar = (L('('), REF('Expr'), L(')'))
+
+    def value(self):
+        return self[1].value()
+
+def evaluate(e):
+    if not isinstance(e, Operators):
+        return e.value()
+    result = evaluate(e[0])
+    for i in range(1, len(e.elements), 2):
+        operator = e[i].string
+        operand = evaluate(e[i + 1])
+        if operator == '+':
+            result += operand
+        elif operator == '-':
+            result -= operand
+        elif operator == '*':
+            result *= operand
+        else:
+            result /= operand
+    return result
+
+class Expr (Grammar):
+    grammar = OPERATORS(ParenExpr | Number, (L('/'), 'left'), (L('*'), 'left'), (L('+') | L('-'), 'left'))
+
+    def value(self):
+        return evaluate(self[0])
+
+if __name__ == '__main__':
+    parser = Expr.parser()
+    result = parser.parse_text(sys.argv[1], eof=True)
+    remainder = parser.remainder()
+    print("Parsed Text: {}".format(result))
+    print("Unparsed Text: {}".format(remainder))
+    print("Value: {}".format(result.value()))
@@ -1,7 +1,7 @@
 # vi:et:ts=2:sw=2
 
 import re
-from modgrammar import Terminal, GrammarClass, OPTIONAL, WORD
+from modgrammar import Terminal, OPTIONAL, WORD, _anongrammar
 from . import util
 from .util import error_result
 
@@ -11,7 +11,7 @@ __all__ = [
 
 def RE(regexp, **kwargs):
   cdict = util.make_classdict(REGrammar, (), kwargs, regexp=regexp)
-  return GrammarClass("<RE>", (REGrammar,), cdict)
+  return _anongrammar("<RE>", REGrammar, cdict)
 
 _recaret_re = re.compile(r"(^|[^[])\^")
 
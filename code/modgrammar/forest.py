@@ -0,0 +1,555 @@
+# vi:et:ts=2:sw=2
+
+import heapq
+import sys
+
+import modgrammar
+from . import util
+
+__doc__ = """
+The :mod:`modgrammar.forest` module contains the :class:`ParseForest` class, which is returned by parsers when ``matchtype='forest'`` is used.
+"""
+
+# Kinds of forest nodes:
+#   LEAF:   match of a grammar which isn't looked into (terminals, etc.).
+#           Packings are the result objects.
+#   OR:     match of an OR grammar.  Packings are the nodes of the matching
+#           alternatives.
+#   SEQ:    match of a sequence (or repetition).  Packings are the PREFIX nodes
+#           for all of its elements (or None for no elements).
+#   PREFIX: match of the first elements of a sequence.  Packings are pairs
+#           (PREFIX node for all but the last element or None, node for the
+#           last element).
+LEAF, OR, SEQ, PREFIX = range(4)
+
+class _Node:
+  __slots__ = ('kind', 'grammar', 'start', 'end', 'packings')
+
+  def __init__(self, kind, grammar, start, end):
+    self.kind = kind
+    self.grammar = grammar
+    self.start = start
+    self.end = end
+    self.packings = []
+
+class _ForestBuilder:
+  # Finds all the matches of each grammar at each position (at most once),
+  # sharing the nodes for the same grammar and span.  Along with the matches,
+  # the error the backtracking parser would have reported for the grammar at
+  # that position is worked out, so failed parses can be reported the same
+  # way.
+  def __init__(self, text, session):
+    self.text = text
+    self.session = session
+    self.memo = {}
+    self.truncated = {}
+    self.preference = _Preference(self, text.string)
+
+  def nodes(self, grammar, pos):
+    # Returns {end: node} for the matches of grammar at pos.
+    return self.match(grammar, pos)[0]
+
+  def match(self, grammar, pos):
+    # Returns ({end: node}, error) for grammar at pos.
+    key = (id(grammar), pos)
+    try:
+      return self.memo[key]
+    except KeyError:
+      pass
+    # Left-recursive grammars can't be parsed anyway; this just makes sure we
+    # don't loop forever if given one.
+    self.memo[key] = ({}, None)
+    if isinstance(grammar, type) and issubclass(grammar, modgrammar.Reference):
+      result = self.match(grammar.resolve(self.session.data), pos)
+    else:
+      parse = getattr(grammar.grammar_parse, '__func__', None)
+      if parse is modgrammar.Grammar.grammar_parse.__func__:
+        result = self._sequence(grammar, pos)
+      elif parse is modgrammar.OR_Operator.grammar_parse.__func__:
+        result = self._or(grammar, pos)
+      elif parse is modgrammar.ExceptionGrammar.grammar_parse.__func__:
+        result = self._except(grammar, pos)
+      elif parse is modgrammar.NotFollowedBy.grammar_parse.__func__:
+        result = self._not_followed_by(grammar, pos)
+      else:
+        result = self._leaves(grammar, pos)
+    self.memo[key] = result
+    return result
+
+  def _leaves(self, grammar, pos):
+    text = self.text
+    results = None
+    error = None
+    if grammar.grammar_match:
+      results = grammar.grammar_match(text, pos)
+    if results is None:
+      results = []
+      for count, obj in grammar.grammar_parse(text, pos, self.session):
+        if count is False:
+          error = obj
+          break
+        if count is None:
+          raise modgrammar.InternalError("Grammar requested more data when at EOF")
+        results.append((count, obj))
+    if error is None:
+      error = grammar.grammar_match_error(pos)[1]
+    nodes = {}
+    for count, obj in results:
+      end = pos + count
+      if end not in nodes:
+        nodes[end] = _Node(LEAF, grammar, pos, end)
+      nodes[end].packings.append(obj)
+    return (nodes, error)
+
+  def _or(self, grammar, pos):
+    nodes = {}
+    error = None
+    for g in grammar.grammar:
+      g_nodes, g_error = self.match(g, pos)
+      error = util.merge_best_error(error, g_error)
+      for end, node in g_nodes.items():
+        if end not in nodes:
+          nodes[end] = _Node(OR, grammar, pos, end)
+        nodes[end].packings.append(node)
+    return (nodes, error)
+
+  def _except(self, grammar, pos):
+    g, exc = grammar.grammar
+    exc_literals = grammar.grammar_exc_literals
+    g_nodes, error = self.match(g, pos)
+    string = self.text.string
+    nodes = {}
+    for end, node in g_nodes.items():
+      if exc_literals is not None:
+        excluded = string[pos:end] in exc_literals.get(end - pos, ())
+      else:
+        # As with the backtracking parser, the exception grammar only gets to
+        # see the text up to the end of the match.
+        builder = self.truncated.get(end)
+        if builder is None:
+          text = modgrammar.Text(string[:end], bol=self.text.bol, eof=True)
+          builder = self.truncated[end] = _ForestBuilder(text, self.session)
+        excluded = end in builder.nodes(exc, pos)
+      if not excluded:
+        nodes[end] = node
+    if error is None or error[0] == pos:
+      error = (pos, {grammar})
+    return (nodes, error)
+
+  def _not_followed_by(self, grammar, pos):
+    nodes = {}
+    if not self.nodes(grammar.grammar[0], pos):
+      node = nodes[pos] = _Node(LEAF, grammar, pos, pos)
+      node.packings.append(grammar(''))
+    return (nodes, (pos, {grammar}))
+
+  def _sequence(self, cls, index):
+    string = self.text.string
+    whitespace_mode = cls.grammar_whitespace_mode
+    whitespace_re = cls.grammar_whitespace
+    whitespace_skip = whitespace_mode in ('optional', 'required')
+    whitespace_reqd = whitespace_mode == 'required'
+    null_ok = cls.grammar_null_subtoken_ok
+    grammar_min = cls.grammar_min
+    grammar_max = cls.grammar_max
+    nodes = {}
+    error = None
+    first_pos = index
+    if whitespace_skip:
+      first_pos = self.text.whitespace_ends(whitespace_re)[index]
+    # Once only repetitions of the same grammar are left, the number of
+    # elements matched so far no longer matters, and the matches can be
+    # merged by position alone.  (This keeps long repetitions from costing an
+    # extra factor of the text length.)
+    merge_from = None
+    if isinstance(cls.grammar, util.RepeatingTuple) and grammar_max == sys.maxsize and not null_ok:
+      merge_from = max(grammar_min, 1)
+    # Positions after matching count elements, with the PREFIX node for them.
+    frontier = {index: None}
+    count = 0
+    while frontier:
+      if count == merge_from:
+        break
+      if count >= grammar_min:
+        for end, prefix in frontier.items():
+          if end not in nodes:
+            nodes[end] = _Node(SEQ, cls, index, end)
+          nodes[end].packings.append(prefix)
+      if count >= grammar_max:
+        frontier = {}
+        break
+      g = cls.grammar[count]
+      next_frontier = {}
+      for pos, prefix in frontier.items():
+        start, ws_error = self._skip_whitespace(pos, count, whitespace_skip, whitespace_reqd, whitespace_re)
+        if ws_error is not None:
+          error = util.merge_best_error(error, ws_error)
+          continue
+        g_nodes, g_error = self.match(g, start)
+        error = util.merge_best_error(error, g_error)
+        for end, node in g_nodes.items():
+          if end == start and not null_ok and self._empty_first(g, start):
+            continue
+          if end not in next_frontier:
+            next_frontier[end] = _Node(PREFIX, cls, index, end)
+          next_frontier[end].packings.append((prefix, node))
+      frontier = next_frontier
+      count += 1
+    if frontier:
+      # Merged repetitions.  Every element is at least one character long, so
+      # going through the positions in order, all the ways of getting to a
+      # position are known by the time it is taken off the heap.
+      g = cls.grammar[count]
+      heap = list(frontier)
+      heapq.heapify(heap)
+      while heap:
+        pos = heapq.heappop(heap)
+        prefix = frontier[pos]
+        if pos not in nodes:
+          nodes[pos] = _Node(SEQ, cls, index, pos)
+        nodes[pos].packings.append(prefix)
+        start, ws_error = self._skip_whitespace(pos, count, whitespace_skip, whitespace_reqd, whitespace_re)
+        if ws_error is not None:
+          error = util.merge_best_error(error, ws_error)
+          continue
+        g_nodes, g_error = self.match(g, start)
+        error = util.merge_best_error(error, g_error)
+        for end, node in g_nodes.items():
+          if end == start:
+            continue
+          if end not in frontier:
+            frontier[end] = _Node(PREFIX, cls, index, end)
+            heapq.heappush(heap, end)
+          frontier[end].packings.append((prefix, node))
+    if cls.grammar_error_override:
+      error = (index, {cls})
+    elif len(cls.grammar) == 1 and error is not None and error[0] == first_pos and cls.grammar_desc != cls.grammar_name:
+      error = (index, {cls})
+    return (nodes, error)
+
+  def _empty_first(self, grammar, pos):
+    # When empty sub-matches aren't allowed, the backtracking parser only
+    # skips the ones before the first non-empty match of the element; the
+    # ones it backtracks into later are used like any other match.
+    return self.preference.order(grammar, pos)[0] == pos
+
+  def _skip_whitespace(self, pos, count, whitespace_skip, whitespace_reqd, whitespace_re):
+    # Returns (position of the next element, error).
+    if not whitespace_skip:
+      return (pos, None)
+    start = self.text.whitespace_ends(whitespace_re)[pos]
+    if whitespace_reqd and count and start == pos:
+      return (pos, (pos, {modgrammar.WHITESPACE}))
+    return (start, None)
+
+def _trees(node, string):
+  # Yields new (raw) result objects for every tree below node.
+  kind = node.kind
+  if kind == LEAF:
+    yield from node.packings
+  elif kind == OR:
+    for child in node.packings:
+      yield from _trees(child, string)
+  elif kind == SEQ:
+    for prefix in node.packings:
+      if prefix is None:
+        yield node.grammar(string, node.start, node.end, [])
+      else:
+        for objs in _elements(prefix, string):
+          yield node.grammar(string, node.start, node.end, objs)
+
+def _elements(prefix, string):
+  # Yields the lists of (new) result objects for every way of matching the
+  # elements of a PREFIX node.  This goes from the last element backwards
+  # without recursion, as sequences (lists, for example) can be very long.
+  # The elements after the current one are kept as a linked list
+  # (obj, following).
+  stack = [[iter(prefix.packings), None, None, None]]
+  while stack:
+    entry = stack[-1]
+    packings, previous, objs, following = entry
+    if objs is not None:
+      obj = next(objs, None)
+      if obj is not None:
+        if previous is None:
+          elements = [obj]
+          while following is not None:
+            obj, following = following
+            elements.append(obj)
+          yield elements
+        else:
+          stack.append([iter(previous.packings), None, None, (obj, following)])
+        continue
+    packing = next(packings, None)
+    if packing is None:
+      stack.pop()
+    else:
+      entry[1] = packing[0]
+      entry[2] = _trees(packing[1], string)
+
+class _Preference:
+  # Works out which match the backtracking parser would have found first,
+  # without going through the ones it would have backtracked out of.  The
+  # backtracking parser tries the matches of each element in the order the
+  # element's grammar yields them, so this only needs the order of the ends of
+  # each grammar at each position, which is worked out only where there is
+  # more than one way to go.
+  def __init__(self, builder, string):
+    self.builder = builder
+    self.string = string
+    self.orders = {}
+    self.graphs = {}
+
+  def order(self, grammar, pos):
+    # Returns the ends of the matches of grammar at pos, in the order the
+    # backtracking parser would have found them.
+    key = (id(grammar), pos)
+    result = self.orders.get(key)
+    if result is not None:
+      return result
+    nodes = self.builder.nodes(grammar, pos)
+    result = []
+    if nodes:
+      node = next(iter(nodes.values()))
+      if node.grammar is not grammar:
+        # A reference or EXCEPT() grammar: the matches of the grammar it
+        # stands for, in the same order.
+        result = [end for end in self.order(node.grammar, pos) if end in nodes]
+      elif node.kind == LEAF:
+        result = list(nodes)
+      elif node.kind == OR:
+        seen = set()
+        for g in grammar.grammar:
+          for end in self.order(g, pos):
+            if end not in seen:
+              seen.add(end)
+              result.append(end)
+      else:
+        result = self._sequence_order(grammar, nodes)
+    self.orders[key] = result
+    return result
+
+  def _graph(self, grammar, nodes):
+    # Returns (successors, ends) for the matches of a sequence: the PREFIX
+    # nodes following each prefix (None being the empty one), as (element
+    # node, PREFIX node) pairs, and the end of the match each prefix completes
+    # (if any).
+    key = id(next(iter(nodes.values())))
+    graph = self.graphs.get(key)
+    if graph is not None:
+      return graph
+    successors = {}
+    ends = {}
+    seen = set()
+    stack = []
+    for end, node in nodes.items():
+      for prefix in node.packings:
+        ends[id(prefix)] = end
+        stack.append(prefix)
+    while stack:
+      prefix = stack.pop()
+      if prefix is None or id(prefix) in seen:
+        continue
+      seen.add(id(prefix))
+      for previous, child in prefix.packings:
+        successors.setdefault(id(previous), []).append((child, prefix))
+        stack.append(previous)
+    graph = self.graphs[key] = (successors, ends)
+    return graph
+
+  def _successors(self, successors, prefix):
+    result = successors.get(id(prefix), ())
+    if len(result) > 1:
+      child = result[0][0]
+      rank = dict((end, i) for i, end in enumerate(self.order(child.grammar, child.start)))
+      result = sorted(result, key=lambda s: rank[s[0].end])
+    return result
+
+  def _sequence_order(self, grammar, nodes):
+    successors, ends = self._graph(grammar, nodes)
+    greedy = grammar.grammar_greedy
+    result = []
+    found = set()
+    seen = set()
+    stack = [(None, None)]
+    while stack:
+      prefix, following = stack[-1]
+      if following is None:
+        if id(prefix) in seen:
+          stack.pop()
+          continue
+        seen.add(id(prefix))
+        if not greedy and id(prefix) in ends and ends[id(prefix)] not in found:
+          found.add(ends[id(prefix)])
+          result.append(ends[id(prefix)])
+        following = iter(self._successors(successors, prefix))
+        stack[-1] = (prefix, following)
+      step = next(following, None)
+      if step is not None:
+        stack.append((step[1], None))
+        continue
+      stack.pop()
+      if greedy and id(prefix) in ends and ends[id(prefix)] not in found:
+        found.add(ends[id(prefix)])
+        result.append(ends[id(prefix)])
+    return result
+
+  def first(self, node):
+    # Returns a new (raw) result object for the first tree below node the
+    # backtracking parser would have found.
+    while node.kind == OR:
+      node = node.packings[0]
+    if node.kind == LEAF:
+      return node.packings[0]
+    nodes = self.builder.nodes(node.grammar, node.start)
+    successors, ends = self._graph(node.grammar, nodes)
+    # The prefixes from which this match can be completed.
+    useful = set()
+    stack = list(node.packings)
+    while stack:
+      prefix = stack.pop()
+      if prefix is None or id(prefix) in useful:
+        continue
+      useful.add(id(prefix))
+      stack.extend(previous for previous, child in prefix.packings)
+    completes = set(id(prefix) for prefix in node.packings)
+    greedy = node.grammar.grammar_greedy
+    children = []
+    prefix = None
+    while True:
+      if not greedy and id(prefix) in completes:
+        break
+      for child, following in self._successors(successors, prefix):
+        if id(following) in useful:
+          break
+      else:
+        break
+      children.append(child)
+      prefix = following
+    return node.grammar(self.string, node.start, node.end, [self.first(child) for child in children])
+
+class ParseForest:
+  """
+  A shared packed parse forest: all the ways in which a grammar matched the text, where the parts which several matches have in common are stored only once.  This way even highly ambiguous texts, which have an exponential number of parse trees, can be represented (and checked for ambiguity) in polynomial time and space.
+
+  :class:`ParseForest` objects are returned by :meth:`GrammarParser.parse_text` (and the other parse methods) when called with ``matchtype='forest'``.  They have the following useful attributes:
+
+  .. attribute:: lengths
+
+     The lengths of the text matched by the grammar, longest first.
+
+  Iterating over the forest yields the result for every parse tree, the same as a parser with ``matchtype='all'`` would have returned them (but only as they are needed).
+
+  .. note::
+     Grammars with custom :meth:`~Grammar.grammar_parse` methods (terminals, :func:`OPERATORS`, etc.) are not looked into: each of their matches is a single node in the forest.  :const:`CUT` has no effect on the forest.
+  """
+
+  def __init__(self, grammar, string, start, roots, result, builder=None):
+    self.grammar = grammar
+    self.string = string
+    self.start = start
+    self.roots = roots
+    self.lengths = sorted((end - start for end in roots), reverse=True)
+    self._result = result
+    self._preference = builder.preference if builder else None
+
+  def _backtracking_lengths(self):
+    # The lengths in the order the backtracking parser would have found them.
+    return [end - self.start for end in self._preference.order(self.grammar, self.start)]
+
+  def _backtracking_tree(self, length):
+    # The result the backtracking parser would have found first for length.
+    return self._result(self._preference.first(self.roots[self.start + length]))
+
+  def _roots(self, length):
+    if length is None:
+      return [self.roots[self.start + l] for l in self.lengths]
+    node = self.roots.get(self.start + length)
+    return [node] if node is not None else []
+
+  def trees(self, length=None):
+    """
+    *(generator method)*
+
+    Yield the results of all the parse trees for the matches of the given *length* (or of all the matches, longest first, if *length* is :const:`None`).  The trees are built as they are requested.
+    """
+    for root in self._roots(length):
+      for obj in _trees(root, self.string):
+        yield self._result(obj)
+
+  def __iter__(self):
+    return self.trees()
+
+  def count(self, length=None):
+    """
+    Return the number of parse trees for the matches of the given *length* (or of all the matches if *length* is :const:`None`), without building them.
+    """
+    counts = {id(None): 1}
+    total = 0
+    for root in self._roots(length):
+      stack = [root]
+      while stack:
+        node = stack[-1]
+        if id(node) in counts:
+          stack.pop()
+          continue
+        if node.kind == PREFIX:
+          children = [c for packing in node.packings for c in packing]
+        elif node.kind == LEAF:
+          children = []
+        else:
+          children = node.packings
+        missing = [c for c in children if id(c) not in counts]
+        if missing:
+          stack.extend(missing)
+          continue
+        if node.kind == LEAF:
+          n = len(node.packings)
+        elif node.kind == PREFIX:
+          n = sum(counts[id(previous)] * counts[id(child)] for previous, child in node.packings)
+        else:
+          n = sum(counts[id(p)] for p in node.packings)
+        counts[id(node)] = n
+        stack.pop()
+      total += counts[id(root)]
+    return total
+
+  def is_ambiguous(self, length=None):
+    """
+    Return whether the text can be matched in more than one way (with the given *length*, or with any length if *length* is :const:`None`).
+    """
+    return self.count(length) > 1
+
+  def ambiguities(self, length=None):
+    """
+    Return the places where the matches of the given *length* (or all the matches if *length* is :const:`None`) can be parsed in more than one way, as a list of tuples *(grammar, start, end, alternatives)*: the part of the text between the offsets *start* and *end* (counted from the start of the match) can be matched by *grammar* in *alternatives* ways.  (For sequences, this may also be reported for the first elements of the sequence only, with *grammar* being the sequence.)  The list is sorted by position.
+    """
+    result = []
+    seen = set()
+    stack = list(self._roots(length))
+    while stack:
+      node = stack.pop()
+      if node is None or id(node) in seen:
+        continue
+      seen.add(id(node))
+      if len(node.packings) > 1:
+        result.append((node.grammar, node.start - self.start, node.end - self.start, len(node.packings)))
+      if node.kind == OR or node.kind == SEQ:
+        stack.extend(node.packings)
+      elif node.kind == PREFIX:
+        for previous, child in node.packings:
+          stack.append(previous)
+          stack.append(child)
+    result.sort(key=lambda a: (a[1], -a[2]))
+    return result
+
+def parse_forest(parser, pos, session):
+  """
+  Match the parser's grammar at *pos* in its (complete) text buffer.  Returns a tuple *(forest, error)*, where *forest* is the :class:`ParseForest` for the matches (or :const:`None` if there are none), and *error* is the *(position, expected grammars)* error the grammar reported.
+  """
+  builder = _ForestBuilder(parser.text, session)
+  roots, error = builder.match(parser.grammar, pos)
+  if not roots:
+    return (None, error)
+  forest = ParseForest(parser.grammar, parser.text.string, pos, roots, lambda obj: parser._result(obj, session), builder)
+  return (forest, error)
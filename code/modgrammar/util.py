@@ -23,6 +23,24 @@ def update_best_error(current_best, err):
     current_best[1].update(err[1])
   return current_best
 
+def update_furthest_error(current_best, err):
+  # Cheaper version of update_best_error used with error_tracking='deferred':
+  # only keeps the furthest error, without merging the expected sets.
+  if not current_best or err[0] > current_best[0]:
+    return err
+  return current_best
+
+def merge_best_error(best, err):
+  # Like update_best_error, but never modifies the sets in place, for errors
+  # which are shared between several grammars (see modgrammar.forest).
+  if err is None:
+    return best
+  if best is None or err[0] > best[0]:
+    return err
+  if err[0] == best[0] and not err[1] <= best[1]:
+    return (best[0], best[1] | err[1])
+  return best
+
 def best_error_result(err_list):
   if len(err_list) == 1:
     # This will be by far the most common case, so check it first.
@@ -42,7 +60,7 @@ def regularize(grammar):
   if hasattr(grammar, 'grammar_parse'):
     return (grammar,)
   if isinstance(grammar, str):
-    return (modgrammar.LITERAL(grammar),)
+    return (modgrammar.LITERAL(grammar, intern=True),)
   if grammar is None:
     return (modgrammar.EMPTY,)
   try:
@@ -53,7 +71,7 @@ def regularize(grammar):
   except TypeError:
     raise modgrammar.GrammarDefError("object of type '%s' cannot be converted to Grammar" % (type(grammar).__name__,))
 
-_anongrammar_attrs = ('grammar_collapse', 'grammar_desc', 'grammar_name', 'grammar_whitespace', 'grammar_whitespace_mode', 'grammar_tags')
+_anongrammar_attrs = ('grammar_collapse', 'grammar_desc', 'grammar_name', 'grammar_whitespace', 'grammar_whitespace_mode', 'grammar_tags', 'grammar_reduce')
 
 def is_simple_anongrammar(cls):
   if not issubclass(cls, AnonGrammar):
@@ -87,6 +105,8 @@ classdict_map = dict(
     noteworthy='grammar_noteworthy',
     terminal='grammar_terminal',
     error_override='grammar_error_override',
+    compact='grammar_compact',
+    reduce='grammar_reduce',
 )
 
 def make_classdict(base, grammar, kwargs, **defaults):
@@ -106,6 +126,58 @@ def make_classdict(base, grammar, kwargs, **defaults):
     cdict["grammar_whitespace_mode"] = whitespace_mode
   return cdict
 
+class IdentityKey:
+  # Hashes and compares by identity (keeping the object alive meanwhile).
+  __slots__ = ('obj',)
+
+  def __init__(self, obj):
+    self.obj = obj
+
+  def __hash__(self):
+    return id(self.obj)
+
+  def __eq__(self, other):
+    return isinstance(other, IdentityKey) and self.obj is other.obj
+
+def intern_key(value):
+  # Grammars are compared by identity, other values by type and value.  Raises
+  # TypeError for values which are not hashable.
+  if isinstance(value, modgrammar.GrammarClass):
+    return IdentityKey(value)
+  if type(value) is tuple:
+    return (tuple, tuple(intern_key(v) for v in value))
+  if type(value) is dict:
+    return (dict, tuple((k, intern_key(v)) for k, v in sorted(value.items())))
+  hash(value)
+  return (type(value), value)
+
+class WhitespaceEnds (dict):
+  # Ends of the whitespace matching a regex at positions of a text (or the
+  # positions themselves, if there is none), matched only at the positions
+  # which are asked for.
+  def __init__(self, string, regex):
+    self.string = string
+    self.regex = regex
+
+  def __missing__(self, pos):
+    m = self.regex.match(self.string, pos)
+    end = self[pos] = m.end() if m else pos
+    return end
+
+  def extend_to(self, string):
+    # Matches which went up to the end of the text may go further now.
+    end = len(self.string)
+    self.string = string
+    for pos in [pos for pos, ws_end in self.items() if ws_end == end]:
+      del self[pos]
+
+  def skip(self, count, string):
+    # Returns the ends for the text with the first count characters removed
+    # (string), keeping the ones already known for the rest of it.
+    ends = WhitespaceEnds(string, self.regex)
+    ends.update((pos - count, end - count) for pos, end in self.items() if pos >= count)
+    return ends
+
 def calc_line_col(string, count, line=0, col=0, tabs=1):
   pos = 0
   while True:
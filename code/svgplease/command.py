@@ -1,12 +1,16 @@
 from xml.etree import ElementTree
 import collections
+import concurrent.futures
 import copy
+import hashlib
 import io
 import itertools
 import math
 import modgrammar
 import os
 import re
+import stat
+from . import compact, manifest
 
 """Global DPI (dots per inch) setting."""
 DPI = 120
@@ -45,6 +49,98 @@ def explode_style_recursively(element):
     for c in element:
         explode_style_recursively(c)
 
+def load_svg(filename):
+    """Reads and parses given svg file, returns its ElementTree with exploded styles."""
+    t = ElementTree.parse(filename)
+    explode_style_recursively(t.getroot())
+    return t
+
+def load_compact_svg(filename):
+    """Reads and parses given svg file, returns its compact.CompactDocument with exploded styles."""
+    t = compact.parse(filename)
+    explode_style_recursively(t.getroot())
+    return t
+
+def serialize_svg(tree):
+    """Returns the contents of svg file with given ElementTree."""
+    data = io.BytesIO()
+    tree.write(data, encoding="utf-8", xml_declaration=True)
+    return data.getvalue()
+
+def write_atomically(filename, data):
+    """Writes data to the file atomically.
+
+    The data is written to a temporary file in the same directory, which then replaces
+    filename, so filename never contains partially written data. Symbolic links are
+    followed and an existing file keeps its permissions.
+
+    The exception are files with several hard links, as replacing them would break the
+    links: once the temporary file is completely written, the data is also written over
+    the linked file, which is therefore not replaced atomically. Errors while writing
+    the temporary file (a full disk, for example) still leave the file untouched, and if
+    overwriting the file fails, the temporary file is kept."""
+    filename = os.path.realpath(filename)
+    try:
+        existing = os.stat(filename)
+    except OSError:
+        existing = None
+    directory, basename = os.path.split(filename)
+    temporary = os.path.join(directory, ".{0}.{1}.tmp".format(basename, os.getpid()))
+    try:
+        with open(temporary, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if existing is not None and existing.st_nlink > 1:
+            try:
+                with open(filename, "wb") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except BaseException:
+                # filename may now be partially written, so the complete data is kept.
+                temporary = None
+                raise
+            return
+        if existing is not None:
+            os.chmod(temporary, stat.S_IMODE(existing.st_mode))
+        os.replace(temporary, filename)
+    finally:
+        if temporary is not None and os.path.exists(temporary):
+            os.remove(temporary)
+
+def save_svg(tree, filename):
+    """Writes given ElementTree to the file atomically."""
+    write_atomically(filename, serialize_svg(tree))
+
+def save_svg_if_changed(tree, filename, file_manifest):
+    """Writes given ElementTree to the file, unless the manifest says it already contains it.
+
+    Returns sha256 hash of the document."""
+    data = serialize_svg(tree)
+    digest = hashlib.sha256(data).hexdigest()
+    if not file_manifest.has_digest(filename, digest):
+        write_atomically(filename, data)
+    return digest
+
+def map_jobs(function, arguments, jobs):
+    """Returns list of function(*args) for all args in arguments, computed by up to jobs threads.
+
+    At most 2 * jobs calls are started ahead of the oldest unfinished one, which bounds memory
+    used by calls in progress."""
+    jobs = min(jobs, len(arguments))
+    if jobs <= 1:
+        return [function(*args) for args in arguments]
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        pending = collections.deque()
+        for args in arguments:
+            if len(pending) >= 2 * jobs:
+                results.append(pending.popleft().result())
+            pending.append(executor.submit(function, *args))
+        results.extend(future.result() for future in pending)
+    return results
+
 class CommandBase(object):
     """Base class for all commands."""
 
@@ -70,44 +166,99 @@ class OpenSaveBase(CommandBase):
 class Open(OpenSaveBase):
     """Command for opening files"""
     def execute(self, execution_context):
-        for filename in self.filenames:
-            t = ElementTree.parse(filename)
-            execution_context.svg_roots.append(SVGRoot(t, filename))
-            root = t.getroot()
-            explode_style_recursively(root)
-            execution_context.selected_nodes.append(root)
+        load_tree = load_compact_svg if execution_context.compact else load_svg
+        def load(filename):
+            # The size and time are taken before reading, so that a file changed while it
+            # was being read isn't recorded as the source of what was parsed.
+            key = manifest.file_key(filename)
+            tree = load_tree(filename)
+            if manifest.file_key(filename) != key:
+                key = None
+            return tree, key
+        jobs = min(execution_context.jobs, len(self.filenames))
+        if jobs > 1:
+            # Files are read and parsed by a pool of threads, but added in the original order.
+            with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+                self.add_trees(execution_context, executor.map(load, self.filenames))
+        else:
+            self.add_trees(execution_context, map(load, self.filenames))
+
+    def add_trees(self, execution_context, loaded):
+        for filename, (t, key) in zip(self.filenames, loaded):
+            svg_root = SVGRoot(t, filename)
+            svg_root.dirty = False
+            # Without a key the file was removed or changed while it was read.
+            svg_root.source = None if key is None else (os.path.abspath(filename),) + key
+            execution_context.svg_roots.append(svg_root)
+            execution_context.selected_nodes.append(t.getroot())
+            execution_context.node_roots[t.getroot()] = svg_root
 
 class Save(OpenSaveBase):
     """Command for saving files"""
     def execute(self, execution_context):
         used_filenames = set()
-        def filename_generator(filename):
-            yield filename
+        if not execution_context.overwrite:
+            for directory in set(os.path.dirname(filename) for filename in self.filenames):
+                try:
+                    names = os.listdir(directory or os.curdir)
+                except OSError:
+                    continue
+                used_filenames.update(os.path.join(directory, name) for name in names)
+        # Maps filename to [base, ending, index] such that base + str(i) + ending for all i >= index
+        # are its numbered variants that might be unused.
+        numbering = {}
+        def generate_unique_filename(filename):
+            if filename not in used_filenames:
+                return filename
             if filename[-4:] != ".svg":
                 filename += ".svg"
-                yield filename
-            if not re.search("[0-9]+", os.path.basename(filename)):
-                base = filename[:-4]
-                ending = filename[-4:]
-                index = 0
-            else:
-                match = list(re.finditer("[0-9]+", filename))[-1]
-                base = filename[:match.start()]
-                ending = filename[match.end():]
-                index = int(match.group())
-            while True:
+                if filename not in used_filenames:
+                    return filename
+            if filename not in numbering:
+                if not re.search("[0-9]+", os.path.basename(filename)):
+                    numbering[filename] = [filename[:-4], filename[-4:], 1]
+                else:
+                    match = list(re.finditer("[0-9]+", filename))[-1]
+                    numbering[filename] = [filename[:match.start()], filename[match.end():], int(match.group()) + 1]
+            variants = numbering[filename]
+            base, ending, index = variants
+            while base + str(index) + ending in used_filenames:
                 index += 1
-                yield base + str(index) + ending
-        def generate_unique_filename(filename):
-            for name in filename_generator(filename):
-                if name not in used_filenames:
-                    return name
+            variants[2] = index + 1
+            return base + str(index) + ending
+        writes = []
         for svg_root, filename in zip(
                 execution_context.svg_roots,
                 itertools.chain(self.filenames, itertools.cycle(self.filenames[-1:]))):
             filename = generate_unique_filename(filename)
             used_filenames.add(filename)
-            svg_root.root_element.write(filename, encoding="utf-8", xml_declaration=True)
+            writes.append((svg_root, filename))
+        if execution_context.skip_unchanged:
+            self.save_changed(writes, execution_context.jobs)
+        else:
+            map_jobs(save_svg, [(svg_root.root_element, filename) for svg_root, filename in writes],
+                     execution_context.jobs)
+
+    def save_changed(self, writes, jobs):
+        """Saves documents to files, skipping files a manifest knows to be up to date.
+
+        Unmodified documents are not even serialized if they were saved from the same source before."""
+        manifests = {}
+        for svg_root, filename in writes:
+            directory = os.path.dirname(filename)
+            if directory not in manifests:
+                manifests[directory] = manifest.Manifest(directory)
+        def file_manifest(filename):
+            return manifests[os.path.dirname(filename)]
+        writes = [(svg_root, filename) for svg_root, filename in writes
+                  if svg_root.dirty or not file_manifest(filename).has_source(filename, svg_root.source)]
+        digests = map_jobs(save_svg_if_changed,
+                           [(svg_root.root_element, filename, file_manifest(filename)) for svg_root, filename in writes],
+                           jobs)
+        for (svg_root, filename), digest in zip(writes, digests):
+            file_manifest(filename).record(filename, digest, None if svg_root.dirty else svg_root.source)
+        for directory_manifest in manifests.values():
+            directory_manifest.write()
 
 class ExecutionContext(object):
     """Class for storing execution context for the commands.
@@ -115,26 +266,121 @@ class ExecutionContext(object):
     It has the following fields:
         - svg_roots - stores root elements for all opened/generated svg files
         - selected_nodes - stores subset of nodes of all opened/generated svg files
+        - node_roots - maps selected nodes to the svg roots containing them (nodes missing
+          here are looked up in the documents when needed)
+        - before_execute - callbacks called as callback(command, context) before each command
+        - after_execute - callbacks called as callback(command, context) after each command
+        - jobs - maximum number of files read or written concurrently
+        - overwrite - whether Save may overwrite existing files
+        - skip_unchanged - whether Save leaves files which already contain the saved documents untouched
+          (this is tracked in manifest files next to them)
+        - compact - whether Open loads documents as compact.CompactDocument instead of ElementTree
     """
 
     def __init__(self):
         self.svg_roots = []
         self.selected_nodes = []
+        self.node_roots = {}
+        self.before_execute = []
+        self.after_execute = []
+        self.jobs = 1
+        self.overwrite = True
+        self.skip_unchanged = False
+        self.compact = False
 
     def copy(self):
         context = ExecutionContext()
         context.svg_roots = list(self.svg_roots)
         context.selected_nodes = list(self.selected_nodes)
+        context.node_roots = dict(self.node_roots)
+        context.before_execute = list(self.before_execute)
+        context.after_execute = list(self.after_execute)
+        context.jobs = self.jobs
+        context.overwrite = self.overwrite
+        context.skip_unchanged = self.skip_unchanged
+        context.compact = self.compact
         return context
 
+    def execute(self, command):
+        """Executes given command in this context, calling the before_execute and after_execute hooks."""
+        for callback in self.before_execute:
+            callback(command, self)
+        command.execute(self)
+        for callback in self.after_execute:
+            callback(command, self)
+
     def select_roots(self):
         self.selected_nodes = [r.root_element.getroot() for r in self.svg_roots]
+        self.node_roots = dict(zip(self.selected_nodes, self.svg_roots))
+
+    def root_of(self, node):
+        """Returns the svg root containing given selected node, or None."""
+        svg_root = self.node_roots.get(node)
+        if svg_root is None:
+            # The selection was set without recording its roots, look for the node.
+            for r in self.svg_roots:
+                if any(element == node for element in r.root_element.iter()):
+                    svg_root = self.node_roots[node] = r
+                    break
+        return svg_root
+
+    def mark_dirty(self, elements):
+        """Records that subtrees of given elements were modified, in the svg roots containing them.
+
+        The elements must be selected nodes or their descendants; only subtrees of the
+        selected nodes are searched for them."""
+        elements = set(elements)
+        for node in self.selected_nodes:
+            if node in elements:
+                elements.discard(node)
+                svg_root = self.root_of(node)
+                if svg_root is not None:
+                    svg_root.mark_dirty(node)
+        for node in self.selected_nodes:
+            if not elements:
+                break
+            for element in node.iter():
+                if element in elements:
+                    elements.discard(element)
+                    svg_root = self.root_of(node)
+                    if svg_root is not None:
+                        svg_root.mark_dirty(element)
+
+    def dirty_roots(self):
+        """Returns svg roots which were modified since they were opened (or which were generated)."""
+        return [r for r in self.svg_roots if r.dirty]
 
 class SVGRoot(object):
-    """Class representing the root node of SVG file."""
+    """Class representing the root node of SVG file.
+
+    It has the following fields:
+        - root_element - the ElementTree (or compact.CompactDocument) of the document
+        - filename - name of the file the document was opened from (or a suggested name)
+        - dirty - whether the document may differ from the source it was opened from
+        - dirty_elements - elements whose subtrees were modified (if the document is dirty
+          and this is empty, any part of it may have been modified)
+        - source - (absolute path, size, modification time) of the file the document was
+          opened from, or None
+    """
     def __init__(self, root_element, filename="image.svg"):
         self.root_element = root_element
         self.filename = filename
+        self.dirty = True
+        self.dirty_elements = set()
+        self.source = None
+
+    def mark_dirty(self, element=None):
+        """Records that subtree of element (the whole document by default) was modified."""
+        self.dirty = True
+        self.dirty_elements.add(self.root_element.getroot() if element is None else element)
+
+    def is_subtree_dirty(self, element):
+        """Returns whether anything in subtree of element may have been modified."""
+        if not self.dirty:
+            return False
+        if not self.dirty_elements:
+            return True
+        return any(e in self.dirty_elements for e in element.iter())
 
 class Color(object):
     """Class representing colors."""
@@ -190,16 +436,18 @@ class ChangeColor(CommandBase):
         from . import parse
         def parse_color(color_string):
             try:
-                return parse.Color.parser().parse_text(parse.join_tokens(color_string.split()),
-                                                       eof=True, matchtype="complete").color
+                return parse.COLOR_PARSERS.parse_text(
+                        parse.join_tokens(color_string.split()), matchtype="complete")
             except parse.ParseError:
                 return None
 
+        changed = []
         def change_color(node, attribute):
             if attribute in node.keys() and (
                     self.from_color is None
                     or parse_color(node.get(attribute)) == self.from_color):
                 node.set(attribute, str(self.to_color))
+                changed.append(node)
                 opacity_attribute = attribute + "-opacity"
                 if self.to_color.alpha is not None and (self.from_color is None
                         or self.from_color.alpha is None
@@ -214,6 +462,7 @@ class ChangeColor(CommandBase):
                     change_color(subnode, "fill")
                 if self.fill_stroke.stroke:
                     change_color(subnode, "stroke")
+        execution_context.mark_dirty(changed)
 
 class Length(object):
     """Class representing length."""
@@ -264,6 +513,7 @@ class Move(object):
                     self.vertically.in_pixels(),
                     (" " + transform if transform else ""))
             selection.set("transform", new_transform)
+        execution_context.mark_dirty(execution_context.selected_nodes)
 
 
 class Select(object):
@@ -276,9 +526,15 @@ class Select(object):
 
     def execute(self, execution_context):
         new_selection = []
+        node_roots = {}
         for selection in execution_context.selected_nodes:
-            new_selection.extend(selection.findall(".//*[@id='{0}']".format(self.id)))
+            found = selection.findall(".//*[@id='{0}']".format(self.id))
+            new_selection.extend(found)
+            svg_root = execution_context.node_roots.get(selection)
+            if svg_root is not None:
+                node_roots.update((node, svg_root) for node in found)
         execution_context.selected_nodes = new_selection
+        execution_context.node_roots = node_roots
 
 class Scale(object):
     """Class representing scale command."""
@@ -297,6 +553,7 @@ class Scale(object):
                     self.vertically,
                     (" " + transform if transform else ""))
             selection.set("transform", new_transform)
+        execution_context.mark_dirty(execution_context.selected_nodes)
 
 class Remove(object):
     """Class representing remove command."""
@@ -310,16 +567,19 @@ class Remove(object):
             prev = None
             for p in svg_root.root_element.iter():
                 for c in p:
-                    parent_map[c] = (p, prev)
+                    parent_map[c] = (p, prev, svg_root)
                     prev = c
                 prev = p
         for selection in execution_context.selected_nodes:
-            (parent, prev) = parent_map.get(selection, None)
+            (parent, prev, svg_root) = parent_map.get(selection, None)
             if parent is not None:
                 if prev is not None:
                     prev.tail = selection.tail
+                    svg_root.mark_dirty(prev)
                 parent.remove(selection)
+                svg_root.mark_dirty(parent)
         execution_context.selected_nodes = []
+        execution_context.node_roots = {}
 
 class ChangeLike(object):
     """Class representing "change like from one_file.svg to another_file.svg" command."""
@@ -563,6 +823,8 @@ class ChangeLike(object):
 
         for command in commands:
             command.execute(execution_context)
+        for svg_root in execution_context.svg_roots:
+            svg_root.mark_dirty()
 
 def is_text_node(node):
     """Check if given node is a text node."""
@@ -583,10 +845,13 @@ class ChangeText(object):
     __repr__ = __str__
 
     def execute(self, execution_context):
+        changed = []
         for node in execution_context.selected_nodes:
             for n in node.iter():
                 if is_text_node(n) and (len(n) == 0 or n.text is not None):
                     n.text = self.text
+                    changed.append(n)
+        execution_context.mark_dirty(changed)
 
 class Page(object):
     """Class representing page dimensions."""
@@ -641,12 +906,12 @@ class Tile(object):
             sw, sh = root.get("width"), root.get("height")
             if sw is not None:
                 try:
-                    w = parse.Length.parser().parse_text(sw, eof=True, matchtype="complete").length
+                    w = parse.LENGTH_PARSERS.parse_text(sw, matchtype="complete")
                 except modgrammar.ParseError as e:
                     pass
             if sh is not None:
                 try:
-                    h = parse.Length.parser().parse_text(sh, eof=True, matchtype="complete").length
+                    h = parse.LENGTH_PARSERS.parse_text(sh, matchtype="complete")
                 except modgrammar.ParseError as e:
                     pass
             return w, h
@@ -700,10 +965,13 @@ class ChangeFontFamily(object):
         return self.font == other.font
 
     def execute(self, execution_context):
+        changed = []
         for node in execution_context.selected_nodes:
             for n in node.iter():
                 if is_text_node(n):
                     n.set("font-family", self.font)
+                    changed.append(n)
+        execution_context.mark_dirty(changed)
 
 class ChangeFontSize(object):
     """Class representing 'change font size' command."""
@@ -715,7 +983,10 @@ class ChangeFontSize(object):
         return self.size == other.size
 
     def execute(self, execution_context):
+        changed = []
         for node in execution_context.selected_nodes:
             for n in node.iter():
                 if is_text_node(n):
                     n.set("font-size", self.size.short_string())
+                    changed.append(n)
+        execution_context.mark_dirty(changed)
@@ -0,0 +1,582 @@
+"""Compact, array-backed document model for huge svg files.
+
+ElementTree keeps every node as an object with its own attribute dict, which takes hundreds
+of bytes per node. CompactDocument instead stores the tree in parallel arrays indexed by
+node number (parent, first child, next sibling and tag) and keeps attributes, texts and tails
+in per-name columns of ids of interned strings. The names of attributes of each node are
+kept as an interned tuple (its layout), which documents have only a few of. Elements are represented by lightweight
+CompactElement handles created on demand, which provide the subset of the ElementTree
+interface used by the commands.
+
+Differences from ElementTree:
+    - handles of the same node compare equal, but are not the same object
+    - inserting an element which belongs to another document copies it, inserting an element
+      of the same document moves it
+    - copy.deepcopy of an element returns an ordinary ElementTree element
+
+Running this module as a script compares memory use and traversal speed of both models:
+    python3 -m svgplease.compact [--nodes N] [FILE...]
+"""
+from xml.etree import ElementPath, ElementTree
+import array
+import collections.abc
+import re
+
+"""Index standing for a missing node."""
+NONE = -1
+
+"""Size of blocks in which files are read."""
+BLOCK_SIZE = 64 * 1024
+
+# Paths like ".//*[@id='foo']" and ".//*[@id]", which are answered using the attribute columns.
+_ATTRIBUTE_PATH_RE = re.compile(r"\.//\*\[@([^='\]]+)(?:='([^']*)')?\]\Z")
+
+class InternTable(object):
+    """Interned values (strings or tuples), identified by their indices in the table.
+
+    Id 0 stands for the given empty value. Values are never removed from the table."""
+    def __init__(self, empty=None):
+        self.values = [empty]
+        self.ids = {empty: 0}
+
+    def intern(self, value):
+        """Returns id of the value, adding it to the table if needed."""
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return value_id
+
+    def lookup(self, value):
+        """Returns id of the value, or None if it is not in the table."""
+        return self.ids.get(value)
+
+class CompactDocument(object):
+    """Document stored in parallel arrays, usable in place of ElementTree.ElementTree.
+
+    It has the following fields:
+        - strings - InternTable with tags, attribute values, texts and tails
+        - layouts - InternTable with tuples of attribute names
+        - parent, first_child, next_sibling - arrays of node indices (NONE if missing)
+        - tag, text, tail - arrays of string ids
+        - layout - array of ids of tuples of names of attributes of the nodes, in order
+        - columns - maps attribute name to array of string ids of its values (0 where the
+          attribute is not set); the arrays are only as long as needed
+        - root - index of the root node
+    Nodes removed from the tree keep their slots in the arrays.
+    """
+    def __init__(self):
+        self.strings = InternTable()
+        self.layouts = InternTable(())
+        self.parent = array.array("i")
+        self.first_child = array.array("i")
+        self.next_sibling = array.array("i")
+        self.tag = array.array("i")
+        self.text = array.array("i")
+        self.tail = array.array("i")
+        self.layout = array.array("i")
+        self.columns = {}
+        self.root = NONE
+
+    def __len__(self):
+        """Returns the number of node slots (including removed nodes)."""
+        return len(self.tag)
+
+    def new_node(self, tag, attrib=None):
+        """Adds a detached node and returns its index."""
+        index = len(self.tag)
+        self.parent.append(NONE)
+        self.first_child.append(NONE)
+        self.next_sibling.append(NONE)
+        self.tag.append(self.strings.intern(tag))
+        self.text.append(0)
+        self.tail.append(0)
+        self.layout.append(0)
+        if attrib:
+            for name, value in attrib.items():
+                self.set_attribute(index, name, value)
+        return index
+
+    def get_attribute(self, index, name):
+        column = self.columns.get(name)
+        if column is None or index >= len(column):
+            return None
+        return self.strings.values[column[index]]
+
+    def set_attribute(self, index, name, value):
+        """Sets attribute of the node (removes it if value is None)."""
+        names = self.layouts.values[self.layout[index]]
+        if value is None:
+            if name in names:
+                self.layout[index] = self.layouts.intern(tuple(n for n in names if n != name))
+                self.columns[name][index] = 0
+            return
+        if name not in names:
+            self.layout[index] = self.layouts.intern(names + (name,))
+        column = self.columns.get(name)
+        if column is None:
+            column = self.columns[name] = array.array("i")
+        if index >= len(column):
+            column.extend(bytes(column.itemsize * (index + 1 - len(column))))
+        column[index] = self.strings.intern(value)
+
+    def attribute_names(self, index):
+        """Returns names of attributes of the node, in the order they were set."""
+        return self.layouts.values[self.layout[index]]
+
+    def children(self, index):
+        """Yields indices of children of the node."""
+        child = self.first_child[index]
+        while child != NONE:
+            yield child
+            child = self.next_sibling[child]
+
+    def subtree(self, index):
+        """Yields indices of nodes in the subtree of the node, in document order."""
+        first_child, next_sibling, parent = self.first_child, self.next_sibling, self.parent
+        yield index
+        node = first_child[index]
+        while node != NONE:
+            yield node
+            if first_child[node] != NONE:
+                node = first_child[node]
+                continue
+            while node != index and next_sibling[node] == NONE:
+                node = parent[node]
+            if node == index:
+                return
+            node = next_sibling[node]
+
+    def link(self, parent, position, child):
+        """Inserts detached node child as position-th child of parent (like list.insert)."""
+        previous = NONE
+        if position < 0:
+            position = max(0, position + sum(1 for _ in self.children(parent)))
+        for i, sibling in enumerate(self.children(parent)):
+            if i == position:
+                break
+            previous = sibling
+        if previous == NONE:
+            self.next_sibling[child] = self.first_child[parent]
+            self.first_child[parent] = child
+        else:
+            self.next_sibling[child] = self.next_sibling[previous]
+            self.next_sibling[previous] = child
+        self.parent[child] = parent
+
+    def unlink(self, child):
+        """Detaches the node from its parent (it keeps its subtree and tail)."""
+        parent = self.parent[child]
+        if parent == NONE:
+            return
+        if self.first_child[parent] == child:
+            self.first_child[parent] = self.next_sibling[child]
+        else:
+            previous = self.first_child[parent]
+            while self.next_sibling[previous] != child:
+                previous = self.next_sibling[previous]
+            self.next_sibling[previous] = self.next_sibling[child]
+        self.parent[child] = NONE
+        self.next_sibling[child] = NONE
+
+    def adopt(self, element):
+        """Returns index of a detached node of this document with given element.
+
+        Elements of this document are detached from their parents, others (from other compact
+        documents or ElementTree) are copied."""
+        if isinstance(element, CompactElement) and element.document is self:
+            self.unlink(element.index)
+            return element.index
+        index = self.new_node(element.tag, element.attrib)
+        self.text[index] = self.strings.intern(element.text)
+        self.tail[index] = self.strings.intern(element.tail)
+        previous = NONE
+        for child in element:
+            child_index = self.adopt(child)
+            self.parent[child_index] = index
+            if previous == NONE:
+                self.first_child[index] = child_index
+            else:
+                self.next_sibling[previous] = child_index
+            previous = child_index
+        return index
+
+    def getroot(self):
+        return CompactElement(self, self.root)
+
+    def iter(self, tag=None):
+        return self.getroot().iter(tag)
+
+    def find(self, path):
+        return self.getroot().find(path)
+
+    def findall(self, path):
+        return self.getroot().findall(path)
+
+    def iterfind(self, path):
+        return self.getroot().iterfind(path)
+
+    def write(self, file, encoding="us-ascii", xml_declaration=None):
+        """Serializes the document like ElementTree.ElementTree.write (with method="xml").
+
+        file is a file name or a binary file object."""
+        if not hasattr(file, "write"):
+            with open(file, "wb") as f:
+                return self.write(f, encoding, xml_declaration)
+        parts = []
+        def flush():
+            file.write("".join(parts).encode(encoding, "xmlcharrefreplace"))
+            parts.clear()
+        if xml_declaration or (xml_declaration is None and encoding.lower() not in ("utf-8", "us-ascii")):
+            parts.append("<?xml version='1.0' encoding='{}'?>\n".format(encoding))
+        qnames, namespaces = self._qualified_names()
+        strings = self.strings.values
+        columns = self.columns
+        layouts = self.layouts.values
+        # The escaping functions are the ones ElementTree uses, so the output is the same.
+        escape_cdata, escape_attrib = ElementTree._escape_cdata, ElementTree._escape_attrib
+        declarations = "".join(
+                ' xmlns{}="{}"'.format(":" + prefix if prefix else "", escape_attrib(uri))
+                for uri, prefix in sorted(namespaces.items(), key=lambda item: item[1]))
+        root = self.root
+        node = root
+        while True:
+            tag = qnames[strings[self.tag[node]]]
+            parts.append("<" + tag + declarations)
+            declarations = ""
+            for name in layouts[self.layout[node]]:
+                value = strings[columns[name][node]]
+                parts.append(' {}="{}"'.format(qnames[name], escape_attrib(value)))
+            text = strings[self.text[node]]
+            if text or self.first_child[node] != NONE:
+                parts.append(">")
+                if text:
+                    parts.append(escape_cdata(text))
+                if self.first_child[node] != NONE:
+                    node = self.first_child[node]
+                    continue
+                parts.append("</" + tag + ">")
+            else:
+                parts.append(" />")
+            if len(parts) > 4096:
+                flush()
+            # The node is finished, write its tail and end tags of finished ancestors.
+            while True:
+                if self.tail[node]:
+                    parts.append(escape_cdata(strings[self.tail[node]]))
+                if node == root or self.next_sibling[node] != NONE:
+                    break
+                node = self.parent[node]
+                parts.append("</" + qnames[strings[self.tag[node]]] + ">")
+            if node == root:
+                break
+            node = self.next_sibling[node]
+        flush()
+
+    def _qualified_names(self):
+        """Returns (name -> qualified name, namespace uri -> prefix) for tags and attribute names.
+
+        Prefixes are chosen like ElementTree does."""
+        qnames = {}
+        namespaces = {}
+        strings = self.strings.values
+        def add_qname(qname):
+            if qname[:1] == "{":
+                uri, local = qname[1:].rsplit("}", 1)
+                prefix = namespaces.get(uri)
+                if prefix is None:
+                    prefix = ElementTree._namespace_map.get(uri)
+                    if prefix is None:
+                        prefix = "ns{}".format(len(namespaces))
+                    if prefix != "xml":
+                        namespaces[uri] = prefix
+                qnames[qname] = "{}:{}".format(prefix, local) if prefix else local
+            else:
+                qnames[qname] = qname
+        for node in self.subtree(self.root):
+            for name in (strings[self.tag[node]],) + self.attribute_names(node):
+                if name not in qnames:
+                    add_qname(name)
+        return qnames, namespaces
+
+class CompactAttributes(collections.abc.MutableMapping):
+    """Mutable mapping view of attributes of a CompactElement."""
+    def __init__(self, element):
+        self.document = element.document
+        self.index = element.index
+
+    def __getitem__(self, name):
+        value = self.document.get_attribute(self.index, name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        self.document.set_attribute(self.index, name, value)
+
+    def __delitem__(self, name):
+        self[name]
+        self.document.set_attribute(self.index, name, None)
+
+    def __iter__(self):
+        return iter(self.document.attribute_names(self.index))
+
+    def __len__(self):
+        return len(self.document.attribute_names(self.index))
+
+class CompactElement(object):
+    """Handle of a node of CompactDocument, usable in place of ElementTree.Element."""
+    __slots__ = ("document", "index")
+
+    def __init__(self, document, index):
+        self.document = document
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, CompactElement) and self.document is other.document and self.index == other.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.document), self.index))
+
+    def __repr__(self):
+        return "<CompactElement {!r} at {}>".format(self.tag, self.index)
+
+    @property
+    def tag(self):
+        return self.document.strings.values[self.document.tag[self.index]]
+
+    @tag.setter
+    def tag(self, value):
+        self.document.tag[self.index] = self.document.strings.intern(value)
+
+    @property
+    def text(self):
+        return self.document.strings.values[self.document.text[self.index]]
+
+    @text.setter
+    def text(self, value):
+        self.document.text[self.index] = self.document.strings.intern(value)
+
+    @property
+    def tail(self):
+        return self.document.strings.values[self.document.tail[self.index]]
+
+    @tail.setter
+    def tail(self, value):
+        self.document.tail[self.index] = self.document.strings.intern(value)
+
+    @property
+    def attrib(self):
+        return CompactAttributes(self)
+
+    def get(self, key, default=None):
+        value = self.document.get_attribute(self.index, key)
+        return default if value is None else value
+
+    def set(self, key, value):
+        self.document.set_attribute(self.index, key, value)
+
+    def keys(self):
+        return list(self.document.attribute_names(self.index))
+
+    def items(self):
+        return [(name, self.get(name)) for name in self.keys()]
+
+    def __len__(self):
+        return sum(1 for _ in self.document.children(self.index))
+
+    def __iter__(self):
+        document = self.document
+        return (CompactElement(document, child) for child in document.children(self.index))
+
+    def __getitem__(self, index):
+        children = list(self)
+        return children[index]
+
+    def iter(self, tag=None):
+        """Yields this element and its descendants in document order (with given tag)."""
+        if tag == "*":
+            tag = None
+        document = self.document
+        tag_id = None if tag is None else document.strings.lookup(tag)
+        if tag is not None and tag_id is None:
+            return
+        for node in document.subtree(self.index):
+            if tag_id is None or document.tag[node] == tag_id:
+                # ElementPath relies on the element itself being returned.
+                yield self if node == self.index else CompactElement(document, node)
+
+    def iterfind(self, path, namespaces=None):
+        match = _ATTRIBUTE_PATH_RE.match(path)
+        if match is None or namespaces:
+            return ElementPath.iterfind(self, path, namespaces)
+        return self._iter_with_attribute(*match.groups())
+
+    def _iter_with_attribute(self, name, value):
+        """Yields descendants with attribute name (set to value, unless it is None)."""
+        document = self.document
+        column = document.columns.get(name)
+        if column is None:
+            return
+        if value is None:
+            matches = lambda string_id: string_id != 0
+        else:
+            value_id = document.strings.lookup(value)
+            if value_id is None:
+                return
+            matches = lambda string_id: string_id == value_id
+        size = len(column)
+        for node in document.subtree(self.index):
+            if node != self.index and node < size and matches(column[node]):
+                yield CompactElement(document, node)
+
+    def find(self, path, namespaces=None):
+        return next(iter(self.iterfind(path, namespaces)), None)
+
+    def findall(self, path, namespaces=None):
+        return list(self.iterfind(path, namespaces))
+
+    def insert(self, index, element):
+        """Inserts element as index-th child (see CompactDocument.adopt)."""
+        document = self.document
+        document.link(self.index, index, document.adopt(element))
+
+    def append(self, element):
+        self.insert(len(self), element)
+
+    def remove(self, element):
+        if not (isinstance(element, CompactElement) and element.document is self.document
+                and self.document.parent[element.index] == self.index):
+            raise ValueError("element is not a child of this element")
+        self.document.unlink(element.index)
+
+    def to_element(self):
+        """Returns a copy of the subtree as ElementTree.Element."""
+        element = ElementTree.Element(self.tag, dict(self.items()))
+        element.text = self.text
+        element.tail = self.tail
+        element.extend(child.to_element() for child in self)
+        return element
+
+    def __copy__(self):
+        return self.to_element()
+
+    def __deepcopy__(self, memo):
+        return self.to_element()
+
+class _Builder(object):
+    """ElementTree.XMLParser target building CompactDocument (like ElementTree.TreeBuilder)."""
+    def __init__(self):
+        self.document = CompactDocument()
+        self.open = []
+        self.last = NONE
+        self.pending = []
+
+    def start(self, tag, attrib):
+        self._flush()
+        document = self.document
+        index = document.new_node(tag, attrib)
+        if self.last != NONE:
+            document.next_sibling[self.last] = index
+        elif self.open:
+            document.first_child[self.open[-1]] = index
+        else:
+            document.root = index
+        if self.open:
+            document.parent[index] = self.open[-1]
+        self.open.append(index)
+        self.last = NONE
+
+    def end(self, tag):
+        self._flush()
+        self.last = self.open.pop()
+
+    def data(self, data):
+        self.pending.append(data)
+
+    def _flush(self):
+        if self.pending:
+            string_id = self.document.strings.intern("".join(self.pending))
+            if self.last != NONE:
+                self.document.tail[self.last] = string_id
+            elif self.open:
+                self.document.text[self.open[-1]] = string_id
+            self.pending = []
+
+    def close(self):
+        return self.document
+
+def parse(source):
+    """Reads and parses given xml file (file name or binary file object) into CompactDocument."""
+    if not hasattr(source, "read"):
+        with open(source, "rb") as f:
+            return parse(f)
+    parser = ElementTree.XMLParser(target=_Builder())
+    for block in iter(lambda: source.read(BLOCK_SIZE), b""):
+        parser.feed(block)
+    return parser.close()
+
+def synthetic_svg(file, nodes):
+    """Writes svg file with given number of path nodes in groups, like GIS exports."""
+    file.write(b'<?xml version="1.0" encoding="UTF-8"?>\n'
+               b'<svg xmlns="http://www.w3.org/2000/svg" width="1000" height="1000">\n')
+    for i in range(nodes):
+        if i % 100 == 0:
+            file.write(b'<g id="layer%d" stroke="black">\n' % (i // 100) if i == 0
+                       else b'</g>\n<g id="layer%d" stroke="black">\n' % (i // 100))
+        file.write(b'  <path id="p%d" d="M %d %d L %d %d" fill="#%06x" stroke-width="1"/>\n'
+                   % (i, i % 1000, i // 1000, (i * 7) % 1000, (i * 13) % 1000, (i % 16) * 0x111111))
+    file.write(b'</g>\n</svg>\n' if nodes else b'</svg>\n')
+
+def benchmark(filename):
+    """Returns list of (model, measurement, value) comparing ElementTree and CompactDocument."""
+    import time
+    import tracemalloc
+    results = []
+    for model, load in (("ElementTree", ElementTree.parse), ("compact", parse)):
+        # Memory is measured separately, as tracing slows the loading down.
+        tracemalloc.start()
+        tree = load(filename)
+        results.append((model, "memory (MB)", tracemalloc.get_traced_memory()[0] / 2**20))
+        tracemalloc.stop()
+        del tree
+        start = time.perf_counter()
+        tree = load(filename)
+        results.append((model, "load time (s)", time.perf_counter() - start))
+        start = time.perf_counter()
+        for element in tree.iter():
+            element.get("id")
+        results.append((model, "traversal time (s)", time.perf_counter() - start))
+        last_id = [element.get("id") for element in tree.iter() if element.get("id") is not None][-1:]
+        start = time.perf_counter()
+        for element_id in last_id:
+            tree.getroot().findall(".//*[@id='{}']".format(element_id))
+        results.append((model, "select by id time (s)", time.perf_counter() - start))
+        del tree
+    return results
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import tempfile
+    arguments = sys.argv[1:]
+    filenames = []
+    temporary = None
+    if arguments[:1] == ["--nodes"]:
+        temporary = tempfile.NamedTemporaryFile(suffix=".svg", delete=False)
+        with temporary:
+            synthetic_svg(temporary, int(arguments[1]))
+        filenames.append(temporary.name)
+        arguments = arguments[2:]
+    filenames.extend(arguments)
+    try:
+        for filename in filenames:
+            print(filename)
+            for model, measurement, value in benchmark(filename):
+                print("  {:12} {:22} {:10.3f}".format(model, measurement, value))
+    finally:
+        if temporary is not None:
+            os.remove(temporary.name)
@@ -1,4 +1,6 @@
-from . import command, parse
+from . import command, parse, timing
+from modgrammar import debugging
+import cProfile
 import sys
 import glob
 
@@ -10,6 +12,37 @@ def expand(*arguments):
         return argument.replace("\\#", "#").replace("\\%", "%")
     return [remove_backslashes(strip_quotes(argument)) for argument in arguments]
 
+def positive_integer(option, value):
+    """Returns value of option converted to integer, which must be at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise ValueError("Option {} requires a positive integer, got {!r}".format(option, value))
+    return number
+
+# Maps option name to whether it takes an argument.
+OPTIONS = {"--timings": False, "--profile": True, "--trace": True, "--parse-profile": False, "--stream": False, "--jobs": True, "--no-overwrite": False, "--skip-unchanged": False, "--compact": False}
+
+def parse_options(arguments):
+    """Splits leading instrumentation options from the command list.
+
+    Returns pair (options, remaining arguments), where options maps option name
+    to its value (True for options without value)."""
+    options = {}
+    arguments = list(arguments)
+    while arguments and arguments[0] in OPTIONS:
+        option = arguments.pop(0)
+        if OPTIONS[option]:
+            if not arguments:
+                raise ValueError("Option {} requires an argument".format(option))
+            options[option] = arguments.pop(0)
+            if option == "--jobs":
+                options[option] = positive_integer(option, options[option])
+        else:
+            options[option] = True
+    return options, arguments
 
 def run(program_name, arguments):
     """Parses the arguments and runs the commands"""
@@ -17,15 +50,67 @@ def run(program_name, arguments):
         print("Usage: {} command list\nSee the man page for details.".format(program_name))
         sys.exit(1)
     if len(arguments) > 0 and arguments[0] == "--complete":
-        completions = parse.complete(*expand(*arguments[1:]))
+        try:
+            # The shell passes all the words typed so far, including the options.
+            options, words = parse_options(arguments[1:])
+        except ValueError:
+            # An option argument is being typed; there are no commands to complete.
+            return
+        completions = parse.complete(*expand(*words))
         for key, value in sorted(completions.items()):
             if key == "file":
                 value = glob.glob("*.svg")
             for item in value:
                 print(item)
+    elif len(arguments) > 0 and arguments[0] == "--lint":
+        ambiguities = parse.ambiguities(*expand(*arguments[1:]))
+        for tokens, count in ambiguities:
+            print("ambiguous ({} ways): {}".format(count, " ".join(tokens)))
+        if ambiguities:
+            sys.exit(1)
     else:
-        command_list = parse.CommandList.parser().parse_text(
-                parse.join_tokens(arguments), eof=True, matchtype="complete").command_list
+        try:
+            options, arguments = parse_options(arguments)
+        except ValueError as e:
+            sys.stderr.write("{}: {}\nUsage: {} [options] command list\nSee the man page for details.\n".format(
+                program_name, e, program_name))
+            sys.exit(1)
+        timings = timing.Timings() if "--timings" in options or "--trace" in options else None
+        profiler = None
+        if "--profile" in options:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        grammar_profiler = debugging.GrammarProfiler() if "--parse-profile" in options else None
+        if "--stream" in options:
+            command_list = parse.iter_commands(arguments, debug=grammar_profiler)
+            if timings:
+                command_list = timings.streaming(command_list)
+        else:
+            parser = parse.CommandList.parser(debug=grammar_profiler, error_tracking="deferred", reduce=True)
+            text = parse.join_tokens(arguments)
+            if timings:
+                command_list = timings.parsing(parser.parse_text, text, eof=True, matchtype="complete")
+            else:
+                command_list = parser.parse_text(text, eof=True, matchtype="complete")
         execution_context = command.ExecutionContext()
+        if "--jobs" in options:
+            execution_context.jobs = options["--jobs"]
+        if "--no-overwrite" in options:
+            execution_context.overwrite = False
+        if "--skip-unchanged" in options:
+            execution_context.skip_unchanged = True
+        if "--compact" in options:
+            execution_context.compact = True
+        if timings:
+            timings.install(execution_context)
         for command_to_execute in command_list:
-            command_to_execute.execute(execution_context)
+            execution_context.execute(command_to_execute)
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(options["--profile"])
+        if "--timings" in options:
+            timings.report()
+        if "--trace" in options:
+            timings.write_chrome_trace(options["--trace"])
+        if grammar_profiler:
+            sys.stderr.write(grammar_profiler.summary(limit=20) + "\n")
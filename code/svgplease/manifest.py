@@ -0,0 +1,65 @@
+import json
+import os
+
+FILENAME = ".svgplease-manifest.json"
+
+def file_key(filename):
+    """Returns (size, mtime_ns) of the file, or None if it doesn't exist."""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+class Manifest(object):
+    """Sidecar file recording what was saved to the svg files in one directory.
+
+    For each saved file it stores the sha256 hash of the document, the size and
+    modification time the file had after saving (so that files changed by anything else
+    are detected without reading them) and, for documents saved without modification,
+    the source they were opened from.
+    """
+    def __init__(self, directory):
+        self.filename = os.path.join(directory, FILENAME)
+        self.entries = {}
+        try:
+            with open(self.filename) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def _entry(self, filename):
+        entry = self.entries.get(os.path.basename(filename))
+        if entry is None or file_key(filename) != tuple(entry["file"]):
+            return None
+        return entry
+
+    def has_digest(self, filename, digest):
+        """Returns whether filename is known to contain document with given hash."""
+        entry = self._entry(filename)
+        return entry is not None and entry["sha256"] == digest
+
+    def has_source(self, filename, source):
+        """Returns whether filename is known to contain unmodified document opened from source."""
+        entry = self._entry(filename)
+        return entry is not None and source is not None and entry["source"] == list(source)
+
+    def record(self, filename, digest, source=None):
+        """Records that filename now contains document with given hash (and source).
+
+        Nothing is recorded (and any earlier entry is dropped) if the file is gone."""
+        key = file_key(filename)
+        if key is None:
+            self.entries.pop(os.path.basename(filename), None)
+            return
+        self.entries[os.path.basename(filename)] = {
+                "sha256": digest,
+                "file": list(key),
+                "source": None if source is None else list(source),
+                }
+
+    def write(self):
+        temporary = self.filename + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(temporary, self.filename)
@@ -1,4 +1,5 @@
 from modgrammar import *
+import bisect
 from . import command
 
 grammar_whitespace_mode = "explicit"
@@ -12,27 +13,34 @@ def join_tokens(tokens):
     else:
         return ""
 
+def without_separator(string, values, sessiondata):
+    """Reduction returning the matched token without the trailing separator."""
+    return string[:-len(SEPARATOR)]
+
 def KeywordBase(keywords, type, optional=False):
     """Base for all *Keyword functions below"""
-    grammar_list = []
-    for keyword in keywords:
-        grammar_list.append(LITERAL(keyword))
-        grammar_list.append(LITERAL(SEPARATOR))
-    grammar = GRAMMAR(*grammar_list)
-    error_override = True
-    if optional:
-        if len(keywords) == 1:
-            grammar = OPTIONAL(grammar)
-        else:
-            error_override = False
-            grammar = OPTIONAL(KeywordBase([keywords[0]], type, False),
-                              KeywordBase(keywords[1:], type, True))
-    grammar.grammar_error_override = error_override
-    grammar.completions = [keywords[0]]
-    grammar.type = type
     def prefix_matches(prefix):
         return SEPARATOR.join(keywords)[:len(prefix)] == prefix
-    grammar.prefix_matches = prefix_matches
+    attributes = dict(completions=(keywords[0],), type=type,
+            prefix_matches=staticmethod(prefix_matches))
+    if not optional:
+        return GRAMMAR(*[(LITERAL(keyword, intern=True), LITERAL(SEPARATOR, intern=True)) for keyword in keywords],
+                reduce=without_separator, error_override=True, **attributes)
+    if len(keywords) == 1:
+        return OPTIONAL(KeywordBase(keywords, type, False), error_override=True, **attributes)
+    return OPTIONAL(KeywordBase([keywords[0]], type, False),
+                    KeywordBase(keywords[1:], type, True),
+                    error_override=False, **attributes)
+
+def KeywordChoice(keywords, type):
+    """Any one of given keywords, found with a single lookup instead of trying each in turn"""
+    grammar = KEYWORDS(*keywords, sep=SEPARATOR, reduce=without_separator)
+    for keyword, keyword_grammar in zip(keywords, grammar.keyword_grammars):
+        keyword_grammar.completions = [keyword]
+        keyword_grammar.type = type
+        def prefix_matches(prefix, keyword=keyword):
+            return keyword[:len(prefix)] == prefix
+        keyword_grammar.prefix_matches = prefix_matches
     return grammar
 
 def CommandKeyword(keyword):
@@ -50,20 +58,14 @@ def OptionalKeyword(keyword):
     """Literal optional keyword"""
     return KeywordBase([keyword], type="optional_keyword", optional=True)
 
-def DirectionKeyword(keyword):
-    return KeywordBase([keyword], type="direction")
-
-def UnitKeyword(keyword):
-    return KeywordBase([keyword], type="unit")
-
 def MultipleOptionalKeyword(*keywords):
     """Optional keyword that matches any prefix of given keywords"""
     return KeywordBase(keywords, "optional_keyword", optional=True)
 
 class AnyText(Grammar):
     grammar = (ZERO_OR_MORE(EXCEPT(ANY, SEPARATOR)), SEPARATOR)
-    def grammar_elem_init(self, sessiondata):
-        self.text = self.string[:-len(SEPARATOR)]
+    grammar_reduce = without_separator
+    grammar_value_attr = "text"
     grammar_error_override = True
     type = "text"
     completions = ["xkcd.com"]
@@ -72,8 +74,8 @@ class AnyText(Grammar):
 
 class NormalFilename(Grammar):
     grammar = (EXCEPT(ANY_EXCEPT(SEPARATOR), OR("then", "file", "to")), SEPARATOR)
-    def grammar_elem_init(self, sessiondata):
-        self.filename = self.string[:-len(SEPARATOR)]
+    grammar_reduce = without_separator
+    grammar_value_attr = "filename"
     grammar_error_override = True
     type = "file"
     completions = ["file.svg"]
@@ -82,8 +84,8 @@ class NormalFilename(Grammar):
 
 class AnyFilename(Grammar):
     grammar = (ANY_EXCEPT(SEPARATOR), SEPARATOR)
-    def grammar_elem_init(self, sessiondata):
-        self.filename = self.string[:-len(SEPARATOR)]
+    grammar_reduce = without_separator
+    grammar_value_attr = "filename"
     grammar_error_override = True
     type = "file"
     completions = ["file.svg"]
@@ -92,31 +94,34 @@ class AnyFilename(Grammar):
 
 class PrefixedFilename(Grammar):
     grammar = (Keyword("file"), AnyFilename)
-    def grammar_elem_init(self, sessiondata):
-        self.filename = self[1].filename
+    def grammar_reduce(string, values, sessiondata):
+        return values[1]
+    grammar_value_attr = "filename"
 
 class Filename(Grammar):
     grammar = OR(NormalFilename, PrefixedFilename)
     grammar_whitespace_mode = "explicit"
-    def grammar_elem_init(self, sessiondata):
-        self.filename = self[0].filename
+    def grammar_reduce(string, values, sessiondata):
+        return values[0]
+    grammar_value_attr = "filename"
 
 class Open(Grammar):
     grammar = (CommandKeyword("open"), ONE_OR_MORE(Filename))
-    def grammar_elem_init(self, sessiondata):
-        filenames = map(lambda g : g.filename, self[1])
-        self.command = command.Open(*filenames)
+    def grammar_reduce(string, values, sessiondata):
+        return command.Open(*values[1])
+    grammar_value_attr = "command"
 
 class Save(Grammar):
     grammar = (CommandKeyword("save"), OptionalKeyword("to"), ONE_OR_MORE(Filename))
-    def grammar_elem_init(self, sessiondata):
-        filenames = map(lambda g : g.filename, self[2])
-        self.command = command.Save(*filenames)
+    def grammar_reduce(string, values, sessiondata):
+        return command.Save(*values[2])
+    grammar_value_attr = "command"
 
 class NumberWithoutSeparator(Grammar):
     grammar = (OPTIONAL(OR("+", "-")), WORD("0-9"), OPTIONAL((".", WORD("0-9"))))
-    def grammar_elem_init(self, sessiondata):
-        self.number = float(self.string)
+    def grammar_reduce(string, values, sessiondata):
+        return float(string)
+    grammar_value_attr = "number"
 
     grammar_error_override = True
     type = "number"
@@ -126,8 +131,9 @@ class NumberWithoutSeparator(Grammar):
 
 class Number(Grammar):
     grammar = (NumberWithoutSeparator, SEPARATOR)
-    def grammar_elem_init(self, sessiondata):
-        self.number = self[0].number
+    def grammar_reduce(string, values, sessiondata):
+        return values[0]
+    grammar_value_attr = "number"
 
 class Color(Grammar):
     #TODO: color names
@@ -141,17 +147,19 @@ class Color(Grammar):
                 OPTIONAL(WHITESPACE)), sep=",", min=3, max=3), ")", SEPARATOR))
     grammar_error_override = True
 
-    def grammar_elem_init(self, sessiondata):
+    def grammar_reduce(string, values, sessiondata):
         alpha = None
-        if self.string[0] == "#":
-            value = self.string[1:7]
+        if string[0] == "#":
+            value = string[1:7]
             rgb = map(lambda x : int(x, 16), (value[0:2], value[2:4], value[4:6]))
-            if self[0][2] is not None:
-                alpha = int(self.string[7:9], 16)
+            if values[0][2] is not None:
+                alpha = int(string[7:9], 16)
         else:
-            value = self.string[4:-1-len(SEPARATOR)]
+            value = string[4:-1-len(SEPARATOR)]
             rgb = map(lambda d : int(d.strip()), value.split(","))
-        self.color = command.Color(*rgb, alpha=alpha)
+        return command.Color(*rgb, alpha=alpha)
+
+    grammar_value_attr = "color"
 
     # TODO: more intelligent completion
     def prefix_matches(prefix):
@@ -167,25 +175,29 @@ class FillStroke(Grammar):
             OR((FillStrokeKeyword("fill"), OPTIONAL(OptionalKeyword("and"), FillStrokeKeyword("stroke"))),
                 (FillStrokeKeyword("stroke"), OPTIONAL(OptionalKeyword("and"), FillStrokeKeyword("fill")))))
 
-    def grammar_elem_init(self, sessiondata):
-        fill = True if "fill" in self.string else None
-        stroke = True if "stroke" in self.string else None
-        self.fill_stroke = command.FillStroke(fill=fill, stroke=stroke)
+    def grammar_reduce(string, values, sessiondata):
+        fill = True if "fill" in string else None
+        stroke = True if "stroke" in string else None
+        return command.FillStroke(fill=fill, stroke=stroke)
+
+    grammar_value_attr = "fill_stroke"
 
 class ChangeColor(Grammar):
     grammar = (CommandKeyword("change"), FillStroke, OptionalKeyword("color"),
                OPTIONAL(OptionalKeyword("from"), Color),
                OptionalKeyword("to"), Color)
-    def grammar_elem_init(self, sessiondata):
-        from_color = None if self[3] is None else self[3][1].color
-        self.command = command.ChangeColor(fill_stroke=self[1].fill_stroke,
-                                           from_color=from_color,
-                                           to_color=self[5].color)
+    def grammar_reduce(string, values, sessiondata):
+        from_color = None if values[3] is None else values[3][1]
+        return command.ChangeColor(fill_stroke=values[1],
+                                   from_color=from_color,
+                                   to_color=values[5])
+    grammar_value_attr = "command"
 
 class NonNegativeNumberWithoutSeparator(Grammar):
     grammar = (OPTIONAL("+"), WORD("0-9"), OPTIONAL((".", WORD("0-9"))))
-    def grammar_elem_init(self, sessiondata):
-        self.number = float(self.string)
+    def grammar_reduce(string, values, sessiondata):
+        return float(string)
+    grammar_value_attr = "number"
 
     grammar_error_override = True
     type = "non_negative_number"
@@ -195,16 +207,16 @@ class NonNegativeNumberWithoutSeparator(Grammar):
 
 class NonNegativeNumber(Grammar):
     grammar = (NonNegativeNumberWithoutSeparator, SEPARATOR)
-    def grammar_elem_init(self, sessiondata):
-        self.number = self[0].number
+    def grammar_reduce(string, values, sessiondata):
+        return values[0]
+    grammar_value_attr = "number"
 
 class LengthUnit(Grammar):
-    grammar = OR(
-        OR(UnitKeyword("px"), UnitKeyword("pixel"), UnitKeyword("pixels")),
-        OR(UnitKeyword("pt"), UnitKeyword("point"), UnitKeyword("points")),
-        OR(UnitKeyword("mm"), UnitKeyword("millimeter"), UnitKeyword("millimeters")),
-        OR(UnitKeyword("cm"), UnitKeyword("centimeter"), UnitKeyword("centimeters"))
-        )
+    grammar = KeywordChoice([
+        "px", "pixel", "pixels",
+        "pt", "point", "points",
+        "mm", "millimeter", "millimeters",
+        "cm", "centimeter", "centimeters"], type="unit")
     unit_map = {
             "px": "px",
             "pixel": "px",
@@ -219,27 +231,68 @@ class LengthUnit(Grammar):
             "centimeter": "cm",
             "centimeters": "cm",
         }
-    def grammar_elem_init(self, sessiondata):
-        self.unit = LengthUnit.unit_map[self.string[:-len(SEPARATOR)]]
+    def grammar_reduce(string, values, sessiondata):
+        return LengthUnit.unit_map[values[0]]
+    grammar_value_attr = "unit"
 
 class Length(Grammar):
     grammar = (NonNegativeNumberWithoutSeparator, OPTIONAL(SEPARATOR),
             OPTIONAL(OptionalKeyword("of"), LengthUnit))
-    def grammar_elem_init(self, sessiondata):
-        self.length = command.Length(self[0].number, "px" if self[2] is None else self[2][1].unit)
+    def grammar_reduce(string, values, sessiondata):
+        return command.Length(values[0], "px" if values[2] is None else values[2][1])
+    grammar_value_attr = "length"
+
+class LengthUnitWithoutSeparator(Grammar):
+    grammar = KEYWORDS(*LengthUnit.unit_map)
+    def grammar_reduce(string, values, sessiondata):
+        return LengthUnit.unit_map[values[0]]
+    grammar_value_attr = "unit"
+
+class DisplacementTerm(Grammar):
+    grammar = (NumberWithoutSeparator, OPTIONAL(LengthUnitWithoutSeparator))
+    def grammar_reduce(string, values, sessiondata):
+        return {values[1]: values[0]}
+    grammar_value_attr = "terms"
+
+def add_terms(string, values, sessiondata):
+    """Reduction adding up {unit: number} values separated by "+" and "-"."""
+    terms = dict(values[0])
+    for i in range(1, len(values), 2):
+        sign = 1 if values[i] == "+" else -1
+        for unit, number in values[i + 1].items():
+            terms[unit] = terms.get(unit, 0) + sign * number
+    return terms
+
+class DisplacementSum(Grammar):
+    """Sum of displacements within a single token, e.g. 10mm+2px."""
+    grammar = OPERATORS(DisplacementTerm, (("+", "-"), "left"), reduce=add_terms)
+    def grammar_reduce(string, values, sessiondata):
+        return values[0]
+    grammar_value_attr = "terms"
+
+def length_from_terms(terms, default_unit):
+    """Returns Length equal to the sum of {unit: number} terms (unit None means default_unit)."""
+    terms = dict(terms)
+    if None in terms:
+        number = terms.pop(None)
+        terms[default_unit] = terms.get(default_unit, 0) + number
+    if len(terms) == 1:
+        unit, number = terms.popitem()
+        return command.Length(number, unit)
+    return command.Length(sum(command.Length(number, unit).in_pixels() for unit, number in terms.items()), "px")
 
 class Displacement(Grammar):
-    grammar = (NumberWithoutSeparator, OPTIONAL(SEPARATOR),
+    grammar = (DisplacementSum, OPTIONAL(SEPARATOR),
             OPTIONAL(OptionalKeyword("of"), LengthUnit))
-    def grammar_elem_init(self, sessiondata):
-        self.displacement = command.Length(self[0].number, "px" if self[2] is None else self[2][1].unit)
+    def grammar_reduce(string, values, sessiondata):
+        return length_from_terms(values[0], "px" if values[2] is None else values[2][1])
+    grammar_value_attr = "displacement"
 
 class Direction(Grammar):
-    grammar = OR(
-        DirectionKeyword("horizontally"), DirectionKeyword("hor"), DirectionKeyword("x"),
-        DirectionKeyword("vertically"), DirectionKeyword("ver"), DirectionKeyword("y"))
-    def grammar_elem_init(self, sessiondata):
-        self.direction = "horizontally" if self.string[:-len(SEPARATOR)] in ("horizontally", "hor", "x") else "vertically"
+    grammar = KeywordChoice(["horizontally", "hor", "x", "vertically", "ver", "y"], type="direction")
+    def grammar_reduce(string, values, sessiondata):
+        return "horizontally" if values[0] in ("horizontally", "hor", "x") else "vertically"
+    grammar_value_attr = "direction"
 
 def other_direction(direction):
     """Returns the other direction."""
@@ -251,11 +304,11 @@ def other_direction(direction):
 class Move(Grammar):
     grammar = (CommandKeyword("move"), OptionalKeyword("by"), Displacement, OPTIONAL(Direction),
             OPTIONAL(MultipleOptionalKeyword("and", "by"), Displacement, OPTIONAL(Direction)))
-    def grammar_elem_init(self, sessiondata):
-        displacement1 = self[2].displacement
-        displacement2 = self[4][1].displacement if self[4] else command.Displacement(0)
-        direction1 = self[3].direction if self[3] else None
-        direction2 = self[4][2].direction if self[4] and self[4][2] else None
+    def grammar_reduce(string, values, sessiondata):
+        displacement1 = values[2]
+        displacement2 = values[4][1] if values[4] is not None else command.Displacement(0)
+        direction1 = values[3]
+        direction2 = values[4][2] if values[4] is not None else None
 
         if direction1 == None and direction2 == None:
             direction1 = "horizontally"
@@ -265,15 +318,17 @@ class Move(Grammar):
         elif direction2 == None:
             direction2 = other_direction(direction1)
 
-        self.command = command.Move(**{
+        return command.Move(**{
             direction1: displacement1,
             direction2: displacement2,
             })
+    grammar_value_attr = "command"
 
 class Id(Grammar):
     grammar = ("#", WORD("-_a-zA-Z0-9"), SEPARATOR)
-    def grammar_elem_init(self, sessiondata):
-        self.id = self[1].string
+    def grammar_reduce(string, values, sessiondata):
+        return values[1]
+    grammar_value_attr = "id"
     grammar_error_override = True
     type = "id"
     def prefix_matches(prefix):
@@ -282,14 +337,17 @@ class Id(Grammar):
 
 class Select(Grammar):
     grammar = (CommandKeyword("select"), Id)
-    def grammar_elem_init(self, sessiondata):
-        self.command = command.Select(self[1].id)
+    def grammar_reduce(string, values, sessiondata):
+        return command.Select(values[1])
+    grammar_value_attr = "command"
 
 class Percent(Grammar):
     grammar = (NumberWithoutSeparator, "%", SEPARATOR)
+    def grammar_reduce(string, values, sessiondata):
+        return values[0] / 100
+    grammar_value_attr = "number"
     def grammar_elem_init(self, sessiondata):
         self.percent = self[0].number
-        self.number = self.percent / 100
     grammar_error_override = True
     type = "percent"
     def prefix_matches(prefix):
@@ -300,65 +358,71 @@ class Scale(Grammar):
     grammar = (CommandKeyword("scale"), OptionalKeyword("by"), OR(Number, Percent), OR(
         MultipleOptionalKeyword("both", "directions"),
         (OPTIONAL(Direction), OPTIONAL(MultipleOptionalKeyword("and", "by"), OR(Number, Percent), OPTIONAL(Direction)))))
-    def grammar_elem_init(self, sessiondata):
-        both = (self[3] is None or self[3].string[:4] in ("", "both"))
-        scale1 = self[2].number
+    def grammar_reduce(string, values, sessiondata):
+        both = (values[3] is None or values[3][0] == "both")
+        scale1 = values[2]
         if both:
-            self.command = command.Scale(scale1, scale1)
+            return command.Scale(scale1, scale1)
         else:
             scale2 = 1
-            if self[3][1] and self[3][1][1]:
-                scale2 = self[3][1][1].number
-            direction1 = self[3][0].direction if self[3][0] else None
-            direction2 = self[3][1][2].direction if self[3][1] and self[3][1][2] else None
+            if values[3][1] is not None:
+                scale2 = values[3][1][1]
+            direction1 = values[3][0]
+            direction2 = values[3][1][2] if values[3][1] is not None else None
             if direction1 is None and direction2 is None:
                 direction1, direction2 = "horizontally", "vertically"
             elif direction1 == None:
                 direction1 = other_direction(direction2)
             elif direction2 == None:
                 direction2 = other_direction(direction1)
-            self.command = command.Scale(**{
+            return command.Scale(**{
                 direction1: scale1,
                 direction2: scale2
                 })
+    grammar_value_attr = "command"
 
 class Remove(Grammar):
     grammar = (CommandKeyword("remove"), OptionalKeyword("selected"))
-    def grammar_elem_init(self, sessiondata):
-        self.command = command.Remove()
+    def grammar_reduce(string, values, sessiondata):
+        return command.Remove()
+    grammar_value_attr = "command"
 
 class ChangeLike(Grammar):
     grammar = (CommandKeyword("change"), Keyword("like"), Keyword("from"),
             LIST_OF(Filename, sep=Keyword("via")),
             Keyword("to"), Filename)
-    def grammar_elem_init(self, sessiondata):
-        self.command = command.ChangeLike(*([r.filename for r in list(self[3])[::2]] + [self[5].filename]))
+    def grammar_reduce(string, values, sessiondata):
+        return command.ChangeLike(*(list(values[3][::2]) + [values[5]]))
+    grammar_value_attr = "command"
 
 class ChangeText(Grammar):
     grammar = (CommandKeyword("change"), Keyword("text"), Keyword("to"), AnyText)
-    def grammar_elem_init(self, sessiondata):
-        self.command = command.ChangeText(self[3].text)
+    def grammar_reduce(string, values, sessiondata):
+        return command.ChangeText(values[3])
+    grammar_value_attr = "command"
 
 class PageDimensions(Grammar):
     grammar = (Length, OptionalKeyword("by"), Length)
 
 class Page(Grammar):
     grammar = OR(Keyword("a3"), Keyword("a4"), Keyword("a5"), PageDimensions)
-    def grammar_elem_init(self, sessiondata):
-        if len(list(self[0])) == 2:
-            self.page = command.Page(self[0][0].string)
+    def grammar_reduce(string, values, sessiondata):
+        if isinstance(values[0], str):
+            return command.Page(values[0])
         else:
-            self.page = command.Page(self[0][0].length, self[0][2].length)
+            return command.Page(values[0][0], values[0][2])
+    grammar_value_attr = "page"
 
 class Tile(Grammar):
     grammar = (CommandKeyword("tile"), OPTIONAL(OR(Keyword("on"), (Keyword("to"), Keyword("fill")))), Page, OR(OptionalKeyword("page"), OptionalKeyword("pages")))
-    def grammar_elem_init(self, sessiondata):
-        self.command = command.Tile(page=self[2].page, fill=(self[1] is not None and self[1].string == "to" + SEPARATOR + "fill" + SEPARATOR))
+    def grammar_reduce(string, values, sessiondata):
+        return command.Tile(page=values[2], fill=(values[1] == ("to", "fill")))
+    grammar_value_attr = "command"
 
 class Font(Grammar):
     grammar = (ONE_OR_MORE(EXCEPT(ANY, SEPARATOR)), SEPARATOR)
-    def grammar_elem_init(self, sessiondata):
-        self.font = self.string[:-len(SEPARATOR)]
+    grammar_reduce = without_separator
+    grammar_value_attr = "font"
     grammar_error_override = True
     type = "font"
     completions = ["Arial", "Times New Roman"]
@@ -367,20 +431,74 @@ class Font(Grammar):
 
 class ChangeFontFamily(Grammar):
     grammar = (CommandKeyword("change"), Keyword("font"), OptionalKeyword("family"), Keyword("to"), Font)
-    def grammar_elem_init(self, sessiondata):
-        self.command = command.ChangeFontFamily(self[4].font)
+    def grammar_reduce(string, values, sessiondata):
+        return command.ChangeFontFamily(values[4])
+    grammar_value_attr = "command"
 
 class ChangeFontSize(Grammar):
     grammar = (CommandKeyword("change"), Keyword("font"), Keyword("size"), OptionalKeyword("to"), Length)
-    def grammar_elem_init(self, sessiondata):
-        self.command = command.ChangeFontSize(self[4].length)
+    def grammar_reduce(string, values, sessiondata):
+        return command.ChangeFontSize(values[4])
+    grammar_value_attr = "command"
+
+COMMANDS = (ChangeColor, ChangeFontFamily, ChangeFontSize, ChangeLike, ChangeText,
+            Move, Open, Remove, Save, Scale, Select, Tile)
 
 class CommandList(Grammar):
-    grammar = LIST_OF(OR(
-        ChangeColor, ChangeFontFamily, ChangeFontSize, ChangeLike, ChangeText,
-        Move, Open, Remove, Save, Scale, Select, Tile), sep=Keyword("then"))
-    def grammar_elem_init(self, sessiondata):
-        self.command_list = list(map(lambda r : r.command, list(self[0])[::2]))
+    grammar = LIST_OF(OR(*COMMANDS), sep=Keyword("then"))
+    grammar_compact = True
+    def grammar_reduce(string, values, sessiondata):
+        return list(values[0][::2])
+    grammar_value_attr = "command_list"
+
+class CommandListItem(Grammar):
+    grammar = (OR(*COMMANDS), OR((Keyword("then"), NOT_FOLLOWED_BY(EOF, desc="command")), EOF))
+    def grammar_reduce(string, values, sessiondata):
+        return values[0]
+    grammar_value_attr = "command"
+
+# Parsers for attribute values read while executing commands. Pools can be used
+# from several threads at once.
+COLOR_PARSERS = Color.parser_pool(error_tracking="deferred", reduce=True)
+LENGTH_PARSERS = Length.parser_pool(error_tracking="deferred", reduce=True)
+
+def iter_commands(tokens, debug=False):
+    """Parses tokens of a command list, yielding each command as soon as it is parsed.
+
+    Tokens are consumed lazily, so tokens can be any iterable. ParseError is raised
+    when the rest of the command list is invalid, after yielding the commands before it."""
+    parser = CommandListItem.parser(debug=debug, error_tracking="deferred", reduce=True)
+    return parser.parse_lines((token + SEPARATOR for token in tokens), eof=True)
+
+def ambiguities(*tokens):
+    """Returns the parts of the command list that can be parsed in more than one way.
+
+    Returns list of pairs (tokens, number of ways). Ambiguities without any tokens
+    (e.g. which of several optional parts were left out) are reported as the tokens
+    of the whole command they are in."""
+    text = join_tokens(tokens)
+    forest = CommandList.parser().parse_text(text, eof=True, matchtype="forest")
+    if forest is None or len(text) not in forest.lengths:
+        # Report the error.
+        CommandList.parser().parse_text(text, eof=True, matchtype="complete")
+        return []
+    # Offsets at which the commands (with the following "then") end.
+    command_ends = []
+    for item in CommandListItem.parser().parse_lines([text], eof=True):
+        command_ends.append((command_ends[-1] if command_ends else 0) + len(item.string))
+    result = []
+    for grammar, start, end, count in forest.ambiguities(len(text)):
+        if end == start:
+            # Ambiguities at the end of a command belong to it, not to the next one.
+            index = bisect.bisect_left(command_ends, start)
+            start = command_ends[index - 1] if index > 0 else 0
+            end = command_ends[index]
+        part = text[start:end].rstrip(SEPARATOR).split(SEPARATOR)
+        if part[-1:] == ["then"] and end != len(text):
+            part.pop()
+        if (part, count) not in result:
+            result.append((part, count))
+    return result
 
 def complete(*tokens):
     text = join_tokens(tokens) + SEPARATOR
@@ -0,0 +1,130 @@
+from .command import Save
+import json
+import sys
+import time
+
+def count_nodes(nodes):
+    """Returns the number of nodes in subtrees rooted at given nodes."""
+    return sum(1 for node in nodes for _ in node.iter())
+
+class CommandTiming(object):
+    """Class representing measurements of a single executed command.
+
+    It has the following fields:
+        - command - the executed command
+        - start - wall clock time (time.perf_counter) when the command started
+        - wall_time - wall clock time spent in the command (in seconds)
+        - cpu_time - cpu time spent in the command (in seconds)
+        - nodes_visited - number of selected nodes (with descendants) the command started with,
+          plus the nodes of documents it opened or generated
+        - documents_opened - number of documents opened or generated by the command
+        - documents_saved - number of documents written by the command
+    """
+    def __init__(self, command, start, wall_time, cpu_time, nodes_visited, documents_opened, documents_saved):
+        self.command = command
+        self.start = start
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.nodes_visited = nodes_visited
+        self.documents_opened = documents_opened
+        self.documents_saved = documents_saved
+
+    @property
+    def name(self):
+        return self.command.__class__.__name__
+
+class Timings(object):
+    """Class collecting parse time and per-command timings.
+
+    The measurements are done by before_execute and after_execute hooks of ExecutionContext.
+    Usage:
+    >>> timings = Timings()
+    >>> timings.install(execution_context)
+    >>> for command_to_execute in command_list:
+    ...     execution_context.execute(command_to_execute)
+    >>> timings.report()
+    """
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.parse_start = None
+        self.parse_time = None
+        self.commands = []
+        self._started = None
+
+    def install(self, execution_context):
+        """Adds hooks measuring each command to given execution context."""
+        execution_context.before_execute.append(self.before_execute)
+        execution_context.after_execute.append(self.after_execute)
+
+    def parsing(self, parse, *args, **kwargs):
+        """Calls parse(*args, **kwargs), records time spent and returns its result."""
+        self.parse_start = time.perf_counter()
+        try:
+            return parse(*args, **kwargs)
+        finally:
+            self.parse_time = time.perf_counter() - self.parse_start
+
+    def streaming(self, iterable):
+        """Yields items of iterable (e.g. commands being parsed), recording total time spent
+        in producing them as the parse time."""
+        self.parse_start = time.perf_counter()
+        self.parse_time = 0
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.parse_time += time.perf_counter() - start
+            yield item
+
+    def before_execute(self, command, execution_context):
+        nodes = count_nodes(execution_context.selected_nodes)
+        documents = set(map(id, execution_context.svg_roots))
+        self._started = (nodes, documents, time.perf_counter(), time.process_time())
+
+    def after_execute(self, command, execution_context):
+        wall_end, cpu_end = time.perf_counter(), time.process_time()
+        nodes, documents, wall_start, cpu_start = self._started
+        self._started = None
+        new_roots = [r for r in execution_context.svg_roots if id(r) not in documents]
+        nodes += count_nodes(r.root_element.getroot() for r in new_roots)
+        saved = len(execution_context.svg_roots) if isinstance(command, Save) else 0
+        self.commands.append(CommandTiming(command, wall_start, wall_end - wall_start, cpu_end - cpu_start,
+                                           nodes, len(new_roots), saved))
+
+    def report(self, output=None):
+        """Prints human-readable summary of the measurements to output (stderr by default)."""
+        if output is None:
+            output = sys.stderr
+        if self.parse_time is not None:
+            output.write("{0:>3} {1:<16} wall {2:9.6f}s\n".format("", "parse", self.parse_time))
+        for i, timing in enumerate(self.commands):
+            output.write("{0:>3} {1:<16} wall {2:9.6f}s cpu {3:9.6f}s nodes {4:>8} opened {5:>4} saved {6:>4}\n".format(
+                i + 1, timing.name, timing.wall_time, timing.cpu_time,
+                timing.nodes_visited, timing.documents_opened, timing.documents_saved))
+        total = sum(t.wall_time for t in self.commands) + (self.parse_time or 0)
+        output.write("{0:>3} {1:<16} wall {2:9.6f}s\n".format("", "total", total))
+
+    def chrome_trace(self):
+        """Returns the measurements in Chrome trace event format (chrome://tracing)."""
+        def event(name, start, duration, args):
+            return {"name": name, "ph": "X", "pid": 1, "tid": 1,
+                    "ts": (start - self.origin) * 1e6, "dur": duration * 1e6, "args": args}
+        events = []
+        if self.parse_time is not None:
+            events.append(event("parse", self.parse_start, self.parse_time, {}))
+        for timing in self.commands:
+            events.append(event(timing.name, timing.start, timing.wall_time, {
+                "cpu_time": timing.cpu_time,
+                "nodes_visited": timing.nodes_visited,
+                "documents_opened": timing.documents_opened,
+                "documents_saved": timing.documents_saved,
+                }))
+        return {"traceEvents": events}
+
+    def write_chrome_trace(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.chrome_trace(), f)
@@ -1,8 +1,11 @@
 import os
 import unittest
+import unittest.mock
 from xml.etree import ElementTree
 from . import util
 
+from svgplease import manifest
+
 from svgplease.command import ChangeColor, ChangeFontFamily, ChangeFontSize, ChangeLike, ChangeText, Color, Displacement, ExecutionContext, FillStroke, Length, Open, Move, Page, Remove, Save, Scale, Select, SVGRoot, Tile
 
 class TestOpen(unittest.TestCase):
@@ -36,6 +39,34 @@ class TestOpen(unittest.TestCase):
             self.assertIsInstance(execution_context.selected_nodes[0], ElementTree.Element)
             self.assertEqual(root.filename, filename)
 
+    def test_execute_file_removed(self):
+        # The file can disappear between reading and looking at its size and time.
+        execution_context = ExecutionContext()
+        with util.TestDirectory(os.path.join(util.TEST_DATA, "circle.svg")):
+            with unittest.mock.patch("svgplease.manifest.file_key", return_value=None):
+                Open("circle.svg").execute(execution_context)
+        self.assertIsNone(execution_context.svg_roots[0].source)
+
+    def test_execute_file_changed_while_reading(self):
+        execution_context = ExecutionContext()
+        with util.TestDirectory(os.path.join(util.TEST_DATA, "circle.svg")):
+            keys = iter([(1, 1), (2, 2)])
+            with unittest.mock.patch("svgplease.manifest.file_key", side_effect=lambda filename: next(keys)):
+                Open("circle.svg").execute(execution_context)
+        self.assertIsNone(execution_context.svg_roots[0].source)
+
+    def test_execute_concurrently(self):
+        execution_context = ExecutionContext()
+        execution_context.jobs = 4
+        with util.TestDirectory(*[os.path.join(util.TEST_DATA, f) for f in ("circle.svg", "rectangles.svg")]) as testdir:
+            filenames = ["circle.svg", "rectangles.svg"] * 5
+            Open(*filenames).execute(execution_context)
+            self.assertEqual([r.filename for r in execution_context.svg_roots], filenames)
+            self.assertEqual(execution_context.selected_nodes,
+                             [r.root_element.getroot() for r in execution_context.svg_roots])
+            self.assertEqual([len(list(r.root_element.iter())) for r in execution_context.svg_roots],
+                             [len(list(ElementTree.parse(f).iter())) for f in filenames])
+
 class TestSave(unittest.TestCase):
 
     def test_filenames(self):
@@ -68,6 +99,108 @@ class TestSave(unittest.TestCase):
             for name in ("output0.svg", "output1.svg", "output2.svg", "output3.svg"):
                 self.assertTrue(os.path.isfile(os.path.join(testdir, name)))
 
+    def test_execute_concurrently(self):
+        execution_context = ExecutionContext()
+        execution_context.jobs = 3
+        with util.TestDirectory(os.path.join(util.TEST_DATA, "circle.svg")) as testdir:
+            svg_root = ElementTree.parse("circle.svg")
+            for i in range(20):
+                execution_context.svg_roots.append(SVGRoot(svg_root, "circle.svg"))
+            Save("output.svg").execute(execution_context)
+            expected = sorted(["circle.svg", "output.svg"] + ["output{}.svg".format(i) for i in range(1, 20)])
+            self.assertEqual(sorted(os.listdir(testdir)), expected)
+            self.assertEqual(ElementTree.parse("output7.svg").getroot().tag, svg_root.getroot().tag)
+
+    def test_many_files(self):
+        execution_context = ExecutionContext()
+        with util.TestDirectory(os.path.join(util.TEST_DATA, "circle.svg")) as testdir:
+            svg_root = ElementTree.parse("circle.svg")
+            for i in range(1000):
+                execution_context.svg_roots.append(SVGRoot(svg_root, "circle.svg"))
+            Save("tiled1.svg", "tiled.svg").execute(execution_context)
+            expected = ["circle.svg", "tiled.svg"] + ["tiled{}.svg".format(i) for i in range(1, 1000)]
+            self.assertEqual(sorted(os.listdir(testdir)), sorted(expected))
+
+    def test_no_overwrite(self):
+        execution_context = ExecutionContext()
+        execution_context.overwrite = False
+        with util.TestDirectory(os.path.join(util.TEST_DATA, "circle.svg")) as testdir:
+            with open("circle.svg", "rb") as f:
+                original = f.read()
+            svg_root = ElementTree.parse("circle.svg")
+            for i in range(2):
+                execution_context.svg_roots.append(SVGRoot(svg_root, "circle.svg"))
+            Save("circle.svg").execute(execution_context)
+            self.assertEqual(sorted(os.listdir(testdir)), ["circle.svg", "circle1.svg", "circle2.svg"])
+            with open("circle.svg", "rb") as f:
+                self.assertEqual(f.read(), original)
+
+    def test_skip_unchanged(self):
+        with util.TestDirectory(os.path.join(util.TEST_DATA, "circle.svg")) as testdir:
+            def save(dirty):
+                execution_context = ExecutionContext()
+                execution_context.skip_unchanged = True
+                execution_context.execute(Open("circle.svg"))
+                execution_context.svg_roots[0].dirty = dirty
+                execution_context.execute(Save("output.svg"))
+                return os.stat("output.svg").st_ino
+            first = save(False)
+            self.assertTrue(os.path.isfile(".svgplease-manifest.json"))
+            self.assertEqual(save(False), first)
+            # Possibly modified document with the same contents.
+            self.assertEqual(save(True), first)
+            os.utime("output.svg", ns=(0, 0))
+            self.assertNotEqual(save(False), first)
+
+    def test_manifest_record_removed_file(self):
+        with util.TestDirectory() as testdir:
+            file_manifest = manifest.Manifest(testdir)
+            file_manifest.entries["gone.svg"] = {"sha256": "0", "file": [1, 1], "source": None}
+            file_manifest.record(os.path.join(testdir, "gone.svg"), "1")
+            self.assertEqual(file_manifest.entries, {})
+
+    def test_overwrite_keeps_links_and_mode(self):
+        with util.TestDirectory(os.path.join(util.TEST_DATA, "circle.svg")):
+            os.chmod("circle.svg", 0o640)
+            os.symlink("circle.svg", "symlink.svg")
+            os.link("circle.svg", "hardlink.svg")
+            def save(filename):
+                execution_context = ExecutionContext()
+                execution_context.execute(Open("circle.svg"))
+                execution_context.selected_nodes[0].set("width", filename)
+                execution_context.execute(Save(filename))
+            save("symlink.svg")
+            self.assertTrue(os.path.islink("symlink.svg"))
+            self.assertEqual(ElementTree.parse("hardlink.svg").getroot().get("width"), "symlink.svg")
+            os.remove("hardlink.svg")
+            save("circle.svg")
+            self.assertEqual(os.stat("circle.svg").st_mode & 0o777, 0o640)
+            self.assertEqual(ElementTree.parse("symlink.svg").getroot().get("width"), "circle.svg")
+
+    def test_failed_overwrite_of_hard_link_keeps_data(self):
+        with util.TestDirectory(os.path.join(util.TEST_DATA, "circle.svg")) as testdir:
+            os.link("circle.svg", "hardlink.svg")
+            execution_context = ExecutionContext()
+            execution_context.execute(Open("circle.svg"))
+            execution_context.selected_nodes[0].set("width", "10")
+            with unittest.mock.patch("os.fsync", side_effect=[None, OSError("disk error")]):
+                self.assertRaises(OSError, execution_context.execute, Save("circle.svg"))
+            temporary = [name for name in os.listdir(testdir) if name.endswith(".tmp")]
+            self.assertEqual(len(temporary), 1)
+            self.assertEqual(ElementTree.parse(temporary[0]).getroot().get("width"), "10")
+
+    def test_failed_save_keeps_file(self):
+        execution_context = ExecutionContext()
+        with util.TestDirectory(os.path.join(util.TEST_DATA, "circle.svg")) as testdir:
+            with open("circle.svg", "rb") as f:
+                original = f.read()
+            broken = ElementTree.ElementTree(ElementTree.Element("svg", {"width": object()}))
+            execution_context.svg_roots.append(SVGRoot(broken))
+            self.assertRaises(TypeError, Save("circle.svg").execute, execution_context)
+            with open("circle.svg", "rb") as f:
+                self.assertEqual(f.read(), original)
+            self.assertEqual(os.listdir(testdir), ["circle.svg"])
+
 class TestExecutionContext(unittest.TestCase):
 
     def test_svg_roots(self):
@@ -86,6 +219,58 @@ class TestExecutionContext(unittest.TestCase):
         self.assertEqual(context.svg_roots, ["foo", "bar"])
         self.assertEqual(context.selected_nodes, ["lol"])
 
+    def test_execute_hooks(self):
+        calls = []
+        class Command(object):
+            def execute(self, execution_context):
+                calls.append(("execute", self, execution_context))
+        context = ExecutionContext()
+        context.before_execute.append(lambda c, e: calls.append(("before", c, e)))
+        context.after_execute.append(lambda c, e: calls.append(("after", c, e)))
+        command = Command()
+        context.execute(command)
+        self.assertEqual(calls, [
+            ("before", command, context),
+            ("execute", command, context),
+            ("after", command, context)])
+
+    def test_dirty_tracking(self):
+        context = ExecutionContext()
+        with util.TestDirectory(os.path.join(util.TEST_DATA, "circle.svg"), os.path.join(util.TEST_DATA, "rectangles.svg")):
+            context.execute(Open("circle.svg", "rectangles.svg"))
+        self.assertEqual(context.dirty_roots(), [])
+        circle_root, rectangles_root = context.svg_roots
+        circle = circle_root.root_element.getroot()[0]
+        context.selected_nodes = [circle]
+        context.execute(Move(Displacement(1), Displacement(2)))
+        self.assertEqual(context.dirty_roots(), [circle_root])
+        self.assertEqual(circle_root.dirty_elements, {circle})
+        self.assertTrue(circle_root.is_subtree_dirty(circle_root.root_element.getroot()))
+        self.assertFalse(rectangles_root.is_subtree_dirty(rectangles_root.root_element.getroot()))
+        context.execute(Remove())
+        self.assertIn(circle_root.root_element.getroot(), circle_root.dirty_elements)
+
+    def test_dirty_tracking_without_traversal(self):
+        class Untraversable(object):
+            def __init__(self, tree):
+                self.tree = tree
+            def getroot(self):
+                return self.tree.getroot()
+            def iter(self):
+                raise AssertionError("documents should not be traversed")
+        context = ExecutionContext()
+        with util.TestDirectory(os.path.join(util.TEST_DATA, "circle.svg"), os.path.join(util.TEST_DATA, "rectangles.svg")):
+            context.execute(Open("circle.svg", "rectangles.svg"))
+        circle_root, rectangles_root = context.svg_roots
+        for svg_root in context.svg_roots:
+            svg_root.root_element = Untraversable(svg_root.root_element)
+        context.execute(Select("blue"))
+        blue = context.selected_nodes[0]
+        context.execute(Move(Displacement(1), Displacement(2)))
+        context.execute(ChangeColor(FillStroke(), Color(0, 0, 0)))
+        self.assertEqual(context.dirty_roots(), [rectangles_root])
+        self.assertEqual(rectangles_root.dirty_elements, {blue})
+
 class TestSVGRoot(unittest.TestCase):
 
     def test_filename(self):
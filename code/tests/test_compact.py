@@ -0,0 +1,85 @@
+import copy
+import glob
+import io
+import os
+import unittest
+from xml.etree import ElementTree
+from . import util
+
+from svgplease import command, compact
+
+SVG = (b'<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" id="root">'
+       b'<g id="a" fill="red">text<rect id="b" width="1"/>tail<use xlink:href="#b" id="c"/></g>'
+       b'<circle r="2" id="d" />\n</svg>')
+
+class TestCompactDocument(unittest.TestCase):
+
+    def setUp(self):
+        self.document = compact.parse(io.BytesIO(SVG))
+        self.tree = ElementTree.parse(io.BytesIO(SVG))
+
+    def test_parse(self):
+        self.assertEqual([(e.tag, e.items(), e.text, e.tail) for e in self.document.iter()],
+                         [(e.tag, e.items(), e.text, e.tail) for e in self.tree.iter()])
+
+    def test_serialize(self):
+        self.assertEqual(command.serialize_svg(self.document), command.serialize_svg(self.tree))
+        for filename in glob.glob(os.path.join(util.TEST_DATA, "*.svg")):
+            self.assertEqual(command.serialize_svg(compact.parse(filename)),
+                             command.serialize_svg(ElementTree.parse(filename)))
+
+    def test_attributes(self):
+        g = self.document.find(".//*[@id='a']")
+        g.set("stroke", "blue")
+        g.set("fill", "green")
+        self.assertEqual(g.keys(), ["id", "fill", "stroke"])
+        self.assertEqual(g.attrib.pop("id"), "a")
+        self.assertNotIn("id", g.attrib)
+        self.assertEqual(g.get("id", "none"), "none")
+        self.assertEqual(dict(g.attrib), {"fill": "green", "stroke": "blue"})
+
+    def test_handles(self):
+        root = self.document.getroot()
+        self.assertEqual(root, self.document.getroot())
+        self.assertEqual(len({root[0][0], self.document.find(".//*[@id='b']")}), 1)
+        self.assertNotEqual(root[0], root[1])
+        self.assertEqual([c.get("id") for c in root[0][:2]], ["b", "c"])
+
+    def test_find(self):
+        root = self.document.getroot()
+        self.assertEqual([e.get("id") for e in root.findall(".//*[@id]")], ["a", "b", "c", "d"])
+        self.assertEqual(root.findall(".//*[@id='nothing']"), [])
+        self.assertEqual([e.get("id") for e in root[0].findall(".//*[@fill]")], [])
+        self.assertEqual(root.find("{http://www.w3.org/2000/svg}circle").get("r"), "2")
+        self.assertEqual([e.get("id") for e in root.iter("{http://www.w3.org/2000/svg}rect")], ["b"])
+
+    def test_remove_and_insert(self):
+        root = self.document.getroot()
+        g, circle = root
+        self.assertRaises(ValueError, g.remove, circle)
+        root.remove(g)
+        self.assertEqual([e.get("id") for e in root.iter()], ["root", "d"])
+        root.append(g)
+        circle.insert(0, g[1])
+        self.assertEqual([e.get("id") for e in root.iter()], ["root", "d", "c", "a", "b"])
+        circle.insert(-1, self.tree.getroot()[1])
+        self.assertEqual([e.get("id") for e in circle], ["d", "c"])
+        self.assertEqual(len(self.tree.getroot()), 2)
+
+    def test_deepcopy(self):
+        g = copy.deepcopy(self.document.getroot()[0])
+        self.assertIsInstance(g, ElementTree.Element)
+        self.assertEqual(ElementTree.tostring(g), ElementTree.tostring(self.tree.getroot()[0]))
+
+    def test_open(self):
+        context = command.ExecutionContext()
+        context.compact = True
+        with util.TestDirectory(os.path.join(util.TEST_DATA, "rectangles.svg")):
+            context.execute(command.Open("rectangles.svg"))
+            context.execute(command.Select("blue"))
+            context.execute(command.ChangeColor(command.FillStroke(), command.Color(0, 0, 0)))
+            context.execute(command.Remove())
+            context.execute(command.Save("output.svg"))
+            self.assertIsInstance(context.svg_roots[0].root_element, compact.CompactDocument)
+            self.assertEqual(context.dirty_roots(), context.svg_roots)
+            self.assertEqual(ElementTree.parse("output.svg").getroot().findall(".//*[@id='blue']"), [])
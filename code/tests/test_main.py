@@ -1,3 +1,5 @@
+import contextlib
+import io
 import unittest
 
 from svgplease import main
@@ -11,3 +13,40 @@ class TestExpand(unittest.TestCase):
 
     def test_backslash(self):
         self.assertEqual(main.expand("\\#foo", "10\\%"), ["#foo", "10%"])
+
+class TestParseOptions(unittest.TestCase):
+
+    def test_no_options(self):
+        self.assertEqual(main.parse_options(["open", "file.svg"]), ({}, ["open", "file.svg"]))
+
+    def test_options(self):
+        self.assertEqual(
+                main.parse_options(["--timings", "--trace", "trace.json", "open", "file.svg"]),
+                ({"--timings": True, "--trace": "trace.json"}, ["open", "file.svg"]))
+
+    def test_missing_argument(self):
+        self.assertRaises(ValueError, main.parse_options, ["--profile"])
+
+    def test_jobs(self):
+        self.assertEqual(main.parse_options(["--jobs", "4", "open", "a.svg"]), ({"--jobs": 4}, ["open", "a.svg"]))
+        for value in ("abc", "0", "-3"):
+            self.assertRaises(ValueError, main.parse_options, ["--jobs", value])
+
+class TestRun(unittest.TestCase):
+
+    def test_invalid_option(self):
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr), self.assertRaises(SystemExit):
+            main.run("svgplease", ["--jobs", "abc", "open", "a.svg"])
+        self.assertIn("Option --jobs requires a positive integer, got 'abc'", stderr.getvalue())
+
+    def complete(self, *arguments):
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            main.run("svgplease", ["--complete"] + list(arguments))
+        return stdout.getvalue().split()
+
+    def test_complete_after_options(self):
+        self.assertIn("open", self.complete("op"))
+        self.assertEqual(self.complete("--jobs", "4", "--stream", "op"), self.complete("op"))
+        self.assertEqual(self.complete("--jobs"), [])
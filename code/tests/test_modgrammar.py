@@ -0,0 +1,192 @@
+import io
+import pickle
+import re
+import types
+import unittest
+import modgrammar
+from modgrammar import CUT, GRAMMAR, LIST_OF, LITERAL, OPERATORS, OPTIONAL, OR, ParseError, REF, REPEAT, WORD
+
+class Item(modgrammar.Grammar):
+    grammar_whitespace_mode = "optional"
+    grammar = (WORD("a-z"), LITERAL(";"))
+
+class InternedGrammars(unittest.TestCase):
+
+    def test_intern(self):
+        separator = LITERAL(" ", intern=True)
+        self.assertIs(separator, LITERAL(" ", intern=True))
+        self.assertIs(OPTIONAL("a", "b", intern=True), OPTIONAL("a", "b", intern=True))
+        self.assertIsNot(LITERAL("a", intern=True), LITERAL("a", desc="letter a", intern=True))
+        with self.assertRaises(AttributeError):
+            separator.completions = ["a"]
+
+    def test_implicit_literals(self):
+        self.assertIs(OPTIONAL("a").grammar[0], GRAMMAR("a", "b").grammar[0])
+
+    def test_not_interned(self):
+        self.assertIsNot(LITERAL("a"), LITERAL("a"))
+        literal = LITERAL("a")
+        literal.completions = ["a"]
+        self.assertEqual(literal.completions, ["a"])
+        self.assertFalse(hasattr(LITERAL("a"), "completions"))
+
+class OperatorPrecedence(unittest.TestCase):
+
+    def shape(self, result):
+        if isinstance(result, modgrammar.Operators):
+            return tuple(self.shape(e) for e in result.elements)
+        return result.string
+
+    def test_precedence(self):
+        grammar = OPERATORS(WORD("0-9"), ("^", "right"), (("*", "/"), "left"), (("+", "-"), "left"))
+        parser = grammar.parser()
+        self.assertEqual(self.shape(parser.parse_text("1+2*3-4", eof=True)), ("1", "+", ("2", "*", "3"), "-", "4"))
+        parser = grammar.parser()
+        self.assertEqual(self.shape(parser.parse_text("2^3^4*5", eof=True)), (("2", "^", ("3", "^", "4")), "*", "5"))
+        parser = grammar.parser()
+        self.assertEqual(self.shape(parser.parse_text("7+", eof=True)), ("7",))
+        self.assertEqual(parser.remainder(), "+")
+
+class Cut(unittest.TestCase):
+
+    def test_cut(self):
+        self.assertIsNotNone(GRAMMAR(OR("ab", "a"), "b").parser().parse_text("ab", eof=True))
+        with self.assertRaises(ParseError):
+            GRAMMAR(OR("ab", "a"), CUT, "b").parser().parse_text("ab", eof=True)
+
+    def test_cut_in_failed_sequence(self):
+        # A sequence which fails after a CUT doesn't commit the grammars around it.
+        self.assertIsNotNone(OR(("a", CUT, "b"), ("a", "c")).parser().parse_text("ac", eof=True))
+
+class Forest(unittest.TestCase):
+
+    def test_forest(self):
+        grammar = REPEAT(OR("a", "aa"))
+        forest = grammar.parser().parse_text("a" * 40, eof=True, matchtype="forest")
+        self.assertEqual(forest.lengths, list(range(40, 0, -1)))
+        self.assertEqual(forest.count(40), 165580141)
+        self.assertTrue(forest.is_ambiguous(2))
+        self.assertEqual(sorted(len(tree.elements) for tree in forest.trees(4)), [2, 3, 3, 3, 4])
+        self.assertEqual(forest.ambiguities(2), [(grammar, 0, 2, 2)])
+
+class ChartParser(unittest.TestCase):
+
+    def test_chart_parser(self):
+        # Backtracking would try every way of splitting the a's before failing.
+        grammar = GRAMMAR(REPEAT(OR("a", "aa")), "b")
+        parser = grammar.parser(algorithm="chart")
+        with self.assertRaises(ParseError) as error:
+            parser.parse_text("a" * 500, eof=True)
+        self.assertEqual(error.exception.char, 500)
+        self.assertEqual(error.exception.expected, {LITERAL("a"), LITERAL("aa"), LITERAL("b")})
+        parser = grammar.parser(algorithm="chart")
+        self.assertIsNone(parser.parse_text("aaa"))
+        self.assertEqual(parser.parse_text("b", eof=True).elements[0].string, "aaa")
+        self.assertEqual(repr(grammar.parser(algorithm="chart").parse_text("aaab", eof=True)),
+                         repr(grammar.parser().parse_text("aaab", eof=True)))
+
+    def test_empty_matches(self):
+        # Empty matches of an element are used if backtracking gets to them.
+        grammar = OR(LIST_OF(REPEAT(LITERAL("aa"), min=0), sep=LITERAL("b")), LITERAL("a"), LITERAL("a"))
+        for matchtype in ("shortest", "first", "last"):
+            self.assertEqual(repr(grammar.parser(algorithm="chart").parse_text("aaab", eof=True, matchtype=matchtype)),
+                             repr(grammar.parser().parse_text("aaab", eof=True, matchtype=matchtype)))
+        self.assertEqual(sorted(map(repr, grammar.parser(algorithm="chart").parse_text("aaab", eof=True, matchtype="all"))),
+                         sorted(map(repr, grammar.parser().parse_text("aaab", eof=True, matchtype="all"))))
+        self.assertEqual(repr(grammar.parser(algorithm="chart").parse_text("aaab", eof=True, matchtype="shortest")), "<LIST><''>")
+
+class ParserPool(unittest.TestCase):
+
+    def test_nested_parse(self):
+        # Actions can parse with the same grammar while its parse is in progress.
+        def add(string, values, sessiondata):
+            first, _, rest = string.partition("+")
+            return int(first) + (pool.parse_string(rest) if rest else 0)
+        pool = GRAMMAR(WORD("0-9"), OPTIONAL("+", WORD("0-9+")), reduce=add).parser_pool(reduce=True)
+        self.assertEqual(pool.parse_string("1+2+3"), 6)
+        self.assertEqual(len(pool.idle), 3)
+
+class WhitespaceEnds(unittest.TestCase):
+
+    def test_whitespace_ends(self):
+        text = modgrammar.Text("a  b ")
+        ends = text.whitespace_ends(modgrammar.WS_DEFAULT)
+        comments = text.whitespace_ends(re.compile(r"(\s|#[^\n]*)+"))
+        self.assertEqual([ends[i] for i in range(6)], [0, 3, 3, 3, 5, 5])
+        self.assertEqual(comments[1], 3)
+        text.append("\n#c\nd")
+        self.assertEqual([ends[i] for i in range(11)], [0, 3, 3, 3, 6, 6, 6, 7, 9, 9, 10])
+        self.assertEqual((comments[4], comments[6]), (9, 9))
+        self.assertEqual(text.skip(3).whitespace_ends(modgrammar.WS_DEFAULT)[1], 3)
+        # What is known about the rest of the text is kept, shifted.
+        self.assertEqual(text.whitespace_ends(modgrammar.WS_DEFAULT), {0: 0, 1: 3, 2: 3, 3: 3, 4: 4, 5: 6, 6: 6, 7: 7})
+
+    def test_many_matches(self):
+        # Each match skips the text, which must not throw away (and recompute)
+        # the whitespace ends of the rest of it.
+        parser = Item.parser()
+        results = list(parser.parse_lines(["abc ; " * 2000], eof=True))
+        self.assertEqual(len(results), 2000)
+        self.assertEqual(results[-1].string, " abc ;")
+        self.assertLessEqual(len(parser.text.whitespace_cache[modgrammar.WS_DEFAULT]), 10)
+
+class References(unittest.TestCase):
+
+    def test_link_references(self):
+        grammars = types.SimpleNamespace(Item=LITERAL("x"))
+        grammar = GRAMMAR(REF("Item", module=grammars), REF("Item", module=grammars, dynamic=True))
+        parser = grammar.parser(sessiondata={"Item": LITERAL("y")})
+        self.assertIs(grammar.grammar[0], grammars.Item)
+        self.assertTrue(grammar.grammar[1].ref_dynamic)
+        self.assertEqual(parser.parse_text("xy", eof=True).string, "xy")
+
+class ParseFile(unittest.TestCase):
+
+    def test_blocks(self):
+        text = "abc; de ;\nf;  gh;"
+        for blocksize in (None, 1, 7, 8192):
+            parser = Item.parser()
+            results = list(parser.parse_file(io.StringIO(text), blocksize=blocksize))
+            self.assertEqual([r[0].string for r in results], ["abc", "de", "f", "gh"])
+
+class ResultObjects(unittest.TestCase):
+
+    def test_slots(self):
+        text = "ab,c"
+        result = GRAMMAR(WORD("a-z"), ",", WORD("a-z")).parser().parse_text(text, eof=True)
+        self.assertIsInstance(result.elements, tuple)
+        self.assertEqual(result.__dict__, {})
+        self.assertEqual(result.string, text)
+        result.string = "changed"
+        self.assertEqual(result.string, "changed")
+
+    def test_collapsed_single_element(self):
+        # No result object is built around the single element of a collapsed
+        # grammar, as it would be replaced by that element anyway.
+        grammar = GRAMMAR("a", OPTIONAL("b"))
+        count, raw = next(grammar.grammar_parse(modgrammar.Text("ab", eof=True), 0, modgrammar.ParserSession()))
+        self.assertIs(raw.elements[1].__class__, grammar.grammar[1].grammar[0])
+        count, raw = next(grammar.grammar_parse(modgrammar.Text("a", eof=True), 0, modgrammar.ParserSession()))
+        self.assertIs(raw.elements[1].__class__, grammar.grammar[1])
+        self.assertEqual([e and e.string for e in grammar.parser().parse_text("ab", eof=True).elements], ["a", "b"])
+        self.assertEqual([e and e.string for e in grammar.parser().parse_text("a", eof=True).elements], ["a", None])
+
+    def test_pickle(self):
+        result = Item.parser().parse_text("abc ;", eof=True)
+        copy = pickle.loads(pickle.dumps(result))
+        self.assertEqual(copy.string, "abc ;")
+        self.assertEqual([e.string for e in copy.elements], ["abc", ";"])
+
+class Values(unittest.TestCase):
+
+    def test_value_attr(self):
+        class Sum(modgrammar.Grammar):
+            grammar = (WORD("0-9"), "+", WORD("0-9"))
+            grammar_value_attr = "total"
+            def grammar_reduce(string, values, sessiondata):
+                return int(values[0]) + int(values[2])
+            def grammar_elem_init(self, sessiondata):
+                self.doubled = self.total * 2
+        result = Sum.parser().parse_text("1+2", eof=True)
+        self.assertEqual((result.total, result.doubled), (3, 6))
+        self.assertEqual(Sum.parser(reduce=True).parse_text("1+2", eof=True), 3)
@@ -1,4 +1,8 @@
+import concurrent.futures
+import io
 import unittest
+import modgrammar
+from modgrammar import debugging, ParseError
 
 import svgplease
 import svgplease.parse
@@ -44,6 +48,13 @@ class ParseOpen(TestParse):
         self.assertEqual(self.parse("open", "file.svg", "other file.svg", "file", "then").command,
                 command.Open("file.svg", "other file.svg", "then"))
 
+    def test_open_many_files(self):
+        filenames = ["file{}.svg".format(i) for i in range(5000)] + ["thenfile.svg", "tofile.svg"]
+        self.assertEqual(self.parse("open", *filenames).command, command.Open(*filenames))
+
+    def test_keyword_is_not_filename(self):
+        self.assertParsingFailed("open", "to")
+
 class ParseSave(TestParse):
     tested_class_name = "Save"
 
@@ -94,6 +105,85 @@ class ParseCommandList(TestParse):
                 self.parse("open", "file.svg", "then", "save", "to", "file1.svg").command_list,
                 [command.Open("file.svg"), command.Save("file1.svg")])
 
+    def test_compact_result(self):
+        result = self.parse("open", "file.svg", "then", "save", "to", "file1.svg")
+        self.assertEqual(result.elements, ())
+        self.assertTrue(result)
+        self.assertEqual(result.string, self.tokens(["open", "file.svg", "then", "save", "to", "file1.svg"]))
+        self.assertEqual(result.command_list, [command.Open("file.svg"), command.Save("file1.svg")])
+
+    def test_reduce(self):
+        tokens = ["open", "a.svg", "then", "move", "by", "10", "px", "hor", "then",
+                  "scale", "by", "50%", "vertically", "then", "change", "like", "from", "b.svg", "via", "c.svg", "to", "d.svg",
+                  "then", "tile", "to", "fill", "10", "cm", "by", "5", "mm", "pages"]
+        parser = svgplease.parse.CommandList.parser(reduce=True)
+        self.assertEqual(parser.parse_text(self.tokens(tokens), eof=True, matchtype="complete"),
+                         self.parse(*tokens).command_list)
+
+    def test_all_matches(self):
+        # Every way of reading the commands is found, including the ones which
+        # differ in the commands before the last one.
+        def count(*tokens):
+            result = svgplease.parse.CommandList.parser().parse_text(self.tokens(tokens), eof=True, matchtype="all")
+            return len(result), sum(1 for r in result if len(r.string) == len(self.tokens(tokens)))
+        self.assertEqual(count("scale", "2", "then", "scale", "3"), (6, 4))
+        self.assertEqual(count("scale", "2", "then", "scale", "3", "then", "scale", "4"), (14, 8))
+
+    def test_keyword_grammars(self):
+        keyword = svgplease.parse.Keyword("to")
+        self.assertEqual(keyword.completions, ("to",))
+        self.assertEqual(svgplease.parse.OptionalKeyword("to").type, "optional_keyword")
+        self.assertEqual(keyword.type, "keyword")
+
+    def test_chart_parser(self):
+        tokens = ["open", "a.svg", "then", "scale", "by", "50%", "then", "save", "to", "b.svg"]
+        parser = svgplease.parse.CommandList.parser(algorithm="chart")
+        self.assertEqual(parser.parse_text(self.tokens(tokens), eof=True, matchtype="complete").command_list,
+                         self.parse(*tokens).command_list)
+
+    def test_parser_pool(self):
+        pool = svgplease.parse.CommandList.parser_pool(2, reduce=True)
+        token_lists = [["open", "{}.svg".format(i), "then", "scale", "by", "{}%".format(i + 1), "then", "save", "to", "out.svg"]
+                       for i in range(40)]
+        expected = [self.parse(*tokens).command_list for tokens in token_lists]
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(lambda tokens: pool.parse_text(self.tokens(tokens), matchtype="complete"), token_lists))
+        self.assertEqual(results, expected)
+        self.assertLessEqual(len(pool.idle), 2)
+
+    def test_ambiguities(self):
+        self.assertEqual(svgplease.parse.ambiguities(
+            "open", "a.svg", "then", "move", "by", "10", "px", "then", "save", "to", "b.svg"), [])
+        # Which of the optional direction parts was left out.
+        self.assertEqual(svgplease.parse.ambiguities(
+            "open", "a.svg", "then", "scale", "by", "50%", "then", "scale", "2"),
+            [(["scale", "by", "50%"], 2), (["scale", "2"], 2)])
+        self.assertEqual(svgplease.parse.ambiguities(), [])
+        self.assertRaises(ParseError, svgplease.parse.ambiguities, "open", "then")
+
+    def test_incremental_input(self):
+        # Terminals take a shortcut when the whole input is available; feeding
+        # it in pieces and parsing under a debugger must give the same result.
+        tokens = ["open", "a.svg", "then", "move", "by", "10", "px", "hor", "then",
+                  "scale", "by", "50%", "vertically", "then", "change", "fill", "color", "to", "#ff00ff",
+                  "then", "tile", "to", "fill", "10", "cm", "by", "5", "mm", "pages"]
+        expected = self.parse(*tokens).command_list
+        text = self.tokens(tokens)
+        parser = svgplease.parse.CommandList.parser()
+        self.assertIsNone(parser.parse_text(text[:7]))
+        self.assertEqual(parser.parse_text(text[7:], eof=True, matchtype="complete").command_list, expected)
+        parser = svgplease.parse.CommandList.parser(debug=debugging.GrammarProfiler())
+        self.assertEqual(parser.parse_text(text, eof=True, matchtype="complete").command_list, expected)
+
+    def test_parse_file_in_blocks(self):
+        tokens = ["open", "a.svg", "then", "move", "by", "10", "px", "hor", "then",
+                  "scale", "by", "50%", "vertically", "then", "save", "to", "b.svg"]
+        expected = self.parse(*tokens).command_list
+        for blocksize in (None, 1, 7, 8192):
+            parser = svgplease.parse.CommandListItem.parser(reduce=True)
+            commands = list(parser.parse_file(io.StringIO(self.tokens(tokens)), blocksize=blocksize))
+            self.assertEqual(commands, expected)
+
 class ParseNumber(TestParse):
     tested_class_name = "Number"
 
@@ -214,6 +304,12 @@ class ParseDisplacement(TestParse):
         self.assertEqual(self.parse("5", "centimeters").displacement, command.Displacement(5, "cm"))
         self.assertEqual(self.parse("-0.5", "of", "pixel").displacement, command.Displacement(-0.5, "px"))
 
+    def test_arithmetic(self):
+        self.assertEqual(self.parse("10mm+2mm-1mm").displacement, command.Displacement(11, "mm"))
+        self.assertEqual(self.parse("10+2", "cm").displacement, command.Displacement(12, "cm"))
+        self.assertEqual(self.parse("10mm+2px").displacement,
+                command.Displacement(command.Displacement(10, "mm").in_pixels() + 2, "px"))
+
 class ParseDirection(TestParse):
     tested_class_name = "Direction"
 
@@ -385,6 +481,30 @@ class ParseChangeFontSize(TestParse):
         self.assertEqual(self.parse("change", "font", "size", "10").command,
                 command.ChangeFontSize(command.Length(10, "px")))
 
+class IterCommands(unittest.TestCase):
+    tokens = ["open", "a.svg", "b.svg", "then", "move", "by", "10", "px", "hor", "then",
+              "scale", "by", "50%", "vertically", "then", "change", "text", "to", "then", "then",
+              "tile", "to", "fill", "a4", "page", "then", "save", "to", "c.svg"]
+
+    def test_same_as_command_list(self):
+        command_list = svgplease.parse.CommandList.parser().parse_text(
+                svgplease.parse.join_tokens(self.tokens), eof=True, matchtype="complete").command_list
+        self.assertEqual(list(svgplease.parse.iter_commands(self.tokens)), command_list)
+
+    def test_yields_before_reading_everything(self):
+        consumed = []
+        def tokens():
+            for token in self.tokens:
+                consumed.append(token)
+                yield token
+        commands = svgplease.parse.iter_commands(tokens())
+        self.assertEqual(next(commands), command.Open("a.svg", "b.svg"))
+        self.assertEqual(consumed, self.tokens[:5])
+
+    def test_trailing_then(self):
+        commands = svgplease.parse.iter_commands(["remove", "then"])
+        self.assertRaises(svgplease.parse.ParseError, list, commands)
+
 class Complete(unittest.TestCase):
 
     def assertCompletionEqual(self, tokens, expected_completion):
@@ -408,6 +528,16 @@ class Complete(unittest.TestCase):
             "keyword": ["then"]
             })
 
+    def test_complete_unit_and_direction(self):
+        self.assertCompletionContains(["move", "10"], {
+            "unit": ["centimeter", "centimeters", "cm", "millimeter", "millimeters", "mm",
+                     "pixel", "pixels", "point", "points", "pt", "px"],
+            "direction": ["hor", "horizontally", "ver", "vertically", "x", "y"],
+            })
+        self.assertCompletionContains(["move", "10", "pi"], {
+            "unit": ["pixel", "pixels"],
+            })
+
     def test_complete_remove(self):
         self.assertCompletionContains(["remove"], {
             "optional_keyword": ["selected"]
@@ -519,3 +649,61 @@ class Complete(unittest.TestCase):
         self.assertCompletionEqual(["change", "font", "to"], {
             "font": ["Arial", "Times New Roman"],
             })
+
+class ParseErrorDetails(unittest.TestCase):
+
+    def test_lazy_details(self):
+        parser = svgplease.parse.Number.parser()
+        with self.assertRaises(svgplease.parse.ParseError) as context:
+            parser.parse_text("1x\n", eof=True, matchtype="complete")
+        error = context.exception
+        self.assertEqual((error.char, error.line, error.col), (1, 0, 1))
+        self.assertTrue(str(error).startswith("[line 1, column 2] Expected "))
+        self.assertTrue(error.message.endswith("Found 'x'"))
+        error.message = "custom"
+        self.assertEqual(str(error), "[line 1, column 2] custom")
+
+    def test_deferred_error_tracking(self):
+        for tokens in (["open", "a.svg", "then", "move", "by", "10", "x", "and", "foo"],
+                       ["change", "color", "to", "#zz"], ["scale"]):
+            text = svgplease.parse.join_tokens(tokens)
+            errors = []
+            for error_tracking in ("full", "deferred"):
+                parser = svgplease.parse.CommandList.parser(error_tracking=error_tracking)
+                with self.assertRaises(svgplease.parse.ParseError) as context:
+                    parser.parse_text(text, eof=True, matchtype="complete")
+                errors.append(context.exception)
+            full, deferred = errors
+            self.assertEqual(deferred.char, full.char)
+            self.assertEqual(deferred.expected, full.expected)
+            self.assertEqual(str(deferred), str(full))
+
+class GrammarProfiler(unittest.TestCase):
+
+    def test_stats(self):
+        profiler = debugging.GrammarProfiler()
+        svgplease.parse.CommandList.parser(debug=profiler).parse_text(
+                svgplease.parse.join_tokens(["open", "a.svg", "b.svg", "then", "save", "to", "c.svg"]),
+                eof=True, matchtype="complete")
+        stats = {s.grammar: s for s in profiler.results()}
+        filename = stats[svgplease.parse.NormalFilename]
+        self.assertEqual(filename.calls, 5)
+        self.assertEqual(filename.successes, 3)
+        self.assertGreater(filename.failures, 0)
+        self.assertGreaterEqual(filename.time, filename.self_time)
+        self.assertIn("NormalFilename", profiler.summary())
+        profiler.reset()
+        self.assertEqual(profiler.results(), [])
+
+    def test_stats_with_deferred_errors(self):
+        # The second parse done to find what was expected at the error isn't counted.
+        tokens = svgplease.parse.join_tokens(["open", "a.svg", "then", "scale", "by", "x"])
+        calls = []
+        for error_tracking in ("full", "deferred"):
+            profiler = debugging.GrammarProfiler()
+            parser = svgplease.parse.CommandList.parser(debug=profiler, error_tracking=error_tracking)
+            with self.assertRaises(ParseError) as error:
+                parser.parse_text(tokens, eof=True, matchtype="complete")
+            self.assertIn("Expected", str(error.exception))
+            calls.append({s.grammar: s.calls for s in profiler.results()})
+        self.assertEqual(calls[0], calls[1])